@@ -7,8 +7,12 @@ import pyotp
 import re
 import base64
 import time
-from extensions import bcrypt
 from logger import logger
+import cache
+import hashing
+import logstore
+import logsearch
+import metrics
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
@@ -41,8 +45,14 @@ def current_user_permissions():
     if not uid:
         return permissions
 
+    # load_user already resolved these from the cached user context
+    cached = getattr(g, "permissions", None)
+    if cached is not None:
+        permissions.update(cached)
+        return permissions
+
     try:
-        with sqlite3.connect(DB_PATH) as db:
+        with metrics.connect(DB_PATH) as db:
             c = db.cursor()
             c.execute("""
                 SELECT
@@ -79,12 +89,17 @@ def wants_json_response():
     accept = request.headers.get("Accept", "")
     return "application/json" in accept and "text/html" not in accept
 
+@api_bp.errorhandler(hashing.HashingBusy)
+def hashing_busy(e):
+    logger.warning("%s %s refused: password hashing queue full", u(getattr(g, 'user_id', None)), request.path)
+    return jsonify({"error": "Server busy, try again in a moment"}), 503
+
 @api_bp.before_request
 def require_login_for_api():
     if getattr(g, "logged_in", False):
         return None
 
-    logger.warning(f"{u(getattr(g, 'user_id', None))} unauthorized API access path={request.path}")
+    logger.warning("%s unauthorized API access path=%s", u(getattr(g, 'user_id', None)), request.path)
     if wants_json_response():
         return jsonify({"error": "Authentication required"}), 401
 
@@ -92,7 +107,7 @@ def require_login_for_api():
     return redirect(url_for("login"))
 
 def _delete_secret_by_id(secret_id):
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT name, email, company_id, secret FROM otp_secrets WHERE id = ?", (secret_id,))
         meta = cursor.fetchone()
@@ -107,31 +122,12 @@ def build_otpauth_uri(account_name, issuer, secret):
     return f"otpauth://totp/{label}?{params}"
 
 def user_ref(user_id=None, username=None):
-    try:
-        if user_id is not None and username is None:
-            with sqlite3.connect(DB_PATH) as db:
-                c = db.cursor()
-                c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-                r = c.fetchone()
-                if r:
-                    username = r[0]
-        if username is not None and user_id is None:
-            with sqlite3.connect(DB_PATH) as db:
-                c = db.cursor()
-                c.execute("SELECT id FROM users WHERE username = ?", (username,))
-                r = c.fetchone()
-                if r:
-                    user_id = r[0]
-    except:
-        pass
-    uname = username if username is not None else "unknown"
-    uid = user_id if user_id is not None else "unknown"
-    return f"{uname} with id {uid}"
+    return cache.UserRef(user_id=user_id, username=username)
 
 def u(user_id):
     if getattr(g, "user_id", None) == user_id and getattr(g, "username", None):
-        return user_ref(user_id=user_id, username=g.username)
-    return user_ref(user_id=user_id)
+        return cache.UserRef(user_id=user_id, username=g.username)
+    return cache.UserRef(user_id=user_id)
 
 def sanitize_payload(d):
     if not isinstance(d, dict):
@@ -148,28 +144,13 @@ def sanitize_payload(d):
     return redacted
 
 def get_company_name(cid):
-    try:
-        with sqlite3.connect(DB_PATH) as db:
-            c = db.cursor()
-            c.execute("SELECT name FROM companies WHERE company_id = ?", (cid,))
-            r = c.fetchone()
-            return r[0] if r else "Unknown Company"
-    except:
-        return "Unknown Company"
+    return cache.company_name(cid) or "Unknown Company"
 
 def get_username(uid):
-    try:
-        with sqlite3.connect(DB_PATH) as db:
-            c = db.cursor()
-            c.execute("SELECT username FROM users WHERE id = ?", (uid,))
-            r = c.fetchone()
-            return r[0] if r else None
-    except:
-        return None
+    return cache.username(uid)
 
 @api_bp.route("/secrets", methods=["GET"])
 def get_all_secrets():
-    t0 = time.perf_counter()
     ids_param = request.args.get("ids")
     id_list = None
     if ids_param is not None:
@@ -178,7 +159,7 @@ def get_all_secrets():
             part = part.strip()
             if part.isdigit():
                 id_list.append(int(part))
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         if id_list is not None:
             if id_list:
@@ -224,13 +205,12 @@ def get_all_secrets():
             "current_code": code,
             "seconds_remaining": remaining
         })
-    dt = round((time.perf_counter() - t0) * 1000)
+    metrics.incr("totp", len(rows))
     return jsonify(out)
 
 @api_bp.route("/secrets/<int:secret_id>", methods=["GET"])
 def get_single_secret(secret_id):
-    t0 = time.perf_counter()
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("""
             SELECT 
@@ -249,22 +229,22 @@ def get_single_secret(secret_id):
         row = cursor.fetchone()
 
     if not row:
-        logger.warning(f"{u(getattr(g, 'user_id', None))} requested secret id={secret_id} result=not_found")
+        logger.warning("%s requested secret id=%s result=not_found", u(getattr(g, 'user_id', None)), secret_id)
         return jsonify({"error": "Secret not found"}), 404
 
     secret = normalize_secret(row[3])
     try:
         totp = pyotp.TOTP(secret)
         code = totp.now()
+        metrics.incr("totp")
         time_left = totp.interval - (int(time.time()) % totp.interval)
     except (BinasciiError, ValueError) as e:
-        logger.exception(f"{u(getattr(g, 'user_id', None))} requested secret id={secret_id} result=invalid_secret")
+        logger.exception("%s requested secret id=%s result=invalid_secret", u(getattr(g, 'user_id', None)), secret_id)
         return jsonify({
             "error": "Invalid secret format. Run a database integrity check.",
             "fix_hint": "Check for invalid secrets. Use the /admin tools to fix this entry."
         }), 400
 
-    dt = round((time.perf_counter() - t0) * 1000)
     return jsonify({
         "id": row[0],
         "name": row[1],
@@ -281,19 +261,19 @@ def get_single_secret(secret_id):
 @api_bp.route("/secrets", methods=["POST"])
 def create_secret():
     if not current_user_has_permission("can_add_secrets"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} create_secret result=forbidden_missing_permission")
+        logger.warning("%s create_secret result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing permission: can_add_secrets"}), 403
     t0 = time.perf_counter()
     data = request.json or {}
     payload = sanitize_payload(data)
     company_id = int(data.get("company_id", 1))
-    company_name = get_company_name(company_id)
+    company_name = cache.CompanyRef(company_id)
     raw_secret = data.get("secret", "")
     secret = normalize_secret(raw_secret)
     if len(secret) < 16 or len(secret) > 128:
         return jsonify({"error": "Secret length invalid"}), 400
-    logger.info(f"{u(getattr(g, 'user_id', None))} create_secret start payload={payload} company={company_name} [{company_id}]")
-    with sqlite3.connect(DB_PATH) as db:
+    logger.info("%s create_secret start payload=%s company=%s [%s]", u(getattr(g, 'user_id', None)), payload, company_name, company_id)
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("""
             INSERT INTO otp_secrets (name, email, secret, otp_type, refresh_time, company_id)
@@ -309,25 +289,25 @@ def create_secret():
         db.commit()
         new_id = cursor.lastrowid
     dt = round((time.perf_counter() - t0) * 1000)
-    logger.info(f"{u(getattr(g, 'user_id', None))} create_secret done id={new_id} name={data.get('name')} company={company_name} duration_ms={dt}")
+    logger.info("%s create_secret done id=%s name=%s company=%s duration_ms=%s", u(getattr(g, 'user_id', None)), new_id, data.get('name'), company_name, dt)
     return jsonify({"status": "created", "id": new_id}), 201
 
 @api_bp.route("/secrets/<int:secret_id>", methods=["PUT"])
 def update_secret(secret_id):
     if not current_user_has_permission("can_edit"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} update_secret result=forbidden_missing_permission")
+        logger.warning("%s update_secret result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing permission: can_edit"}), 403
     t0 = time.perf_counter()
     data = request.json or {}
     payload = sanitize_payload(data)
     company_id = int(data.get("company_id", 1))
-    company_name = get_company_name(company_id)
+    company_name = cache.CompanyRef(company_id)
     raw_secret = data.get("secret", "")
     secret = normalize_secret(raw_secret)
     if len(secret) < 16 or len(secret) > 128:
         return jsonify({"error": "Secret length invalid"}), 400
-    logger.info(f"{u(getattr(g, 'user_id', None))} update_secret start id={secret_id} payload={payload} company={company_name} [{company_id}]")
-    with sqlite3.connect(DB_PATH) as db:
+    logger.info("%s update_secret start id=%s payload=%s company=%s [%s]", u(getattr(g, 'user_id', None)), secret_id, payload, company_name, company_id)
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("""
             UPDATE otp_secrets SET
@@ -350,16 +330,16 @@ def update_secret(secret_id):
         db.commit()
         if cursor.rowcount:
             dt = round((time.perf_counter() - t0) * 1000)
-            logger.info(f"{u(getattr(g, 'user_id', None))} update_secret done id={secret_id} duration_ms={dt}")
+            logger.info("%s update_secret done id=%s duration_ms=%s", u(getattr(g, 'user_id', None)), secret_id, dt)
             return jsonify({"status": "updated"})
         else:
-            logger.warning(f"{u(getattr(g, 'user_id', None))} update_secret id={secret_id} result=not_found")
+            logger.warning("%s update_secret id=%s result=not_found", u(getattr(g, 'user_id', None)), secret_id)
             return jsonify({"error": "Secret not found"}), 404
 
 @api_bp.route("/create-user", methods=["POST"])
 def create_user():
     if not current_user_has_permission("can_add_users"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} create_user result=forbidden_missing_permission")
+        logger.warning("%s create_user result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         flash("You do not have permission to manage users.", "error")
         return redirect("/users")
     t0 = time.perf_counter()
@@ -373,10 +353,10 @@ def create_user():
     can_add_secrets = int(data.get("can_add_secrets") == "on")
     can_add_users = int(data.get("can_add_users") == "on")
     if not username or not data.get("password"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} create_user result=missing_fields")
+        logger.warning("%s create_user result=missing_fields", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing fields"}), 400
-    hashed = bcrypt.generate_password_hash(data.get("password")).decode("utf-8")
-    with sqlite3.connect(DB_PATH) as db:
+    hashed = hashing.generate_password_hash(data.get("password"))
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("""
             INSERT INTO users (
@@ -398,74 +378,77 @@ def create_user():
         ))
         db.commit()
         new_id = cursor.lastrowid
+    cache.invalidate_user(new_id, username)
     dt = round((time.perf_counter() - t0) * 1000)
-    logger.info(f"{u(getattr(g, 'user_id', None))} created user {username} with id {new_id} admin={bool(is_admin)} duration_ms={dt}")
+    logger.info("%s created user %s with id %s admin=%s duration_ms=%s", u(getattr(g, 'user_id', None)), username, new_id, bool(is_admin), dt)
     return redirect("/users")
 
 @api_bp.route("/reset-password", methods=["POST"])
 def reset_password():
     if not current_user_has_permission("can_add_users"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} reset_password result=forbidden_missing_permission")
+        logger.warning("%s reset_password result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         flash("You do not have permission to manage users.", "error")
         return redirect("/users")
     t0 = time.perf_counter()
     target_id = request.form.get("user_id")
     if not target_id or not request.form.get("new_password"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} reset_password result=missing_fields")
+        logger.warning("%s reset_password result=missing_fields", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing user_id or password"}), 400
-    hashed = bcrypt.generate_password_hash(request.form.get("new_password")).decode("utf-8")
-    with sqlite3.connect(DB_PATH) as db:
+    hashed = hashing.generate_password_hash(request.form.get("new_password"))
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed, target_id))
         db.commit()
+        cache.invalidate_user(target_id)
         if cursor.rowcount:
             target_name = get_username(target_id)
             dt = round((time.perf_counter() - t0) * 1000)
-            logger.info(f"{u(getattr(g, 'user_id', None))} reset password for {user_ref(user_id=target_id, username=target_name)} duration_ms={dt}")
+            logger.info("%s reset password for %s duration_ms=%s", u(getattr(g, 'user_id', None)), user_ref(user_id=target_id, username=target_name), dt)
             return redirect("/users")
         else:
-            logger.warning(f"{u(getattr(g, 'user_id', None))} reset_password id={target_id} result=not_found")
+            logger.warning("%s reset_password id=%s result=not_found", u(getattr(g, 'user_id', None)), target_id)
             return jsonify({"error": "User not found"}), 404
 
 @api_bp.route("/delete-user", methods=["POST"])
 def delete_user():
     if not current_user_has_permission("can_add_users"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_user result=forbidden_missing_permission")
+        logger.warning("%s delete_user result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         flash("You do not have permission to manage users.", "error")
         return redirect("/users")
     t0 = time.perf_counter()
     target_id = request.form.get("user_id")
     if not target_id:
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_user result=missing_user_id")
+        logger.warning("%s delete_user result=missing_user_id", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing user_id"}), 400
     target_name = get_username(target_id)
     if target_name and target_name.lower() == "admin":
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_user blocked_protected_user {user_ref(user_id=target_id, username=target_name)}")
+        logger.warning("%s delete_user blocked_protected_user %s", u(getattr(g, 'user_id', None)), user_ref(user_id=target_id, username=target_name))
         flash("The admin user cannot be deleted.", "error")
         return redirect("/users")
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("DELETE FROM users WHERE id = ?", (target_id,))
         db.commit()
+        cache.invalidate_user(target_id)
         if cursor.rowcount:
             dt = round((time.perf_counter() - t0) * 1000)
-            logger.info(f"{u(getattr(g, 'user_id', None))} deleted user {user_ref(user_id=target_id, username=target_name)} duration_ms={dt}")
+            logger.info("%s deleted user %s duration_ms=%s", u(getattr(g, 'user_id', None)), user_ref(user_id=target_id, username=target_name), dt)
             return redirect("/users")
         else:
-            logger.warning(f"{u(getattr(g, 'user_id', None))} delete_user id={target_id} result=not_found")
+            logger.warning("%s delete_user id=%s result=not_found", u(getattr(g, 'user_id', None)), target_id)
             return jsonify({"error": "User not found"}), 404
 
 @api_bp.route("/update-user-permissions", methods=["POST"])
 def update_user_permissions():
     if not current_user_has_permission("can_add_users"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} update_user_permissions result=forbidden_missing_permission")
+        logger.warning("%s update_user_permissions result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         flash("You do not have permission to manage user permissions.", "error")
         return redirect("/users")
 
     t0 = time.perf_counter()
     target_id = request.form.get("user_id")
     if not target_id:
-        logger.warning(f"{u(getattr(g, 'user_id', None))} update_user_permissions result=missing_user_id")
+        logger.warning("%s update_user_permissions result=missing_user_id", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing user_id"}), 400
 
     is_admin = 1 if request.form.get("is_admin") == "on" else 0
@@ -479,15 +462,15 @@ def update_user_permissions():
     if can_delete_companies:
         can_add_companies = 1
 
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT username, is_admin FROM users WHERE id = ?", (target_id,))
         row = cursor.fetchone()
         if not row:
-            logger.warning(f"{u(getattr(g, 'user_id', None))} update_user_permissions id={target_id} result=not_found")
+            logger.warning("%s update_user_permissions id=%s result=not_found", u(getattr(g, 'user_id', None)), target_id)
             return jsonify({"error": "User not found"}), 404
         if str(row[0]).strip().lower() == "admin":
-            logger.warning(f"{u(getattr(g, 'user_id', None))} update_user_permissions id={target_id} result=forbidden_builtin_admin_locked")
+            logger.warning("%s update_user_permissions id=%s result=forbidden_builtin_admin_locked", u(getattr(g, 'user_id', None)), target_id)
             flash("Permissions for user admin are locked and cannot be changed.", "error")
             return redirect("/users")
 
@@ -512,9 +495,10 @@ def update_user_permissions():
             target_id
         ))
         db.commit()
+    cache.invalidate_user(target_id)
 
     dt = round((time.perf_counter() - t0) * 1000)
-    logger.info(f"{u(getattr(g, 'user_id', None))} updated permissions for {user_ref(user_id=target_id, username=row[0])} duration_ms={dt}")
+    logger.info("%s updated permissions for %s duration_ms=%s", u(getattr(g, 'user_id', None)), user_ref(user_id=target_id, username=row[0]), dt)
     return redirect("/users")
 
 @api_bp.route("/check-company", methods=["GET"])
@@ -523,7 +507,7 @@ def check_company():
     kundennummer = (request.args.get("kundennummer") or "").strip()
     exclude_id = request.args.get("exclude_id")
     result = {"name_taken": False, "kundennummer_taken": False}
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         c = db.cursor()
         if name:
             if exclude_id:
@@ -542,7 +526,7 @@ def check_company():
 @api_bp.route("/create-company", methods=["POST"])
 def create_company():
     if not current_user_has_permission("can_add_companies"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} create_company result=forbidden_missing_permission")
+        logger.warning("%s create_company result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         if wants_json_response():
             return jsonify({"error": "Missing permission: can_add_companies"}), 403
         flash("You do not have permission to add companies.", "error")
@@ -553,11 +537,11 @@ def create_company():
     password = (request.form.get("password") or "").strip()
     login_enabled = 1 if request.form.get("login_enabled") in ("on", "true", "1") else 0
     if not name:
-        logger.warning(f"{u(getattr(g, 'user_id', None))} create_company result=missing_name")
+        logger.warning("%s create_company result=missing_name", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing name"}), 400
-    hashed_password = bcrypt.generate_password_hash(password).decode("utf-8") if password else None
+    hashed_password = hashing.generate_password_hash(password) if password else None
     try:
-        with sqlite3.connect(DB_PATH) as db:
+        with metrics.connect(DB_PATH) as db:
             cursor = db.cursor()
             cursor.execute(
                 "INSERT INTO companies (name, kundennummer, password, login_enabled) VALUES (?, ?, ?, ?)",
@@ -565,15 +549,16 @@ def create_company():
             )
             db.commit()
             new_id = cursor.lastrowid
+        cache.forget_company(new_id)
     except sqlite3.IntegrityError as e:
         msg = "Kundennummer already in use" if "kundennummer" in str(e) else "A company with this name already exists"
-        logger.warning(f"{u(getattr(g, 'user_id', None))} create_company result=duplicate name={name} kundennummer={kundennummer}")
+        logger.warning("%s create_company result=duplicate name=%s kundennummer=%s", u(getattr(g, 'user_id', None)), name, kundennummer)
         if wants_json_response():
             return jsonify({"error": msg}), 409
         flash(msg, "error")
         return redirect("/companies")
     dt = round((time.perf_counter() - t0) * 1000)
-    logger.info(f"{u(getattr(g, 'user_id', None))} created company {name} with id {new_id} duration_ms={dt}")
+    logger.info("%s created company %s with id %s duration_ms=%s", u(getattr(g, 'user_id', None)), name, new_id, dt)
     if wants_json_response():
         return jsonify({"company": {
             "id": new_id, "name": name, "kundennummer": kundennummer,
@@ -584,31 +569,32 @@ def create_company():
 @api_bp.route("/delete-company", methods=["POST"])
 def delete_company():
     if not current_user_has_permission("can_delete_companies"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_company result=forbidden_missing_permission")
+        logger.warning("%s delete_company result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         flash("You do not have permission to delete companies.", "error")
         return redirect("/companies")
     t0 = time.perf_counter()
     company_id = request.form.get("company_id")
     if not company_id:
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_company result=missing_company_id")
+        logger.warning("%s delete_company result=missing_company_id", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing company_id"}), 400
     cname = get_company_name(company_id)
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("DELETE FROM companies WHERE company_id = ?", (company_id,))
         db.commit()
+        cache.forget_company(company_id)
         if cursor.rowcount:
             dt = round((time.perf_counter() - t0) * 1000)
-            logger.info(f"{u(getattr(g, 'user_id', None))} deleted company {cname} [{company_id}] duration_ms={dt}")
+            logger.info("%s deleted company %s [%s] duration_ms=%s", u(getattr(g, 'user_id', None)), cname, company_id, dt)
             return redirect("/companies")
         else:
-            logger.warning(f"{u(getattr(g, 'user_id', None))} delete_company id={company_id} result=not_found")
+            logger.warning("%s delete_company id=%s result=not_found", u(getattr(g, 'user_id', None)), company_id)
             return jsonify({"error": "Company not found"}), 404
 
 @api_bp.route("/edit-company", methods=["POST"])
 def edit_company():
     if not current_user_has_permission("can_edit"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} edit_company result=forbidden_missing_permission")
+        logger.warning("%s edit_company result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         if wants_json_response():
             return jsonify({"error": "Missing permission: can_edit"}), 403
         flash("You do not have permission to edit companies.", "error")
@@ -621,7 +607,7 @@ def edit_company():
     login_enabled = 1 if request.form.get("login_enabled") in ("on", "true", "1") else 0
 
     if not company_id or not name:
-        logger.warning(f"{u(getattr(g, 'user_id', None))} edit_company result=missing_fields")
+        logger.warning("%s edit_company result=missing_fields", u(getattr(g, 'user_id', None)))
         return jsonify({"error": "Missing fields"}), 400
 
     if kundennummer == "":
@@ -630,10 +616,10 @@ def edit_company():
     password = (password or "").strip()
     hashed_password = None
     if password:
-        hashed_password = bcrypt.generate_password_hash(password).decode("utf-8")
+        hashed_password = hashing.generate_password_hash(password)
 
     try:
-        with sqlite3.connect(DB_PATH) as db:
+        with metrics.connect(DB_PATH) as db:
             cursor = db.cursor()
             if hashed_password:
                 cursor.execute(
@@ -646,16 +632,17 @@ def edit_company():
                     (name, kundennummer, login_enabled, company_id),
                 )
             db.commit()
+        cache.forget_company(company_id)
     except sqlite3.IntegrityError as e:
         msg = "Kundennummer already in use" if "kundennummer" in str(e) else "A company with this name already exists"
-        logger.warning(f"{u(getattr(g, 'user_id', None))} edit_company result=duplicate id={company_id} name={name} kundennummer={kundennummer}")
+        logger.warning("%s edit_company result=duplicate id=%s name=%s kundennummer=%s", u(getattr(g, 'user_id', None)), company_id, name, kundennummer)
         if wants_json_response():
             return jsonify({"error": msg}), 409
         flash(msg, "error")
         return redirect("/companies")
 
     dt = round((time.perf_counter() - t0) * 1000)
-    logger.info(f"{u(getattr(g, 'user_id', None))} updated company {get_company_name(company_id)} [{company_id}] duration_ms={dt}")
+    logger.info("%s updated company %s [%s] duration_ms=%s", u(getattr(g, 'user_id', None)), get_company_name(company_id), company_id, dt)
     if wants_json_response():
         return jsonify({"company": {
             "id": int(company_id), "name": name, "kundennummer": kundennummer,
@@ -668,7 +655,7 @@ def delete_secret():
     t0 = time.perf_counter()
 
     if not current_user_has_permission("can_delete"):
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_secret result=forbidden_missing_permission")
+        logger.warning("%s delete_secret result=forbidden_missing_permission", u(getattr(g, 'user_id', None)))
         if wants_json_response():
             return jsonify({"error": "Missing permission: can_delete"}), 403
         flash("You do not have permission to delete secrets.", "error")
@@ -676,7 +663,7 @@ def delete_secret():
 
     secret_id = request.form.get("secret_id")
     if not secret_id:
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_secret result=missing_secret_id")
+        logger.warning("%s delete_secret result=missing_secret_id", u(getattr(g, 'user_id', None)))
         if wants_json_response():
             return jsonify({"error": "Missing secret_id"}), 400
         flash("No secret ID provided.", "error")
@@ -689,22 +676,21 @@ def delete_secret():
             cname = get_company_name(meta[2])
             dt = round((time.perf_counter() - t0) * 1000)
             logger.info(
-                f"{u(getattr(g, 'user_id', None))} deleted secret id={secret_id} "
-                f"name={meta[0]} email={meta[1]} company={cname} secret={meta[3]} duration_ms={dt}"
+                "%s deleted secret id=%s name=%s email=%s company=%s secret=%s duration_ms=%s", u(getattr(g, 'user_id', None)), secret_id, meta[0], meta[1], cname, meta[3], dt
             )
             if wants_json_response():
                 return jsonify({"status": "deleted", "id": int(secret_id)})
             flash("Secret deleted successfully.", "success")
             return redirect(request.referrer or url_for("home"))
 
-        logger.warning(f"{u(getattr(g, 'user_id', None))} delete_secret id={secret_id} result=not_found")
+        logger.warning("%s delete_secret id=%s result=not_found", u(getattr(g, 'user_id', None)), secret_id)
         if wants_json_response():
             return jsonify({"error": "Secret not found"}), 404
         flash("Secret not found.", "error")
         return redirect(request.referrer or url_for("home"))
 
     except Exception:
-        logger.exception(f"{u(getattr(g, 'user_id', None))} delete_secret id={secret_id} result=error")
+        logger.exception("%s delete_secret id=%s result=error", u(getattr(g, 'user_id', None)), secret_id)
         if wants_json_response():
             return jsonify({"error": "An error occurred while deleting the secret"}), 500
         flash("An error occurred while deleting the secret.", "error")
@@ -712,17 +698,63 @@ def delete_secret():
 
 @api_bp.route("/logs")
 def live_logs():
+    if not current_user_has_permission("is_admin"):
+        return jsonify({"error": "Missing permission: is_admin"}), 403
     day = request.args.get("day")
     if not day:
-        return jsonify(logs=[])
-    log_file = os.path.join("logs", day, "app.log")
+        return jsonify(records=[], levels={}, modules=[])
+
+    def _multi(name):
+        return [v.strip() for value in request.args.getlist(name) for v in value.split(",") if v.strip()]
+
+    flt = logstore.make_filter(
+        levels=_multi("level"),
+        modules=_multi("module"),
+        time_from=request.args.get("from"),
+        time_to=request.args.get("to"),
+        text=request.args.get("q"),
+    )
     try:
-        with open(log_file, "r") as f:
-            lines = f.readlines()[-500:]
+        limit = int(request.args.get("limit") or logstore.DEFAULT_LIMIT)
+    except ValueError:
+        limit = logstore.DEFAULT_LIMIT
+    try:
+        since = int(request.args["since"]) if request.args.get("since") else None
+    except ValueError:
+        since = None
+    try:
+        result = logstore.query(day, flt, limit, since)
     except FileNotFoundError:
-        lines = []
-        logger.warning(f"{u(getattr(g, 'user_id', None))} live_logs day={day} result=file_not_found")
-    return jsonify(logs=lines)
+        logger.warning("%s live_logs day=%s result=file_not_found", u(getattr(g, 'user_id', None)), day)
+        return jsonify(records=[], levels={}, modules=[])
+    return jsonify(result)
+
+@api_bp.route("/logs/search")
+def search_logs():
+    if not current_user_has_permission("is_admin"):
+        return jsonify({"error": "Missing permission: is_admin"}), 403
+
+    def _multi(name):
+        return [v.strip() for value in request.args.getlist(name) for v in value.split(",") if v.strip()]
+
+    t0 = time.perf_counter()
+    try:
+        q = logsearch.make_query(
+            levels=_multi("level"),
+            modules=_multi("module"),
+            time_from=request.args.get("from"),
+            time_to=request.args.get("to"),
+            text=request.args.get("q"),
+            regex=request.args.get("regex") in ("1", "true", "on"),
+        )
+        limit = int(request.args.get("limit") or logsearch.PAGE_DEFAULT)
+        result = logsearch.search(q, limit, request.args.get("cursor"), request.args.get("order") != "asc")
+    except (logsearch.SearchError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    dt = round((time.perf_counter() - t0) * 1000)
+    logger.info("%s searched logs results=%d days=%d scanned=%d duration_ms=%d", u(getattr(g, 'user_id', None)),
+                len(result["results"]), result["days_searched"], result["records_scanned"], dt)
+    return jsonify(result)
 
 @api_bp.route("/export-search", methods=["GET"])
 def export_search():
@@ -735,7 +767,7 @@ def export_search():
         except:
             pass
 
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         c = db.cursor()
 
         if selected_ids:
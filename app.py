@@ -1,27 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify, Response
+import asyncmode
+if __name__ == "__main__":
+    # gevent has to patch the stdlib before anything below imports it
+    asyncmode.setup()
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify, Response, send_file
 import sqlite3
 import json
 import os
 import sys
-import shutil
 import uuid
 import urllib.request
 import subprocess
 import signal
 import struct
+import hmac
+import select
 from datetime import datetime
 import time
 from functools import wraps
-from api import api_bp
-from extensions import bcrypt
-from logger import logger
+from api import api_bp, u, user_ref
+from logger import logger, stats as logging_stats, set_json_logs, add_tap, deliver_tap, retention_from_settings, set_retention
 import threading
+from collections import deque
 from flask_socketio import SocketIO, emit, join_room, disconnect
 from database import (
-    hourly_maintenance, acquire_lock, release_lock, get_missing_columns,
-    ensure_dirs, init_db, backup_db, load_state, save_state,
-    normalize_secrets, check_orphans, BACKUP_DIR,
+    get_missing_columns, ensure_dirs, init_db, load_state, acquire_lock, release_lock,
+    run_restore_hooks, wal_status, BACKUP_DIR,
 )
+import scheduler
+import cache
+import hashing
+import sqlprofile
+import sampler
+import wsgiserver
+import prefork
+import reqprofile
+import ratelimit
+import logstore
+import metrics
 
 try:
     import pty
@@ -30,14 +45,8 @@ try:
 except ImportError:
     pty = fcntl = termios = None
 
-_LOGIN_MAX_ATTEMPTS = 5
-_LOGIN_LOCKOUT_SECONDS = 900
-_login_attempts: dict = {}
-_login_lock = threading.Lock()
-
 app = Flask(__name__)
-bcrypt.init_app(app)
-socketio = SocketIO(app, async_mode="threading")
+socketio = SocketIO(app, async_mode=asyncmode.mode())
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join("instance", "otp.db")
@@ -80,31 +89,51 @@ CONSOLE_CMD = [sys.executable or "python3", os.path.join(BASE_DIR, "start.py")]
 _CONSOLE_BUFFER_MAX = 200_000
 _console_lock = threading.Lock()
 _console = {"proc": None, "fd": None}
+_console_clients = set()
 _console_buffer = bytearray()
 
+# Under prefork the pty lives in the master, which has no websocket clients:
+# workers send it start/input/resize/stop (_console_remote) and it
+# broadcasts what the console prints; each worker keeps its own copy of the
+# scrollback and passes events on to its clients (_console_relay).
+def _buffer_console_output(data: bytes):
+    with _console_lock:
+        _console_buffer.extend(data)
+        if len(_console_buffer) > _CONSOLE_BUFFER_MAX:
+            del _console_buffer[: len(_console_buffer) - _CONSOLE_BUFFER_MAX]
+
+def _console_publish(event, data):
+    if prefork.is_master():
+        prefork.broadcast("console", {"event": event, "data": data})
+    else:
+        socketio.emit(event, data, namespace="/console", room="console")
+
 def _console_reader(fd, proc):
+    # waits in select() rather than in read() so that under gevent (which
+    # patches select but not reads on a pty) only this greenlet waits
     while True:
         try:
+            select.select([fd], [], [])
             data = os.read(fd, 4096)
         except OSError:
             break
         if not data:
             break
-        with _console_lock:
-            _console_buffer.extend(data)
-            if len(_console_buffer) > _CONSOLE_BUFFER_MAX:
-                del _console_buffer[: len(_console_buffer) - _CONSOLE_BUFFER_MAX]
-        socketio.emit("output", data.decode("utf-8", "replace"), namespace="/console", room="console")
+        _buffer_console_output(data)
+        _console_publish("output", data.decode("utf-8", "replace"))
     proc.wait()
     with _console_lock:
         if _console["proc"] is proc:
             _console["proc"] = None
             _console["fd"] = None
-    socketio.emit("exited", {}, namespace="/console", room="console")
+    _console_publish("exited", {})
 
 def _console_start():
     if pty is None:
         return False, "Remote console isn't supported on this platform."
+    if prefork.is_worker():
+        prefork.send("console", {"op": "start"})
+        return True, None
     with _console_lock:
         proc = _console["proc"]
         if proc is not None and proc.poll() is None:
@@ -131,10 +160,14 @@ def _console_start():
         _console["proc"] = proc
         _console["fd"] = master_fd
         _console_buffer.clear()
-        threading.Thread(target=_console_reader, args=(master_fd, proc), daemon=True).start()
-        return True, None
+        socketio.start_background_task(_console_reader, master_fd, proc)
+    prefork.broadcast("console", {"event": "reset"})
+    return True, None
 
 def _console_write(data: bytes):
+    if prefork.is_worker():
+        prefork.send("console", {"op": "input", "data": data.decode("utf-8", "replace")})
+        return
     with _console_lock:
         fd = _console["fd"]
     if fd is not None:
@@ -144,6 +177,9 @@ def _console_write(data: bytes):
             pass
 
 def _console_resize(rows, cols):
+    if prefork.is_worker():
+        prefork.send("console", {"op": "resize", "rows": rows, "cols": cols})
+        return
     with _console_lock:
         fd = _console["fd"]
         proc = _console["proc"]
@@ -157,6 +193,9 @@ def _console_resize(rows, cols):
         pass
 
 def _console_stop():
+    if prefork.is_worker():
+        prefork.send("console", {"op": "stop"})
+        return
     with _console_lock:
         proc = _console["proc"]
         fd = _console["fd"]
@@ -173,6 +212,35 @@ def _console_stop():
         except OSError:
             pass
 
+def _console_remote(msg, reply):
+    op = msg.get("op")
+    if op == "start":
+        ok, err = _console_start()
+        if not ok:
+            reply("console", {"event": "error", "data": {"message": err}})
+    elif op == "input":
+        _console_write(str(msg.get("data") or "").encode("utf-8"))
+    elif op == "resize":
+        try:
+            _console_resize(int(msg.get("rows", 24)), int(msg.get("cols", 80)))
+        except (TypeError, ValueError):
+            pass
+    elif op == "stop":
+        _console_stop()
+
+def _console_relay(msg, _reply):
+    event = msg.get("event")
+    if event == "reset":
+        with _console_lock:
+            _console_buffer.clear()
+        return
+    if event == "output":
+        _buffer_console_output(str(msg.get("data") or "").encode("utf-8"))
+    socketio.emit(event, msg.get("data"), namespace="/console", room="console")
+
+prefork.on("console", _console_remote, role="master")
+prefork.on("console", _console_relay)
+
 def _console_authorized():
     load_user()
     return bool(g.logged_in and g.is_admin)
@@ -184,6 +252,8 @@ def console_connect():
         disconnect()
         return False
     join_room("console")
+    with _console_lock:
+        _console_clients.add(request.sid)
     ok, err = _console_start()
     if not ok:
         emit("error", {"message": err})
@@ -192,7 +262,12 @@ def console_connect():
         snapshot = bytes(_console_buffer)
     if snapshot:
         emit("output", snapshot.decode("utf-8", "replace"))
-    logger.info(f"{u(g.user_id)} opened the remote console")
+    logger.info("%s opened the remote console", u(g.user_id))
+
+@socketio.on("disconnect", namespace="/console")
+def console_disconnect():
+    with _console_lock:
+        _console_clients.discard(request.sid)
 
 @socketio.on("input", namespace="/console")
 def console_input(data):
@@ -215,10 +290,172 @@ def console_resize_evt(data):
 def console_stop_evt():
     if not _console_authorized():
         return
-    logger.warning(f"{u(g.user_id)} ended the remote console session")
+    logger.warning("%s ended the remote console session", u(g.user_id))
     _console_stop()
     socketio.emit("exited", {}, namespace="/console", room="console")
 
+# ---- live log stream -------------------------------------------------------
+# The logs page subscribes over the /logs namespace instead of polling. The
+# log listener hands every written record to _log_stream_tap, which only
+# appends it to an inbox; a background task wakes every LOG_STREAM_TICK,
+# routes the inbox to the subscribers whose day and filter match and sends
+# each one batch. A client gets its next batch only after acking the last,
+# so a slow one just accumulates a pending queue, capped at
+# LOG_STREAM_PENDING_MAX (oldest dropped, and the count reported with the
+# next batch). A burst that overflows the inbox before the next tick is
+# counted the same way, for every client, since nobody knows whose records
+# they were. Admin rights are checked once, on connect.
+LOG_STREAM_TICK = 0.5
+LOG_STREAM_BACKLOG = 500
+LOG_STREAM_BATCH_MAX = 500
+LOG_STREAM_PENDING_MAX = 2000
+LOG_STREAM_ACK_TIMEOUT = 30
+LOG_STREAM_INBOX_MAX = 20000
+_log_stream_lock = threading.Lock()
+_log_stream = {"clients": {}, "inbox": deque(maxlen=LOG_STREAM_INBOX_MAX), "overflow": 0, "task": None}
+
+def _log_stream_tap(doc):
+    if _log_stream["clients"]:
+        inbox = _log_stream["inbox"]
+        if len(inbox) == inbox.maxlen:
+            _log_stream["overflow"] += 1
+        inbox.append(doc)
+
+def _log_stream_sent(client, r):
+    # caller holds _log_stream_lock; whether the backlog already had r.
+    # Compared until the first record past the backlog's last second.
+    cutoff = client["cutoff"]
+    if cutoff is None:
+        return False
+    last, seen = cutoff
+    if r["time"] > last:
+        client["cutoff"] = None
+        return False
+    return r["time"] < last or (r["time"], r["msg"]) in seen
+
+def _log_stream_route(client, batch):
+    # caller holds _log_stream_lock
+    for r in batch:
+        if r["day"] != client["day"] or _log_stream_sent(client, r):
+            continue
+        client["levels"][r["level"]] = client["levels"].get(r["level"], 0) + 1
+        client["modules"].add(r["module"])
+        if not logstore.matches(r, client["filter"]):
+            continue
+        client["pending"].append(r)
+        if len(client["pending"]) > LOG_STREAM_PENDING_MAX:
+            client["pending"].popleft()
+            client["dropped"] += 1
+
+def _log_stream_ack(sid):
+    with _log_stream_lock:
+        client = _log_stream["clients"].get(sid)
+        if client is not None:
+            client["inflight"] = None
+
+def _log_stream_loop():
+    inbox = _log_stream["inbox"]
+    while True:
+        socketio.sleep(LOG_STREAM_TICK)
+        batch = []
+        while inbox:
+            batch.append(inbox.popleft())
+        overflow, _log_stream["overflow"] = _log_stream["overflow"], 0
+        now = time.time()
+        out = []
+        with _log_stream_lock:
+            for sid, client in _log_stream["clients"].items():
+                client["dropped"] += overflow
+                if batch:
+                    _log_stream_route(client, batch)
+                if not client["ready"]:
+                    continue
+                if client["inflight"] is not None and now - client["inflight"] < LOG_STREAM_ACK_TIMEOUT:
+                    continue
+                if not client["pending"] and not client["dropped"] and not client["levels"]:
+                    continue
+                pending = client["pending"]
+                records = [pending.popleft() for _ in range(min(len(pending), LOG_STREAM_BATCH_MAX))]
+                out.append((sid, {
+                    "records": records,
+                    "dropped": client["dropped"],
+                    "levels": client["levels"],
+                    "modules": sorted(client["modules"]),
+                }))
+                client.update(dropped=0, levels={}, modules=set(), inflight=now)
+        for sid, payload in out:
+            socketio.emit("lines", payload, namespace="/logs", to=sid,
+                          callback=lambda *args, sid=sid: _log_stream_ack(sid))
+
+add_tap(_log_stream_tap)
+# prefork workers get every worker's records from the master
+prefork.on("log", lambda doc, _reply: deliver_tap(doc))
+
+def _log_stream_start():
+    with _log_stream_lock:
+        if _log_stream["task"] is None:
+            _log_stream["task"] = socketio.start_background_task(_log_stream_loop)
+
+@socketio.on("connect", namespace="/logs")
+def log_stream_connect():
+    if not _console_authorized():
+        logger.warning("rejected unauthorized log stream connection attempt")
+        disconnect()
+        return False
+    with _log_stream_lock:
+        _log_stream["clients"][request.sid] = {
+            "user_id": g.user_id, "day": None, "filter": None, "ready": False,
+            "pending": deque(), "dropped": 0, "levels": {}, "modules": set(), "inflight": None, "cutoff": None,
+        }
+    _log_stream_start()
+
+@socketio.on("disconnect", namespace="/logs")
+def log_stream_disconnect():
+    with _log_stream_lock:
+        _log_stream["clients"].pop(request.sid, None)
+
+@socketio.on("subscribe", namespace="/logs")
+def log_stream_subscribe(data):
+    sid = request.sid
+    if sid not in _log_stream["clients"] or not isinstance(data, dict):
+        return
+    day = str(data.get("day") or "")
+
+    def _multi(value):
+        values = value if isinstance(value, list) else str(value or "").split(",")
+        return [str(v).strip() for v in values if str(v).strip()]
+
+    flt = logstore.make_filter(
+        levels=_multi(data.get("level")),
+        modules=_multi(data.get("module")),
+        time_from=data.get("from"),
+        time_to=data.get("to"),
+        text=data.get("q"),
+    )
+    # subscribe before reading the backlog so nothing written in between is
+    # missed, then drop what the backlog already covers: from what is
+    # pending now, and from what is still in the inbox as it gets routed
+    with _log_stream_lock:
+        client = _log_stream["clients"].get(sid)
+        if client is None:
+            return
+        client.update(day=day, filter=flt, ready=False, pending=deque(), dropped=0, levels={}, modules=set(), cutoff=None)
+    try:
+        backlog = logstore.query(day, flt, LOG_STREAM_BACKLOG)
+    except FileNotFoundError:
+        backlog = {"records": [], "levels": {}, "modules": []}
+    records = backlog["records"]
+    last = records[-1].get("time") if records else ""
+    seen = {(r.get("time"), r.get("msg")) for r in records if r.get("time") == last}
+    with _log_stream_lock:
+        client = _log_stream["clients"].get(sid)
+        if client is None or client["filter"] is not flt:
+            return
+        client["cutoff"] = (last, seen) if records else None
+        client["pending"] = deque(r for r in client["pending"] if not _log_stream_sent(client, r))
+        client.update(ready=True, levels={}, modules=set())
+    emit("backlog", backlog)
+
 def sniff_avatar_ext(data):
     if data[:8] == b"\x89PNG\r\n\x1a\n":
         return "png"
@@ -243,6 +480,8 @@ def remove_avatar_files(user_id):
         if os.path.isfile(path):
             os.remove(path)
 
+SERVER_MODES = ("development", "production")
+
 def load_app_settings():
     defaults = {
         "host": "0.0.0.0",
@@ -261,14 +500,45 @@ def load_app_settings():
         port = defaults["port"]
     secret_key = str(os.environ.get("OTP_SECRET_KEY") or data.get("secret_key") or defaults["secret_key"]).strip() or defaults["secret_key"]
     company_name = str(data.get("company_name") or "").strip()
+    bcrypt_rounds = hashing.rounds_from_settings(data)
+    server_mode = str(os.environ.get("OTP_SERVER_MODE") or data.get("server_mode") or "development").strip().lower()
+    if server_mode not in SERVER_MODES:
+        server_mode = "development"
+    server_threads = wsgiserver.threads_from_settings({"server_threads": os.environ.get("OTP_SERVER_THREADS") or data.get("server_threads")})
+    workers = prefork.workers_from_settings({"workers": os.environ.get("OTP_WORKERS") or data.get("workers")})
+    if server_mode != "production" or not prefork.supported() or asyncmode.mode() == "gevent":
+        workers = 0
+    # each worker would otherwise count failed logins on its own
+    rate_limit_store = "sqlite" if data.get("rate_limit_store") == "sqlite" or workers else "memory"
+    json_logs = bool(data.get("json_logs"))
+    log_retention_days, log_retention_mb = retention_from_settings(data)
+    metrics_token = str(os.environ.get("OTP_METRICS_TOKEN") or data.get("metrics_token") or "").strip()
+    sql_profile, sql_slow_ms = sqlprofile.settings_from(data)
     return {
         "host": host,
         "port": port,
         "secret_key": secret_key,
-        "company_name": company_name
+        "company_name": company_name,
+        "bcrypt_rounds": bcrypt_rounds,
+        "rate_limit_store": rate_limit_store,
+        "json_logs": json_logs,
+        "log_retention_days": log_retention_days,
+        "log_retention_mb": log_retention_mb,
+        "metrics_token": metrics_token,
+        "sql_profile": sql_profile,
+        "sql_slow_ms": sql_slow_ms,
+        "server_mode": server_mode,
+        "server_threads": server_threads,
+        "workers": workers,
+        "socketio_async": asyncmode.mode()
     }
 
 APP_SETTINGS = load_app_settings()
+hashing.set_rounds(APP_SETTINGS["bcrypt_rounds"])
+ratelimit.configure(APP_SETTINGS["rate_limit_store"])
+set_json_logs(APP_SETTINGS["json_logs"])
+set_retention(APP_SETTINGS["log_retention_days"], APP_SETTINGS["log_retention_mb"])
+sqlprofile.configure(APP_SETTINGS["sql_profile"], APP_SETTINGS["sql_slow_ms"])
 
 app.secret_key = APP_SETTINGS["secret_key"]
 app.register_blueprint(api_bp, url_prefix="/api")
@@ -286,33 +556,6 @@ def get_app_version():
     except Exception:
         return "0.0.0"
 
-def user_ref(user_id=None, username=None):
-    try:
-        if user_id is not None and username is None:
-            with sqlite3.connect(DB_PATH) as db:
-                c = db.cursor()
-                c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-                r = c.fetchone()
-                if r:
-                    username = r[0]
-        if username is not None and user_id is None:
-            with sqlite3.connect(DB_PATH) as db:
-                c = db.cursor()
-                c.execute("SELECT id FROM users WHERE username = ?", (username,))
-                r = c.fetchone()
-                if r:
-                    user_id = r[0]
-    except:
-        pass
-    uname = username if username is not None else "unknown"
-    uid = user_id if user_id is not None else "unknown"
-    return f"{uname} with id {uid}"
-
-def u(user_id):
-    if getattr(g, "user_id", None) == user_id and getattr(g, "username", None):
-        return user_ref(user_id=user_id, username=g.username)
-    return user_ref(user_id=user_id)
-
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -327,7 +570,7 @@ def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if not g.is_admin:
-            logger.warning(f"{u(g.user_id)} attempted admin-only access.")
+            logger.warning("%s attempted admin-only access.", u(g.user_id))
             flash("Admin access required.", "error")
             return redirect(url_for("home"))
         return f(*args, **kwargs)
@@ -350,7 +593,7 @@ def permission_required(permission_name):
                 return redirect(url_for("login"))
 
             if not has_permission(permission_name):
-                logger.warning(f"{u(g.user_id)} missing permission '{permission_name}'.")
+                logger.warning("%s missing permission '%s'.", u(g.user_id), permission_name)
                 flash("Access denied.", "error")
                 return redirect(url_for("home"))
 
@@ -379,38 +622,29 @@ def row_to_settings(row):
         "full_width_layout": int(row[27] or 0),
     }
 
-def _is_rate_limited(ip: str) -> float | None:
-    with _login_lock:
-        entry = _login_attempts.get(ip)
-        if not entry:
-            return None
-        now = time.time()
-        if entry["locked_until"] and now < entry["locked_until"]:
-            return entry["locked_until"] - now
-        if now - entry["window_start"] > _LOGIN_LOCKOUT_SECONDS:
-            del _login_attempts[ip]
-        return None
-
-def _record_failed_login(ip: str):
-    now = time.time()
-    with _login_lock:
-        entry = _login_attempts.get(ip)
-        if not entry or now - entry["window_start"] > _LOGIN_LOCKOUT_SECONDS:
-            _login_attempts[ip] = {"count": 1, "window_start": now, "locked_until": 0.0}
-        else:
-            entry["count"] += 1
-            if entry["count"] >= _LOGIN_MAX_ATTEMPTS:
-                entry["locked_until"] = now + _LOGIN_LOCKOUT_SECONDS
-
-def _clear_login_attempts(ip: str):
-    with _login_lock:
-        _login_attempts.pop(ip, None)
-
 @app.errorhandler(404)
 def page_not_found(e):
-    logger.warning(f"404 Error: {request.path} not found.")
+    logger.warning("404 Error: %s not found.", request.path)
     return render_template("404.html"), 404
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        metrics.record(request.endpoint or "<unmatched>", response.status_code, time.perf_counter() - started)
+    return response
+
+@app.teardown_request
+def record_failed_request(exc):
+    # after_request is skipped when the error handling itself failed
+    started = g.pop("request_started", None)
+    if started is not None:
+        metrics.record(request.endpoint or "<unmatched>", 500, time.perf_counter() - started)
+
 @app.before_request
 def block_on_schema_mismatch():
     if request.endpoint == "static":
@@ -421,6 +655,21 @@ def block_on_schema_mismatch():
             html = f.read()
         return Response(html, status=503, mimetype="text/html")
 
+# What open pages fetch on a timer (codes, pinned list, live logs, the
+# status cards) and Prometheus scrapes aren't activity: with any page left
+# open the server would otherwise never be idle for WAL_IDLE_SECONDS.
+IDLE_POLL_ENDPOINTS = frozenset({
+    "static", "api.get_all_secrets", "user_pinned", "api.live_logs",
+    "db_jobs", "db_wal", "db_queries", "server_requests", "server_hashing",
+    "server_logging", "server_ping", "prometheus_metrics",
+})
+
+@app.before_request
+def mark_activity():
+    # idle time feeds the WAL checkpoint policy (see scheduler.touch)
+    if request.endpoint not in IDLE_POLL_ENDPOINTS:
+        scheduler.touch()
+
 @app.before_request
 def load_user():
     g.user_id = session.get("user_id")
@@ -434,58 +683,124 @@ def load_user():
     g.can_delete_companies = False
     g.can_add_secrets = False
     g.can_add_users = False
+    g.permissions = None
 
     if g.logged_in:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("""
-                SELECT
-                    id, username, password, last_login_time, session_token,
-                    is_admin, can_delete, can_edit, can_add_companies,
-                    can_delete_companies, can_add_secrets, can_add_users,
-                    pinned, show_timer, show_otp_type, show_emails, show_company,
-                    blur_on_inactive, show_including_admin_on_top, hide_codes_by_default, hide_secret_field,
-                    show_search_and_link, show_pinned_in_sidebar, only_pinned_in_sidebar, bg_animation_style,
-                    bg_animation_intensity, blur_on_inactive_delay, full_width_layout
-                FROM users
-                WHERE id = ?
-            """, (g.user_id,))
-            row = cursor.fetchone()
-
-            if row:
-                db_token = row[4]
-                session_token = session.get("session_token")
-                if db_token and session_token != db_token:
-                    session.clear()
-                    g.logged_in = False
-                    g.user_id = None
-                    return
-
-                g.username = row[1]
-                g.is_admin = bool(row[5])
-                g.can_delete = bool(row[6]) or g.is_admin
-                g.can_edit = bool(row[7]) or g.is_admin
-                g.can_add_companies = bool(row[8]) or g.is_admin
-                g.can_delete_companies = bool(row[9]) or g.is_admin
-                g.can_add_secrets = bool(row[10]) or g.is_admin
-                g.can_add_users = bool(row[11]) or g.is_admin
-                g.user_settings = {
-                    "show_timer": int(row[13] or 0),
-                    "show_otp_type": int(row[14] or 0),
-                    "show_emails": int(row[15] or 0),
-                    "show_company": int(row[16] or 0),
-                    "blur_on_inactive": int(row[17] or 0),
-                    "show_including_admin_on_top": int(row[18] or 0),
-                    "hide_codes_by_default": int(row[19] or 0),
-                    "hide_secret_field": int(row[20] or 0),
-                    "show_search_and_link": int(row[21] or 0),
-                    "show_pinned_in_sidebar": int(row[22] or 0),
-                    "only_pinned_in_sidebar": int(row[23] or 0),
-                    "bg_animation_style": row[24] or "turbulence",
-                    "bg_animation_intensity": int(row[25]) if row[25] is not None else 100,
-                    "blur_on_inactive_delay": int(row[26]) if row[26] is not None else 60,
-                    "full_width_layout": int(row[27] or 0),
-                }
+        session_token = session.get("session_token")
+        ctx = cache.get_user_context(g.user_id, session_token)
+        if ctx is None:
+            ctx = _load_user_context(g.user_id, session_token)
+        if ctx is None:
+            return
+        if ctx is False:
+            session.clear()
+            g.logged_in = False
+            g.user_id = None
+            return
+
+        g.username = ctx["username"]
+        g.is_admin = ctx["is_admin"]
+        for name, allowed in ctx["permissions"].items():
+            setattr(g, name, allowed)
+        g.permissions = dict(ctx["permissions"], is_admin=ctx["is_admin"])
+        g.user_settings = dict(ctx["user_settings"])
+
+# Registered after load_user so g.is_admin is known; as an after_request
+# hook registered later it runs before record_request_metrics.
+@app.before_request
+def start_request_profile():
+    if not g.logged_in or not g.is_admin or request.endpoint == "static" or not reqprofile.requested(request):
+        return
+    g.profile = reqprofile.start()
+    g.profile_busy = g.profile is None
+    g.profile_started = time.perf_counter()
+
+@app.after_request
+def save_request_profile(response):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        reqprofile.stop(profile)
+        elapsed_ms = round((time.perf_counter() - g.profile_started) * 1000, 1)
+        profile_id = reqprofile.save(profile, {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "user": g.username,
+            "elapsed_ms": elapsed_ms,
+        })
+        response.headers["X-Profile-Id"] = profile_id
+        response.headers["Link"] = f'<{url_for("view_profile", profile_id=profile_id)}>; rel="profile"'
+        logger.info("%s profiled %s %s (%s ms) as %s", u(g.user_id), request.method, request.path, elapsed_ms, profile_id)
+    elif g.pop("profile_busy", False):
+        response.headers["X-Profile"] = "busy"
+    return response
+
+@app.teardown_request
+def drop_request_profile(exc):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        reqprofile.stop(profile)
+
+def _load_user_context(user_id, session_token):
+    """Reads the user row behind a session. Returns None if the user is
+    gone, False if the session token no longer matches, else the context
+    dict (which is also cached)."""
+    gen = cache.generation()
+    with metrics.connect(DB_PATH) as db:
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT
+                id, username, password, last_login_time, session_token,
+                is_admin, can_delete, can_edit, can_add_companies,
+                can_delete_companies, can_add_secrets, can_add_users,
+                pinned, show_timer, show_otp_type, show_emails, show_company,
+                blur_on_inactive, show_including_admin_on_top, hide_codes_by_default, hide_secret_field,
+                show_search_and_link, show_pinned_in_sidebar, only_pinned_in_sidebar, bg_animation_style,
+                bg_animation_intensity, blur_on_inactive_delay, full_width_layout
+            FROM users
+            WHERE id = ?
+        """, (user_id,))
+        row = cursor.fetchone()
+
+    if not row:
+        return None
+    db_token = row[4]
+    if db_token and session_token != db_token:
+        return False
+
+    is_admin = bool(row[5])
+    ctx = {
+        "username": row[1],
+        "is_admin": is_admin,
+        "permissions": {
+            "can_delete": bool(row[6]) or is_admin,
+            "can_edit": bool(row[7]) or is_admin,
+            "can_add_companies": bool(row[8]) or is_admin,
+            "can_delete_companies": bool(row[9]) or is_admin,
+            "can_add_secrets": bool(row[10]) or is_admin,
+            "can_add_users": bool(row[11]) or is_admin,
+        },
+        "user_settings": {
+            "show_timer": int(row[13] or 0),
+            "show_otp_type": int(row[14] or 0),
+            "show_emails": int(row[15] or 0),
+            "show_company": int(row[16] or 0),
+            "blur_on_inactive": int(row[17] or 0),
+            "show_including_admin_on_top": int(row[18] or 0),
+            "hide_codes_by_default": int(row[19] or 0),
+            "hide_secret_field": int(row[20] or 0),
+            "show_search_and_link": int(row[21] or 0),
+            "show_pinned_in_sidebar": int(row[22] or 0),
+            "only_pinned_in_sidebar": int(row[23] or 0),
+            "bg_animation_style": row[24] or "turbulence",
+            "bg_animation_intensity": int(row[25]) if row[25] is not None else 100,
+            "blur_on_inactive_delay": int(row[26]) if row[26] is not None else 60,
+            "full_width_layout": int(row[27] or 0),
+        },
+    }
+    cache.put_user_context(user_id, session_token, ctx, gen)
+    return ctx
 
 @app.context_processor
 def inject_user():
@@ -505,24 +820,48 @@ def inject_user():
         show_index_button=INDEX_TEMPLATE_PRESENT,
         app_version=get_app_version(),
         current_year=datetime.now().year,
-        company_brand=APP_SETTINGS.get("company_name", "")
+        company_brand=APP_SETTINGS.get("company_name", ""),
+        # Socket.IO's polling handshake spans several requests, which
+        # prefork workers don't share state for
+        socketio_options={"transports": ["websocket"]} if APP_SETTINGS["workers"] else {}
     )
 
+def _rehash_password(user_id, username, old_hash, password):
+    """Bring a stored hash (or a legacy plaintext password) up to the
+    configured bcrypt cost after a successful login. Best effort: the login
+    never fails because of it, and the migration job covers plaintext."""
+    try:
+        new_hash = hashing.generate_password_hash(password)
+    except hashing.HashingBusy:
+        logger.debug("%s rehash deferred, hashing queue full", user_ref(user_id=user_id, username=username))
+        return
+    with metrics.connect(DB_PATH) as db:
+        cursor = db.cursor()
+        cursor.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?", (new_hash, user_id, old_hash))
+        db.commit()
+    if not cursor.rowcount:
+        return
+    old_rounds = hashing.hash_rounds(old_hash)
+    if old_rounds is None:
+        logger.info("%s plaintext password hashed at cost %s", user_ref(user_id=user_id, username=username), hashing.get_rounds())
+    else:
+        logger.info("%s password rehashed from cost %s to %s", user_ref(user_id=user_id, username=username), old_rounds, hashing.get_rounds())
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     t0 = time.perf_counter()
 
     if g.logged_in:
-        logger.info(f"{u(g.user_id)} attempted to access login while already logged in.")
+        logger.info("%s attempted to access login while already logged in.", u(g.user_id))
         flash("You are already logged in.", "info")
         return redirect(url_for("home"))
 
     if request.method == "POST":
         ip = request.remote_addr
-        remaining = _is_rate_limited(ip)
+        remaining = ratelimit.remaining(ip)
         if remaining is not None:
             wait_min = int(remaining // 60) + 1
-            logger.warning(f"Rate limit hit on /login from IP={ip} ({remaining:.0f}s remaining)")
+            logger.warning("Rate limit hit on /login from IP=%s (%.0fs remaining)", ip, remaining)
             flash(f"Too many failed login attempts. Try again in {wait_min} minute(s).", "error")
             return redirect(url_for("login"))
 
@@ -530,10 +869,10 @@ def login():
         password = request.form.get("password", "")
         keep_logged_in = "keep_logged_in" in request.form
 
-        logger.info(f"Login attempt start username='{username}' keep_logged_in={keep_logged_in}")
+        logger.info("Login attempt start username='%s' keep_logged_in=%s", username, keep_logged_in)
 
         try:
-            with sqlite3.connect(DB_PATH) as db:
+            with metrics.connect(DB_PATH) as db:
                 cursor = db.cursor()
                 cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
                 user = cursor.fetchone()
@@ -542,52 +881,63 @@ def login():
                 user_id = user[0]
                 stored_password = user[2]
                 is_admin = bool(user[5])
-                logger.debug(f"Login: Found user id={user_id} admin={is_admin}")
-
-                if stored_password == password or stored_password.strip() == "":
-                    logger.warning(f"{user_ref(user_id=user_id, username=username)} using unhashed/empty password — migrating to hash.")
-                    hashed = bcrypt.generate_password_hash(stored_password or password).decode("utf-8")
-                    with sqlite3.connect(DB_PATH) as db:
-                        cursor = db.cursor()
-                        cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed, user_id))
-                        db.commit()
-                    stored_password = hashed
-                    flash("Password has been migrated to a secure hash.", "info")
+                logger.debug("Login: Found user id=%s admin=%s", user_id, is_admin)
+
+                legacy = hashing.hash_rounds(stored_password) is None
+                if legacy:
+                    # a value the migration job hasn't reached yet: this one
+                    # is checked and hashed below, the job gets the rest
+                    scheduler.trigger("password_migration")
+                    if not (stored_password or "").strip():
+                        logger.warning("%s has an empty password, needs an admin reset", user_ref(user_id=user_id, username=username))
+                        flash("Your password has to be reset by an administrator.", "error")
+                        return redirect(url_for("login"))
+                    valid = hmac.compare_digest(stored_password.encode("utf-8"), password.encode("utf-8"))
+                else:
+                    valid = hashing.check_password_hash(stored_password, password)
 
-                if bcrypt.check_password_hash(stored_password, password):
-                    _clear_login_attempts(ip)
+                if valid:
+                    ratelimit.clear(ip)
                     session_token = str(uuid.uuid4())
                     session["user_id"] = user_id
                     session["is_admin"] = is_admin
                     session["session_token"] = session_token
                     session.permanent = keep_logged_in
 
-                    with sqlite3.connect(DB_PATH) as db:
+                    with metrics.connect(DB_PATH) as db:
                         cursor = db.cursor()
                         cursor.execute("UPDATE users SET session_token = ? WHERE id = ?", (session_token, user_id))
                         db.commit()
+                    cache.invalidate_user(user_id)
 
-                    logger.info(f"{user_ref(user_id=user_id, username=username)} login successful. permanent_session={keep_logged_in}")
+                    if legacy or hashing.needs_rehash(stored_password):
+                        _rehash_password(user_id, username, stored_password, password)
+
+                    logger.info("%s login successful. permanent_session=%s", user_ref(user_id=user_id, username=username), keep_logged_in)
                     if is_admin and password == "1234":
-                        logger.warning(f"{user_ref(user_id=user_id, username=username)} logged in with default admin password.")
+                        logger.warning("%s logged in with default admin password.", user_ref(user_id=user_id, username=username))
                         flash("You are using the default password. Please change it.", "warning")
 
                     dt = round((time.perf_counter() - t0) * 1000)
-                    logger.debug(f"Login processing complete for {user_ref(user_id=user_id, username=username)} duration_ms={dt}")
+                    logger.debug("Login processing complete for %s duration_ms=%s", user_ref(user_id=user_id, username=username), dt)
                     return redirect(url_for("home"))
                 else:
-                    _record_failed_login(ip)
-                    logger.warning(f"{user_ref(username=username)} failed login: invalid password.")
+                    ratelimit.record_failure(ip)
+                    logger.warning("%s failed login: invalid password.", user_ref(username=username))
                     flash("Invalid credentials!", "error")
                     return redirect(url_for("login"))
             else:
-                _record_failed_login(ip)
-                logger.warning(f"Login failed: username='{username}' not found.")
+                ratelimit.record_failure(ip)
+                logger.warning("Login failed: username='%s' not found.", username)
                 flash("User not found.", "error")
                 return redirect(url_for("login"))
 
+        except hashing.HashingBusy:
+            logger.warning("Login for username='%s' refused: password hashing queue full", username)
+            flash("The server is busy. Please try again in a moment.", "error")
+            return redirect(url_for("login"))
         except Exception as e:
-            logger.exception(f"Login error for username='{username}': {e}")
+            logger.exception("Login error for username='%s': %s", username, e)
             flash("An error occurred. Please try again.", "error")
             return redirect(url_for("login"))
 
@@ -596,7 +946,7 @@ def login():
 @app.route("/logout")
 def logout():
     user_id = session.get("user_id")
-    logger.info(f"{u(user_id)} logged out.")
+    logger.info("%s logged out.", u(user_id))
     session.clear()
     return redirect(url_for("login"))
 
@@ -609,7 +959,7 @@ def home():
 @login_required
 @permission_required("can_add_users")
 def users():
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("""
             SELECT
@@ -628,11 +978,11 @@ def users():
 @login_required
 def companies():
     if not (has_permission("can_add_companies") or has_permission("can_delete_companies")):
-        logger.warning(f"{u(g.user_id)} attempted to access /companies without permission.")
+        logger.warning("%s attempted to access /companies without permission.", u(g.user_id))
         flash("Access denied.", "error")
         return redirect(url_for("home"))
 
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute(
             """
@@ -655,10 +1005,10 @@ def companies():
 @login_required
 def companies_json():
     if not has_permission("can_add_companies"):
-        logger.warning(f"{u(g.user_id)} attempted to access /companies/json without permission.")
+        logger.warning("%s attempted to access /companies/json without permission.", u(g.user_id))
         return jsonify({"error": "Missing permission: can_add_companies"}), 403
 
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT company_id, name FROM companies ORDER BY name ASC")
         company_list = cursor.fetchall()
@@ -669,7 +1019,7 @@ def companies_json():
 def settings():
     if g.user_settings:
         return render_template("settings.html", user=g.user_settings)
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("""
                 SELECT
@@ -729,7 +1079,7 @@ def update_settings():
         "full_width_layout": flag("full_width_layout"),
     }
     try:
-        with sqlite3.connect(DB_PATH) as db:
+        with metrics.connect(DB_PATH) as db:
             cursor = db.cursor()
             cursor.execute(
                 """
@@ -771,12 +1121,13 @@ def update_settings():
                 ),
             )
             db.commit()
-        logger.info(f"Updated settings for {u(g.user_id)}: {payload}")
+        cache.invalidate_user(g.user_id)
+        logger.info("Updated settings for %s: %s", u(g.user_id), payload)
         if is_ajax:
             return jsonify({"message": "Settings saved."})
         flash("Settings saved.", "success")
     except Exception as e:
-        logger.exception(f"Error updating settings for {u(g.user_id)}: {e}")
+        logger.exception("Error updating settings for %s: %s", u(g.user_id), e)
         if is_ajax:
             return jsonify({"error": "Could not save settings."}), 500
         flash("Could not save settings.", "error")
@@ -797,14 +1148,14 @@ def upload_avatar():
     remove_avatar_files(g.user_id)
     with open(os.path.join(AVATAR_DIR, f"{g.user_id}.{ext}"), "wb") as f:
         f.write(data)
-    logger.info(f"{u(g.user_id)} updated their profile photo")
+    logger.info("%s updated their profile photo", u(g.user_id))
     return jsonify({"avatar_url": get_avatar_url(g.user_id)})
 
 @app.route("/api/account/avatar", methods=["DELETE"])
 @login_required
 def delete_avatar():
     remove_avatar_files(g.user_id)
-    logger.info(f"{u(g.user_id)} removed their profile photo")
+    logger.info("%s removed their profile photo", u(g.user_id))
     return jsonify({"message": "Profile photo removed"})
 
 @app.route("/add", methods=["GET", "POST"])
@@ -819,7 +1170,7 @@ def add():
         refresh_time = int(request.form.get("refresh_time", 30))
         company_id = int(request.form.get("company_id", 1))
 
-        with sqlite3.connect(DB_PATH) as db:
+        with metrics.connect(DB_PATH) as db:
             cursor = db.cursor()
             cursor.execute(
                 """
@@ -830,10 +1181,10 @@ def add():
             )
             db.commit()
 
-        logger.info(f"{u(g.user_id)} added new OTP entry: {name}")
+        logger.info("%s added new OTP entry: %s", u(g.user_id), name)
         return redirect(url_for("home"))
 
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT company_id, name FROM companies ORDER BY name ASC")
         companies = cursor.fetchall()
@@ -847,7 +1198,7 @@ def toggle_pin():
     secret_id = str(data.get("secret_id"))
     user_id = session["user_id"]
 
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT pinned FROM users WHERE id = ?", (user_id,))
         row = cursor.fetchone()
@@ -863,14 +1214,14 @@ def toggle_pin():
         cursor.execute("UPDATE users SET pinned = ? WHERE id = ?", (",".join(pinned), user_id))
         db.commit()
 
-    logger.info(f"{u(user_id)} {'pinned' if new_state else 'unpinned'} secret ID {secret_id}")
+    logger.info("%s %s secret ID %s", u(user_id), 'pinned' if new_state else 'unpinned', secret_id)
     return jsonify({"pinned": new_state})
 
 @app.route("/api/user-pinned")
 @login_required
 def user_pinned():
     user_id = session["user_id"]
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT pinned FROM users WHERE id = ?", (user_id,))
         row = cursor.fetchone()
@@ -895,13 +1246,7 @@ def view_logs():
     today = datetime.now().strftime("%Y-%m-%d")
     selected_day = request.args.get("day") or today
 
-    try:
-        log_folders = sorted(
-            [name for name in os.listdir("logs") if os.path.isdir(os.path.join("logs", name))],
-            reverse=True,
-        )
-    except FileNotFoundError:
-        log_folders = []
+    log_folders = logstore.list_days()
     if not log_folders:
         log_folders = [today]
 
@@ -913,7 +1258,7 @@ def admin_required_json(f):
         if not g.logged_in:
             return jsonify({"error": "Authentication required"}), 401
         if not g.is_admin:
-            logger.warning(f"{u(g.user_id)} attempted admin-only API access path={request.path}")
+            logger.warning("%s attempted admin-only API access path=%s", u(g.user_id), request.path)
             return jsonify({"error": "Admin access required"}), 403
         return f(*args, **kwargs)
     return decorated_function
@@ -922,7 +1267,7 @@ def admin_required_json(f):
 @login_required
 @admin_required
 def webaccess():
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT company_id, name, login_enabled FROM companies ORDER BY name ASC")
         company_list = cursor.fetchall()
@@ -936,13 +1281,13 @@ def toggle_web_access():
     enabled = 1 if data.get("enabled") else 0
     if not company_id:
         return jsonify({"error": "Missing company_id"}), 400
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("UPDATE companies SET login_enabled = ? WHERE company_id = ?", (enabled, company_id))
         db.commit()
         if not cursor.rowcount:
             return jsonify({"error": "Company not found"}), 404
-    logger.info(f"{u(g.user_id)} set web access enabled={bool(enabled)} for company id={company_id}")
+    logger.info("%s set web access enabled=%s for company id=%s", u(g.user_id), bool(enabled), company_id)
     return jsonify({"enabled": bool(enabled)})
 
 def _list_backups():
@@ -980,7 +1325,7 @@ def database_page():
         size_bytes = 0
     size_mb = round(size_bytes / (1024 * 1024), 1)
     size_label = f"{size_bytes / 1024:.1f} KB" if size_bytes < 1024 * 1024 else f"{size_mb} MB"
-    with sqlite3.connect(DB_PATH) as db:
+    with metrics.connect(DB_PATH) as db:
         cursor = db.cursor()
         cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")
         tables = cursor.fetchone()[0]
@@ -997,6 +1342,8 @@ def database_page():
     last_vacuum = load_state().get("last_vacuum") or "Unknown"
     if last_vacuum == datetime.now().strftime("%Y-%m-%d"):
         last_vacuum = "Today"
+    wal = wal_status()
+    wal_label = f"{wal['size'] / 1024:.1f} KB" if wal["size"] < 1024 * 1024 else f"{wal['size'] / (1024 * 1024):.1f} MB"
 
     stats = [
         {"label": "Database size", "value": size_label},
@@ -1004,8 +1351,9 @@ def database_page():
         {"label": "Total records", "value": records},
         {"label": "Last backup", "value": last_backup},
         {"label": "Last vacuum", "value": last_vacuum},
+        {"label": "WAL size", "value": wal_label},
     ]
-    return render_template("database.html", stats=stats, backups=backups, size_bytes=size_bytes)
+    return render_template("database.html", stats=stats, backups=backups, size_bytes=size_bytes, jobs=scheduler.list_jobs(), wal=wal, queries=_query_stats())
 
 _SCHEMA_COLUMN_DEFAULTS = {
     "users.can_delete": "INTEGER DEFAULT 0",
@@ -1028,29 +1376,46 @@ _SCHEMA_COLUMN_DEFAULTS = {
     "companies.login_enabled": "INTEGER DEFAULT 0",
 }
 
+# vacuum, integrity, repair and backup run in the maintenance worker
+# process (scheduler.run_task), never in the one serving requests
+def _db_task_response(task, outcome):
+    if outcome["status"] == "skipped":
+        return jsonify({"error": "Database maintenance is running — try again in a moment"}), 409
+    if outcome["status"] not in ("ok", "issues"):
+        logger.error("database task '%s' failed: %s", task, outcome["error"])
+        return jsonify({"error": f"Task failed: {outcome['error']}"}), 500
+    result = outcome["result"] or {}
+    if task == "vacuum":
+        return jsonify({"message": "Vacuum & optimize completed"})
+    if task == "integrity":
+        summary = f"{result['orphans']} orphaned records · {result['fk_issues']} broken foreign keys · schema {'OK' if result['ok'] else 'ISSUES FOUND'}"
+        return jsonify({"message": "Integrity check completed", "result": summary})
+    if task == "repair":
+        return jsonify({"message": "Database repaired"})
+    if not result.get("backup"):
+        return jsonify({"error": "No database file found"}), 500
+    return jsonify({"message": "Backup created"})
+
 @app.route("/api/db/task", methods=["POST"])
 @admin_required_json
 def run_db_task():
     data = request.get_json() or {}
     task = data.get("task")
-    logger.info(f"{u(g.user_id)} started database task '{task}'")
+    logger.info("%s started database task '%s'", u(g.user_id), task)
+    if task in ("vacuum", "integrity", "repair", "backup"):
+        return _db_task_response(task, scheduler.run_task(task))
+    # same lock as the maintenance jobs and backup restore, which may be
+    # running in the scheduler's worker or another server process
+    locked = task == "schema"
+    if locked and not acquire_lock():
+        return jsonify({"error": "Database maintenance is running — try again in a moment"}), 409
 
     try:
-        if task == "vacuum":
-            with sqlite3.connect(DB_PATH) as db:
-                db.isolation_level = None
-                db.execute("VACUUM")
-                db.execute("PRAGMA optimize")
-            state = load_state()
-            state["last_vacuum"] = datetime.now().strftime("%Y-%m-%d")
-            save_state(state)
-            return jsonify({"message": "Vacuum & optimize completed"})
-
         if task == "schema":
             missing = get_missing_columns()
             if not missing:
                 return jsonify({"message": "Schema is up to date"})
-            with sqlite3.connect(DB_PATH) as db:
+            with metrics.connect(DB_PATH) as db:
                 cursor = db.cursor()
                 for item in missing:
                     table, col = item.split(".", 1)
@@ -1059,42 +1424,225 @@ def run_db_task():
                 db.commit()
             return jsonify({"message": f"Schema updated — added {len(missing)} missing column(s)"})
 
-        if task == "integrity":
-            with sqlite3.connect(DB_PATH) as db:
-                cursor = db.cursor()
-                cursor.execute("PRAGMA integrity_check")
-                integrity_ok = (cursor.fetchone() or ["error"])[0].lower() == "ok"
-                cursor.execute("PRAGMA foreign_key_check")
-                fk_issues = len(cursor.fetchall())
-            orphans = check_orphans()
-            result = f"{orphans} orphaned records · {fk_issues} broken foreign keys · schema {'OK' if integrity_ok else 'ISSUES FOUND'}"
-            return jsonify({"message": "Integrity check completed", "result": result})
-
-        if task == "repair":
-            normalize_secrets()
-            with sqlite3.connect(DB_PATH) as db:
-                db.execute("REINDEX")
-            return jsonify({"message": "Database repaired"})
-
         if task == "reset_sessions":
-            with sqlite3.connect(DB_PATH) as db:
+            with metrics.connect(DB_PATH) as db:
                 cursor = db.cursor()
                 cursor.execute("SELECT id FROM users")
                 for (uid,) in cursor.fetchall():
                     cursor.execute("UPDATE users SET session_token = ? WHERE id = ?", (str(uuid.uuid4()), uid))
                 db.commit()
+            cache.clear_users()
             return jsonify({"message": "All sessions reset — every user will need to log in again"})
 
-        if task == "backup":
-            dest = backup_db()
-            if not dest:
-                return jsonify({"error": "No database file found"}), 500
-            return jsonify({"message": "Backup created"})
-
         return jsonify({"error": "Unknown task"}), 400
     except Exception as e:
-        logger.exception(f"database task '{task}' failed: {e}")
+        logger.exception("database task '%s' failed: %s", task, e)
         return jsonify({"error": f"Task failed: {e}"}), 500
+    finally:
+        if locked:
+            release_lock()
+
+@app.route("/api/db/jobs")
+@admin_required_json
+def db_jobs():
+    return jsonify(scheduler.list_jobs())
+
+@app.route("/api/db/wal")
+@admin_required_json
+def db_wal():
+    return jsonify(wal_status())
+
+def _query_stats():
+    # per worker under prefork; the page says which one answered
+    return dict(sqlprofile.stats(), worker=_worker_label())
+
+@app.route("/api/db/queries")
+@admin_required_json
+def db_queries():
+    return jsonify(_query_stats())
+
+@app.route("/api/db/queries/reset", methods=["POST"])
+@admin_required_json
+def db_queries_reset():
+    _reset_stats("queries")
+    prefork.send("reset", "queries")
+    logger.info("%s reset the query profile", u(g.user_id))
+    return jsonify({"message": "Query profile reset"})
+
+@app.route("/api/db/queries/config", methods=["POST"])
+@admin_required_json
+def db_queries_config():
+    data = request.get_json() or {}
+    enabled = bool(data.get("enabled"))
+    try:
+        slow_ms = max(1, int(data.get("slow_ms") or APP_SETTINGS["sql_slow_ms"]))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid slow query threshold"}), 400
+
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            settings = json.load(f) or {}
+    except Exception:
+        settings = {}
+    settings["sql_profile"] = enabled
+    settings["sql_slow_ms"] = slow_ms
+    with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
+        json.dump(settings, f, indent=2)
+
+    _configure_sql_profile({"enabled": enabled, "slow_ms": slow_ms})
+    prefork.send("sqlprofile", {"enabled": enabled, "slow_ms": slow_ms})
+    logger.info("%s %s the query profiler (slow >= %s ms)", u(g.user_id), "enabled" if enabled else "disabled", slow_ms)
+    return jsonify({"message": "Query profiler " + ("on" if enabled else "off")})
+
+@app.route("/api/server/hashing")
+@admin_required_json
+def server_hashing():
+    return jsonify(hashing.stats())
+
+@app.route("/api/server/logging")
+@admin_required_json
+def server_logging():
+    return jsonify(logging_stats())
+
+# ---- Prometheus -------------------------------------------------------------
+# /metrics is for a scraper on this machine: with no metrics_token set it
+# only answers requests from loopback that didn't come through a proxy;
+# with one set it wants "Authorization: Bearer <token>" from anywhere.
+def _metrics_allowed():
+    token = APP_SETTINGS["metrics_token"]
+    if token:
+        supplied = request.headers.get("Authorization", "")
+        return hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+    return request.remote_addr in ("127.0.0.1", "::1") and "X-Forwarded-For" not in request.headers
+
+def _metrics_extra():
+    caches = cache.stats()
+    # under prefork the master reports the jobs, workers only hold a copy
+    jobs = [] if prefork.is_worker() else scheduler.list_jobs()
+    logs = logging_stats()
+    pool = hashing.stats()
+    with _console_lock:
+        console_clients = len(_console_clients)
+    with _log_stream_lock:
+        log_clients = len(_log_stream["clients"])
+
+    def secs(ms):
+        return None if ms is None else round(ms / 1000, 3)
+
+    return [
+        ("otp_cache_hits_total", "counter", "Cache lookups answered from memory.",
+         [({"cache": name}, caches[name]["hits"]) for name in caches]),
+        ("otp_cache_misses_total", "counter", "Cache lookups that went to the database.",
+         [({"cache": name}, caches[name]["misses"]) for name in caches]),
+        ("otp_cache_entries", "gauge", "Entries held per cache.",
+         [({"cache": name}, caches[name]["size"]) for name in caches]),
+        ("otp_job_last_duration_seconds", "gauge", "Duration of the last run of a maintenance job.",
+         [({"job": j["name"]}, secs(j["last_ms"])) for j in jobs]),
+        ("otp_job_avg_duration_seconds", "gauge", "Mean duration of recent runs of a maintenance job.",
+         [({"job": j["name"]}, secs(j["avg_ms"])) for j in jobs]),
+        ("otp_job_last_run_timestamp_seconds", "gauge", "When a maintenance job last ran.",
+         [({"job": j["name"]}, j["last_run"]) for j in jobs]),
+        ("otp_job_running", "gauge", "1 while a maintenance job is running.",
+         [({"job": j["name"]}, int(bool(j["running"]))) for j in jobs]),
+        ("otp_websocket_clients", "gauge", "Connected Socket.IO clients by namespace.",
+         [({"namespace": "/console"}, console_clients), ({"namespace": "/logs"}, log_clients)]),
+        ("otp_log_queue_depth", "gauge", "Records waiting for the log listener.", [({}, logs["queue_depth"])]),
+        ("otp_log_records_written_total", "counter", "Log records written.", [({}, logs["written"])]),
+        ("otp_log_records_dropped_total", "counter", "Log records dropped on a full queue.", [({}, logs["dropped"])]),
+        ("otp_password_hash_pending", "gauge", "Password hashes queued or running.", [({}, pool["pending"])]),
+        ("otp_password_hash_rejected_total", "counter", "Password hashes refused as busy.", [({}, pool["rejected"])]),
+    ]
+
+@app.route("/metrics")
+def prometheus_metrics():
+    if not _metrics_allowed():
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    if not prefork.is_worker():
+        return Response(metrics.render_prometheus(_metrics_extra()), mimetype="text/plain; version=0.0.4; charset=utf-8")
+    answer = _peer_answer()
+    peers = {slot: p["families"] for slot, p in answer["workers"].items()}
+    if answer["master"]:
+        peers["master"] = answer["master"]
+    text = metrics.render_prometheus(_metrics_extra(), worker=str(prefork.worker_slot()), peers=peers)
+    return Response(text, mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/api/server/requests")
+@admin_required_json
+def server_requests():
+    peers = _peer_answer()["workers"].values() if prefork.is_worker() else ()
+    return jsonify(metrics.stats([p["requests"] for p in peers]))
+
+@app.route("/api/server/requests/reset", methods=["POST"])
+@admin_required_json
+def server_requests_reset():
+    _reset_stats("requests")
+    prefork.send("reset", "requests")
+    logger.info("%s reset the request metrics", u(g.user_id))
+    return jsonify({"message": "Request metrics reset"})
+
+@app.route("/api/server/profile", methods=["POST"])
+@admin_required_json
+def server_profile():
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get("seconds") or request.args.get("seconds") or sampler.DEFAULT_SECONDS)
+        interval = float(data.get("interval") or request.args.get("interval") or sampler.DEFAULT_INTERVAL)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid duration or interval"}), 400
+    logger.info("%s started a %.0f s profile", u(g.user_id), seconds)
+    try:
+        # under gevent it has to be a real thread to see the others run
+        result = asyncmode.blocking(sampler.sample, seconds, interval)
+    except sampler.SamplerBusy as e:
+        return jsonify({"error": str(e)}), 409
+    logger.info("Profile done: %s samples, %s stacks, %s ms spent sampling", result["samples"], result["stacks"], result["overhead_ms"])
+    resp = Response(result["collapsed"], mimetype="text/plain")
+    resp.headers["Content-Disposition"] = f"attachment; filename=profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed"
+    resp.headers["X-Profile-Samples"] = str(result["samples"])
+    resp.headers["X-Profile-Seconds"] = str(result["seconds"])
+    resp.headers["X-Profile-Overhead-Ms"] = str(result["overhead_ms"])
+    worker = _worker_label()
+    if worker:
+        # one worker's threads only; which one is down to who took the request
+        resp.headers["Content-Disposition"] = resp.headers["Content-Disposition"].replace(".collapsed", f"-w{worker['slot']}.collapsed")
+        resp.headers["X-Profile-Worker"] = f"{worker['slot']} (pid {worker['pid']}) of {worker['workers']}"
+    return resp
+
+@app.route("/profiles")
+@login_required
+@admin_required
+def list_request_profiles():
+    return render_template("profiles.html", profiles=reqprofile.list_profiles(), profile=None, rows=[], sort=None)
+
+@app.route("/profiles/<profile_id>")
+@login_required
+@admin_required
+def view_profile(profile_id):
+    sort = request.args.get("sort", reqprofile.SORTS[0])
+    found = reqprofile.top(profile_id, sort)
+    if found is None:
+        return render_template("404.html"), 404
+    meta, rows = found
+    return render_template("profiles.html", profiles=reqprofile.list_profiles(), profile=meta, rows=rows,
+                           sort=sort if sort in reqprofile.SORTS else reqprofile.SORTS[0], sorts=reqprofile.SORTS)
+
+@app.route("/profiles/<profile_id>/pstats")
+@login_required
+@admin_required
+def download_profile(profile_id):
+    path = reqprofile.stats_path(profile_id)
+    if path is None:
+        return render_template("404.html"), 404
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=profile_id + ".pstats")
+
+@app.route("/api/db/jobs/<name>/run", methods=["POST"])
+@admin_required_json
+def db_run_job(name):
+    if name not in scheduler.JOBS:
+        return jsonify({"error": "Unknown job"}), 404
+    scheduler.trigger(name)
+    logger.info("%s triggered maintenance job '%s'", u(g.user_id), name)
+    return jsonify({"message": f"Job '{name}' queued"})
 
 @app.route("/api/db/backups")
 @admin_required_json
@@ -1110,18 +1658,16 @@ def db_load_backup():
     if name not in valid_names:
         return jsonify({"error": "Unknown backup"}), 400
     src = os.path.join(BACKUP_DIR, name)
-    try:
-        backup_db()
-        shutil.copyfile(src, os.path.join(BASE_DIR, DB_PATH))
-        for suffix in ("-wal", "-shm"):
-            side = os.path.join(BASE_DIR, DB_PATH) + suffix
-            if os.path.exists(side):
-                os.remove(side)
-        logger.warning(f"{u(g.user_id)} restored database backup {name}")
-        return jsonify({"message": f"Loaded {name} — a safety backup of the previous database was created"})
-    except Exception as e:
-        logger.exception(f"restore of backup {name} failed: {e}")
-        return jsonify({"error": f"Restore failed: {e}"}), 500
+    outcome = scheduler.run_task("restore", src)
+    if outcome["status"] == "skipped":
+        return jsonify({"error": "Database maintenance is running — try again in a moment"}), 409
+    if outcome["status"] != "ok":
+        logger.error("restore of backup %s failed: %s", name, outcome["error"])
+        return jsonify({"error": f"Restore failed: {outcome['error']}"}), 500
+    # the worker restored the file; this process still has to drop its caches
+    run_restore_hooks()
+    logger.warning("%s restored database backup %s duration_ms=%s", u(g.user_id), name, outcome['duration_ms'])
+    return jsonify({"message": f"Loaded {name} — a safety backup of the previous database was created"})
 
 @app.route("/server")
 @login_required
@@ -1154,7 +1700,7 @@ def server_check_update():
         with urllib.request.urlopen(url, timeout=8) as res:
             latest = res.read().decode("utf-8").strip()
     except Exception as e:
-        logger.warning(f"update check failed: {e}")
+        logger.warning("update check failed: %s", e)
         return jsonify({"error": "Could not reach the update server"}), 502
 
     def vtuple(v):
@@ -1165,7 +1711,7 @@ def server_check_update():
         return tuple(parts)
 
     available = vtuple(latest) > vtuple(current)
-    logger.info(f"{u(g.user_id)} checked for updates: current={current} latest={latest} available={available}")
+    logger.info("%s checked for updates: current=%s latest=%s available=%s", u(g.user_id), current, latest, available)
     return jsonify({"current": current, "latest": latest, "available": available})
 
 @app.route("/api/server/config", methods=["POST"])
@@ -1195,7 +1741,7 @@ def server_config():
         json.dump(settings, f, indent=2)
 
     APP_SETTINGS["company_name"] = company_name
-    logger.info(f"{u(g.user_id)} updated server configuration (port={port})")
+    logger.info("%s updated server configuration (port=%s)", u(g.user_id), port)
     changed_runtime = port != APP_SETTINGS.get("port") or secret_key != APP_SETTINGS.get("secret_key")
     msg = "Server configuration saved"
     if changed_runtime:
@@ -1215,21 +1761,21 @@ def _stop_process():
 @app.route("/api/server/restart", methods=["POST"])
 @admin_required_json
 def server_restart():
-    logger.info(f"{u(g.user_id)} restarted the server")
+    logger.info("%s restarted the server", u(g.user_id))
     threading.Thread(target=_restart_process, daemon=True).start()
     return jsonify({"message": "Restarting"})
 
 @app.route("/api/server/stop", methods=["POST"])
 @admin_required_json
 def server_stop():
-    logger.info(f"{u(g.user_id)} stopped the server")
+    logger.info("%s stopped the server", u(g.user_id))
     threading.Thread(target=_stop_process, daemon=True).start()
     return jsonify({"message": "Stopping"})
 
 @app.route("/api/server/update-now", methods=["POST"])
 @admin_required_json
 def server_update_now():
-    logger.warning(f"{u(g.user_id)} triggered an update from the web UI")
+    logger.warning("%s triggered an update from the web UI", u(g.user_id))
     try:
         with open(UPDATE_STATUS_PATH, "w", encoding="utf-8") as f:
             json.dump({
@@ -1262,25 +1808,136 @@ def server_ping():
         "last_update": read_update_status() or None,
     })
 
-def maintenance_loop():
-    while True:
+# ---- prefork wiring --------------------------------------------------------
+# See prefork.py. The master runs the scheduler and the console pty; the
+# workers ask it for job runs and console I/O and get job snapshots back.
+def _prefork_warmup():
+    scheduler.share_activity()
+    # compiled once here, shared by every worker
+    for name in app.jinja_env.list_templates():
         try:
-            if acquire_lock():
-                try:
-                    hourly_maintenance()
-                finally:
-                    release_lock()
-            else:
-                logger.warning("skip maintenance, lock present")
+            app.jinja_env.get_template(name)
         except Exception as e:
-            logger.critical(f"Database maintenance error: {e}")
-        time.sleep(3600)
+            logger.warning("template %s failed to compile: %s", name, e)
+
+def _prefork_master_start():
+    ratelimit.start_sweeper()
+    scheduler.on_change(lambda: prefork.broadcast("jobs", scheduler.list_jobs()))
+    scheduler.start()
+    scheduler.trigger("password_migration")
+    prefork.broadcast("jobs", scheduler.list_jobs())
+
+def _prefork_worker_start():
+    scheduler.set_remote(prefork.send, prefork.ask)
+    hashing.set_pool_size(hashing.POOL_SIZE // APP_SETTINGS["workers"])
+    hashing.start()
+    threading.Thread(target=_peer_push_loop, daemon=True, name="peer-push").start()
+
+def _run_task_remote(msg, reply):
+    # tasks take minutes; don't hold up the channel's read loop
+    def run():
+        reply("task", scheduler.run_task(msg.get("name"), *(msg.get("args") or [])))
+    threading.Thread(target=run, daemon=True, name="task-" + str(msg.get("name"))).start()
+
+def _prefork_hello(_msg, reply):
+    reply("jobs", scheduler.list_jobs())
+    # a replacement worker starts from the settings it was forked with
+    reply("sqlprofile", {"enabled": APP_SETTINGS["sql_profile"], "slow_ms": APP_SETTINGS["sql_slow_ms"]})
+    with _console_lock:
+        snapshot = bytes(_console_buffer)
+    if snapshot:
+        reply("console", {"event": "output", "data": snapshot.decode("utf-8", "replace")})
+
+# Each worker has its own request table, Prometheus counters and query
+# profiler. Workers push their metric families and request rows to the
+# master every PEER_PUSH_SECONDS; the worker answering /metrics or the
+# request table asks the master for everyone else's and adds them in (each
+# series labelled with its worker, so none of them ever goes backwards).
+# Query profiler settings and resets go through the master to every worker.
+PEER_PUSH_SECONDS = 5
+_peers = {}
+
+def _worker_label():
+    if not prefork.is_worker():
+        return None
+    return {"slot": prefork.worker_slot(), "pid": os.getpid(), "workers": APP_SETTINGS["workers"]}
+
+def _peer_push_loop():
+    while True:
+        prefork.send("peer", {"slot": prefork.worker_slot(), "families": metrics.families(_metrics_extra()), "requests": metrics.snapshot()})
+        time.sleep(PEER_PUSH_SECONDS)
+
+def _peer_store(msg, _reply):
+    msg["at"] = time.time()
+    _peers[str(msg["slot"])] = msg
+
+def _peer_list(msg, reply):
+    fresh = time.time() - PEER_PUSH_SECONDS * 3
+    reply("peers", {
+        "master": metrics.families(_metrics_extra()),
+        "workers": {
+            slot: {"families": p["families"], "requests": p["requests"]}
+            for slot, p in list(_peers.items())
+            if p["at"] > fresh and slot != str((msg or {}).get("slot"))
+        },
+    })
+
+def _peer_answer():
+    return prefork.ask("peers", {"slot": prefork.worker_slot()}) or {"master": None, "workers": {}}
+
+def _configure_sql_profile(msg, _reply=None):
+    APP_SETTINGS["sql_profile"] = bool(msg.get("enabled"))
+    APP_SETTINGS["sql_slow_ms"] = msg.get("slow_ms") or APP_SETTINGS["sql_slow_ms"]
+    sqlprofile.configure(APP_SETTINGS["sql_profile"], APP_SETTINGS["sql_slow_ms"])
+    prefork.broadcast("sqlprofile", msg)
+
+def _reset_stats(what, _reply=None):
+    if what == "requests":
+        metrics.reset()
+        for peer in list(_peers.values()):
+            peer["requests"] = {}
+    elif what == "queries":
+        sqlprofile.reset()
+    prefork.broadcast("reset", what)
+
+prefork.on("hello", _prefork_hello, role="master")
+prefork.on("job", lambda msg, _reply: scheduler.trigger(msg.get("name")), role="master")
+prefork.on("task", _run_task_remote, role="master")
+prefork.on("jobs", lambda jobs, _reply: scheduler.set_snapshot(jobs))
+prefork.on("peer", _peer_store, role="master")
+prefork.on("peers", _peer_list, role="master")
+prefork.on("sqlprofile", _configure_sql_profile, role="master")
+prefork.on("sqlprofile", _configure_sql_profile)
+prefork.on("reset", _reset_stats, role="master")
+prefork.on("reset", _reset_stats)
 
 if __name__ == "__main__":
+    if asyncmode.note():
+        logger.warning("%s", asyncmode.note())
     ensure_dirs()
     init_db()
-    start_thread = (os.environ.get("WERKZEUG_RUN_MAIN") == "true") or not app.debug
+    production = APP_SETTINGS["server_mode"] == "production"
+    workers = APP_SETTINGS["workers"]
+    start_thread = not workers and (production or (os.environ.get("WERKZEUG_RUN_MAIN") == "true") or not app.debug)
     if start_thread:
-        t = threading.Thread(target=maintenance_loop, daemon=True)
-        t.start()
-    socketio.run(app, host=APP_SETTINGS["host"], port=APP_SETTINGS["port"], debug=True, use_reloader=True, allow_unsafe_werkzeug=True)
+        hashing.start()
+        ratelimit.start_sweeper()
+        scheduler.start()
+        scheduler.trigger("password_migration")
+    if workers:
+        prefork.serve(
+            APP_SETTINGS["host"], APP_SETTINGS["port"], app, workers, APP_SETTINGS["server_threads"],
+            warmup=_prefork_warmup, master_start=_prefork_master_start,
+            worker_start=_prefork_worker_start, worker_stop=hashing.stop,
+        )
+    elif production and asyncmode.mode() == "gevent":
+        server = asyncmode.make_server(APP_SETTINGS["host"], APP_SETTINGS["port"], app)
+        logger.info("Serving on %s:%s (production, gevent)", APP_SETTINGS["host"], APP_SETTINGS["port"])
+        server.serve_forever()
+    elif production:
+        # no debugger, no reloader process; see wsgiserver
+        server = wsgiserver.make_server(APP_SETTINGS["host"], APP_SETTINGS["port"], app, threads=APP_SETTINGS["server_threads"])
+        logger.info("Serving on %s:%s (production, %s threads)", APP_SETTINGS["host"], APP_SETTINGS["port"], server.threads)
+        server.serve_forever()
+    else:
+        socketio.run(app, host=APP_SETTINGS["host"], port=APP_SETTINGS["port"], debug=True, use_reloader=True, allow_unsafe_werkzeug=True)
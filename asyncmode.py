@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+
+# ---- Socket.IO async mode ----------------------------------------------------
+# settings.json "socketio_async" (or OTP_SOCKETIO_ASYNC) picks how app.py
+# serves. "threading" is Flask-SocketIO's threading mode on Werkzeug (see
+# wsgiserver.py): every open websocket, console and live logs alike, keeps
+# an OS thread. "gevent" (pip install gevent) monkey-patches the stdlib
+# and serves from gevent's pywsgi server, so each request and websocket is
+# a greenlet on one OS thread and an idle socket costs a few KB instead of
+# a thread stack. That patching has to happen before anything imports
+# socket, threading or subprocess, so app.py calls setup() first, and this
+# module reads settings.json itself. Without gevent installed it falls
+# back to threading.
+# Under gevent one blocking C call stalls every greenlet, so long SQLite
+# work (VACUUM, integrity check, backup and restore) and the sampling
+# profiler go through blocking(), which runs them on gevent's pool of
+# real threads. Prefork workers (prefork.py) are not used in gevent mode:
+# a forked child would inherit every greenlet, the scheduler and the log
+# writer included.
+ASYNC_MODES = ("threading", "gevent")
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json")
+
+_state = {"mode": "threading", "note": None}
+
+def mode_from_settings(data):
+    mode = str(os.environ.get("OTP_SOCKETIO_ASYNC") or (data or {}).get("socketio_async") or "threading").strip().lower()
+    return mode if mode in ASYNC_MODES else "threading"
+
+def setup():
+    """Pick the mode and, for gevent, patch the stdlib. Call once, before
+    the rest of the app is imported. Returns the mode in effect."""
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f) or {}
+    except (OSError, ValueError):
+        data = {}
+    mode = mode_from_settings(data)
+    if mode == "gevent":
+        try:
+            from gevent import monkey
+        except ImportError:
+            _state["note"] = "socketio_async is gevent but gevent isn't installed; using threading"
+            mode = "threading"
+        else:
+            monkey.patch_all()
+    _state["mode"] = mode
+    return mode
+
+def mode():
+    return _state["mode"]
+
+def note():
+    """Why the configured mode wasn't used, or None; for app.py to log
+    once the logger exists."""
+    return _state["note"]
+
+def blocking(fn, *args, **kwargs):
+    """fn(*args, **kwargs), on a real OS thread under gevent."""
+    if _state["mode"] != "gevent":
+        return fn(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+def make_server(host, port, app):
+    """gevent's WSGI server for the production server mode. Websockets
+    are upgraded by simple-websocket inside Flask-SocketIO."""
+    from gevent import pywsgi
+
+    class Handler(pywsgi.WSGIHandler):
+        def run_application(self):
+            super().run_application()
+            # simple-websocket took the socket over; what is left unread
+            # after it closes is websocket frames, not a next request
+            if self.environ.get("HTTP_UPGRADE", "").lower() == "websocket":
+                self.close_connection = True
+
+    return pywsgi.WSGIServer((host, port), app, handler_class=Handler, log=sys.stderr, error_log=sys.stderr)
@@ -0,0 +1,176 @@
+import os
+import sqlite3
+import threading
+import metrics
+from database import DB_PATH, on_restore
+
+# ---- in-process caches -----------------------------------------------------
+# Authenticated-user context (permissions + settings) keyed by
+# (user_id, session_token), so load_user does no SQL for a known session,
+# and id -> name lookups for users and companies, so log lines don't open a
+# connection each. Routes that change a user or company call the matching
+# invalidate/forget function; writes from other processes (edit-database.py,
+# devtool, other workers) are caught by the generation check: PRAGMA
+# data_version on one connection held open for the purpose changes whenever
+# any other connection commits. (stat() of the files doesn't work here —
+# SQLite removes -wal whenever the last per-request connection closes.)
+USER_CONTEXT_MAX = 1024
+NAMES_MAX = 4096
+
+_lock = threading.Lock()
+_state = {"generation": None, "db": None, "pid": None}
+_user_cache = {}
+_names = {"users": {}, "user_ids": {}, "companies": {}}
+_user_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_name_stats = {"hits": 0, "misses": 0}
+
+def _sync():
+    # caller holds _lock; a forked worker must not share the parent's handle
+    try:
+        if _state["db"] is None or _state["pid"] != os.getpid():
+            _state["db"] = sqlite3.connect(f"file:{DB_PATH}?mode=rw", uri=True, check_same_thread=False)
+            _state["pid"] = os.getpid()
+        gen = (_state["pid"], _state["db"].execute("PRAGMA data_version").fetchone()[0])
+    except sqlite3.Error:
+        _state["db"] = None
+        gen = object()
+    if _state["generation"] != gen:
+        _user_cache.clear()
+        for table in _names.values():
+            table.clear()
+        _state["generation"] = gen
+    return gen
+
+def _put(table, key, value, limit):
+    if len(table) >= limit:
+        table.pop(next(iter(table)))
+    table[key] = value
+
+# ---- user context ----------------------------------------------------------
+
+def get_user_context(user_id, session_token):
+    with _lock:
+        _sync()
+        ctx = _user_cache.get((str(user_id), session_token))
+        _user_stats["hits" if ctx is not None else "misses"] += 1
+        return ctx
+
+def generation():
+    """Take before reading what goes to put_user_context."""
+    with _lock:
+        return _sync()
+
+def put_user_context(user_id, session_token, ctx, gen):
+    """Cache ctx unless something committed since generation() gave gen,
+    in which case it may already be stale."""
+    with _lock:
+        if _sync() != gen:
+            return
+        _put(_user_cache, (str(user_id), session_token), ctx, USER_CONTEXT_MAX)
+        _put(_names["users"], str(user_id), ctx["username"], NAMES_MAX)
+
+def invalidate_user(user_id, username=None):
+    """Drop everything cached about one user (context and name). Pass the
+    username for a new user, in case a lookup already cached it as unknown."""
+    with _lock:
+        if username is not None:
+            _names["user_ids"].pop(username, None)
+        for key in [k for k in _user_cache if k[0] == str(user_id)]:
+            del _user_cache[key]
+        name = _names["users"].pop(str(user_id), None)
+        if name is not None:
+            _names["user_ids"].pop(name, None)
+        for key in [k for k, v in _names["user_ids"].items() if str(v) == str(user_id)]:
+            del _names["user_ids"][key]
+        _user_stats["invalidations"] += 1
+
+def clear_users():
+    with _lock:
+        _user_cache.clear()
+        _names["users"].clear()
+        _names["user_ids"].clear()
+        _user_stats["invalidations"] += 1
+
+# ---- id -> name ------------------------------------------------------------
+
+def _lookup(table, key, sql):
+    with _lock:
+        gen = _sync()
+        if key in _names[table]:
+            _name_stats["hits"] += 1
+            return _names[table][key]
+        _name_stats["misses"] += 1
+    try:
+        with metrics.connect(DB_PATH) as db:
+            row = db.execute(sql, (key,)).fetchone()
+    except sqlite3.Error:
+        return None
+    value = row[0] if row else None
+    with _lock:
+        if _state["generation"] == gen:
+            _put(_names[table], key, value, NAMES_MAX)
+    return value
+
+def username(user_id):
+    if user_id is None:
+        return None
+    return _lookup("users", str(user_id), "SELECT username FROM users WHERE id = ?")
+
+def user_id_for(name):
+    if name is None:
+        return None
+    return _lookup("user_ids", name, "SELECT id FROM users WHERE username = ?")
+
+def company_name(company_id):
+    if company_id is None:
+        return None
+    return _lookup("companies", str(company_id), "SELECT name FROM companies WHERE company_id = ?")
+
+def forget_company(company_id):
+    with _lock:
+        _names["companies"].pop(str(company_id), None)
+
+class UserRef:
+    """'<username> with id <id>' for log lines, resolved only when the
+    record is actually formatted."""
+    __slots__ = ("user_id", "username")
+
+    def __init__(self, user_id=None, username=None):
+        self.user_id = user_id
+        self.username = username
+
+    def __str__(self):
+        uid, uname = self.user_id, self.username
+        if uid is not None and uname is None:
+            uname = username(uid)
+        if uname is not None and uid is None:
+            uid = user_id_for(uname)
+        return f"{uname if uname is not None else 'unknown'} with id {uid if uid is not None else 'unknown'}"
+
+    __repr__ = __str__
+
+class CompanyRef:
+    __slots__ = ("company_id",)
+
+    def __init__(self, company_id):
+        self.company_id = company_id
+
+    def __str__(self):
+        return company_name(self.company_id) or "Unknown Company"
+
+    __repr__ = __str__
+
+def stats():
+    with _lock:
+        return {
+            "user_context": dict(_user_stats, size=len(_user_cache)),
+            "names": dict(_name_stats, size=sum(len(t) for t in _names.values())),
+        }
+
+def clear_all():
+    with _lock:
+        _user_cache.clear()
+        for table in _names.values():
+            table.clear()
+
+on_restore(clear_all)
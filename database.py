@@ -1,11 +1,19 @@
 import os
 import sqlite3
-import shutil
 import re
 import time
 import json
+import socket
+import struct
+import threading
 from datetime import datetime
 from logger import logger
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 INSTANCE_DIR = os.path.join(BASE_DIR, "instance")
@@ -14,7 +22,16 @@ STATE_PATH = os.path.join(INSTANCE_DIR, "maintenance_state.json")
 DB_NAME = "otp.db"
 DB_PATH = os.path.join(INSTANCE_DIR, DB_NAME)
 LOCK_PATH = os.path.join(INSTANCE_DIR, "db_maint.lock")
-LOCK_STALE_SECONDS = 5400
+RESTORE_BUSY_TIMEOUT_MS = 30000
+LOCK_HEARTBEAT_SECONDS = 30
+LOCK_STALE_SECONDS = LOCK_HEARTBEAT_SECONDS * 3
+WAL_PATH = DB_PATH + "-wal"
+SHM_PATH = DB_PATH + "-shm"
+WAL_TRUNCATE_BYTES = 16 * 1024 * 1024
+WAL_IDLE_SECONDS = 30
+
+_lock_guard = threading.Lock()
+_lock = {"fd": None, "stop": None}
 
 
 def ensure_dirs():
@@ -24,7 +41,7 @@ def ensure_dirs():
         os.makedirs(BACKUP_DIR)
 
 def connect():
-    db = sqlite3.connect(DB_PATH)
+    db = metrics.connect(DB_PATH)
     db.execute("PRAGMA journal_mode=WAL")
     db.execute("PRAGMA foreign_keys=ON")
     db.execute("PRAGMA synchronous=NORMAL")
@@ -35,7 +52,19 @@ def backup_db():
         return None
     ts = datetime.now().strftime("%Y-%m-%d_%H%M%S")
     dest = os.path.join(BACKUP_DIR, f"otp_{ts}_{os.getpid()}.db")
-    shutil.copyfile(DB_PATH, dest)
+    n = 1
+    while os.path.exists(dest):
+        dest = os.path.join(BACKUP_DIR, f"otp_{ts}_{os.getpid()}_{n}.db")
+        n += 1
+    # backup API rather than a file copy, so frames still sitting in -wal
+    # make it into the backup
+    src = sqlite3.connect(DB_PATH)
+    dst = sqlite3.connect(dest)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
     backups = sorted(
         [os.path.join(BACKUP_DIR, f) for f in os.listdir(BACKUP_DIR) if f.startswith("otp_") and f.endswith(".db")],
         key=os.path.getmtime,
@@ -49,6 +78,61 @@ def backup_db():
             logger.critical("could not remove old backup %s: %s", old_backup, e)
     return dest
 
+_restore_hooks = []
+
+def on_restore(callback):
+    """Register a callback that drops in-process state derived from the
+    database (caches, open handles); it runs after every hot restore."""
+    _restore_hooks.append(callback)
+    return callback
+
+def run_restore_hooks():
+    """restore_backup runs these itself; a process that had the maintenance
+    worker do the restore calls it afterwards."""
+    for callback in list(_restore_hooks):
+        try:
+            callback()
+        except Exception as e:
+            logger.exception("restore hook %s failed: %s", getattr(callback, "__name__", callback), e)
+
+def restore_backup(src_path):
+    """Restore a backup into the live database without a server restart.
+
+    Pages are copied through the SQLite backup API into a connection on the
+    live file, so the copy goes through the WAL like any other write and
+    readers never see a half-replaced file or stale -wal frames. The whole
+    copy is one backup step, which holds the database write lock for its
+    duration — that is the write barrier; concurrent writers wait on their
+    busy timeout. The caller must hold the maintenance lock."""
+    t0 = time.perf_counter()
+    src = sqlite3.connect(":memory:")
+    try:
+        # staged in memory first: the safety backup below prunes old
+        # backups and may well remove the file being restored
+        disk = sqlite3.connect(f"file:{src_path}?mode=ro", uri=True)
+        try:
+            result = disk.execute("PRAGMA quick_check").fetchone()
+            if not result or result[0].lower() != "ok":
+                raise ValueError(f"backup failed quick_check: {(result or ['none'])[0]}")
+            disk.backup(src)
+        finally:
+            disk.close()
+        safety = backup_db()
+        dst = connect()
+        try:
+            dst.execute(f"PRAGMA busy_timeout = {RESTORE_BUSY_TIMEOUT_MS}")
+            src.backup(dst)
+            dst.execute("PRAGMA journal_mode=WAL")
+            dst.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    run_restore_hooks()
+    dt = round((time.perf_counter() - t0) * 1000)
+    logger.warning("database restored from %s duration_ms=%d", os.path.basename(src_path), dt)
+    return {"safety_backup": safety, "duration_ms": dt}
+
 def load_state():
     try:
         with open(STATE_PATH, "r") as f:
@@ -251,82 +335,232 @@ def pragma_checks():
             logger.info("foreign_key_check ok")
     return fk_issues
 
-def optimize_if_needed():
+def quick_check():
+    with connect() as db:
+        result = db.execute("PRAGMA quick_check").fetchone()
+    if not result or result[0].lower() != "ok":
+        logger.critical("quick_check failed: %s", (result or ["none"])[0])
+        return 1
+    logger.info("quick_check ok")
+    return 0
+
+def vacuum():
+    with connect() as db:
+        db.isolation_level = None
+        db.execute("VACUUM")
+        db.execute("PRAGMA optimize")
+    st = load_state()
+    st["last_vacuum"] = datetime.now().strftime("%Y-%m-%d")
+    save_state(st)
+    logger.info("vacuum and optimize completed")
+
+def optimize():
+    with connect() as db:
+        db.execute("PRAGMA optimize")
+    logger.info("optimize completed")
+
+def wal_status():
+    """Size of the WAL plus frame counts read straight from the wal-index
+    header in -shm (mxFrame at offset 16, nBackfill at 96, native byte
+    order), so looking at it never runs a checkpoint. Lag is the number of
+    frames not yet copied back into the database file."""
+    try:
+        size = os.path.getsize(WAL_PATH)
+    except OSError:
+        size = 0
+    out = {"size": size, "frames": None, "backfilled": None, "lag": None, "page_size": None,
+           "threshold": WAL_TRUNCATE_BYTES, "last_checkpoint": load_state().get("last_checkpoint")}
+    try:
+        with open(SHM_PATH, "rb") as f:
+            hdr = f.read(100)
+        if len(hdr) >= 100 and hdr[12]:
+            page_size, frames = struct.unpack_from("=HI", hdr, 14)
+            backfilled = struct.unpack_from("=I", hdr, 96)[0]
+            out["page_size"] = 65536 if page_size == 1 else page_size
+            out["frames"] = frames
+            out["backfilled"] = min(backfilled, frames)
+            out["lag"] = frames - out["backfilled"]
+    except OSError:
+        pass
+    return out
+
+def checkpoint(mode="PASSIVE"):
+    mode = mode.upper()
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"unknown checkpoint mode {mode}")
+    before = wal_status()["size"]
+    t0 = time.perf_counter()
+    with connect() as db:
+        if mode != "PASSIVE":
+            db.execute(f"PRAGMA busy_timeout = {RESTORE_BUSY_TIMEOUT_MS}")
+        busy, log, done = db.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    result = {
+        "mode": mode,
+        "at": time.time(),
+        "busy": bool(busy),
+        "frames": log,
+        "checkpointed": done,
+        "wal_before": before,
+        "wal_after": wal_status()["size"],
+        "duration_ms": round((time.perf_counter() - t0) * 1000),
+    }
     st = load_state()
-    today = datetime.now().strftime("%Y-%m-%d")
-    if st.get("last_vacuum") != today:
+    st["last_checkpoint"] = result
+    save_state(st)
+    logger.info("wal checkpoint %s busy=%d frames=%d checkpointed=%d wal_bytes=%d->%d",
+                mode, busy, log, done, before, result["wal_after"])
+    return result
+
+def checkpoint_if_needed(idle_for=None):
+    """Checkpoint policy: TRUNCATE once the WAL passes WAL_TRUNCATE_BYTES,
+    PASSIVE when the server has been idle for WAL_IDLE_SECONDS (or the idle
+    time is unknown, e.g. a manual run), otherwise leave it to SQLite's
+    autocheckpoint. Returns 1 if a TRUNCATE could not finish."""
+    st = wal_status()
+    if st["size"] >= WAL_TRUNCATE_BYTES:
+        result = checkpoint("TRUNCATE")
+        if result["busy"]:
+            logger.warning("wal checkpoint TRUNCATE blocked by readers, wal_bytes=%d", result["wal_after"])
+            return 1
+        return 0
+    if not st["size"] or st["lag"] == 0:
+        return 0
+    if idle_for is None or idle_for >= WAL_IDLE_SECONDS:
+        checkpoint("PASSIVE")
+    return 0
+
+# ---- maintenance lock ------------------------------------------------------
+# An fcntl.flock advisory lock on db_maint.lock. The kernel drops it the
+# moment the holding process dies, so a crashed or killed maintenance run
+# never blocks the next one. The file body records who holds it (pid, host,
+# heartbeat) purely for display; liveness comes from the flock itself.
+# Platforms without fcntl fall back to an O_EXCL lockfile that counts as
+# stale once its heartbeat stops being refreshed.
+def _write_lock_info(fd, acquired_at):
+    info = {
+        "pid": os.getpid(),
+        "host": socket.gethostname(),
+        "acquired_at": acquired_at,
+        "heartbeat": time.time(),
+    }
+    data = json.dumps(info).encode("utf-8")
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.ftruncate(fd, 0)
+    os.write(fd, data)
+
+def _lock_heartbeat(fd, acquired_at, stop):
+    while not stop.wait(LOCK_HEARTBEAT_SECONDS):
+        # under the guard, and only while this acquisition still holds the
+        # lock: once release_lock() closes fd its number can be reused by
+        # any other file (an otp.db connection) and must not be truncated
+        with _lock_guard:
+            if _lock["stop"] is not stop:
+                return
+            try:
+                _write_lock_info(fd, acquired_at)
+            except OSError:
+                return
+
+def acquire_lock():
+    """Try to take the maintenance lock without blocking. Also returns False
+    when another thread of this process already holds it."""
+    with _lock_guard:
+        if _lock["fd"] is not None:
+            return False
         try:
-            with connect() as db:
-                db.isolation_level = None
-                db.execute("VACUUM")
-                db.execute("PRAGMA optimize")
-            st["last_vacuum"] = today
-            save_state(st)
-            logger.info("vacuum and optimize completed")
-        except Exception as e:
-            logger.exception("vacuum/optimize failed: %s", e)
-    else:
+            if fcntl is not None:
+                fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    return False
+            else:
+                fd = _acquire_lockfile()
+                if fd is None:
+                    return False
+        except OSError:
+            return False
+        acquired_at = time.time()
         try:
-            with connect() as db:
-                db.execute("PRAGMA optimize")
-            logger.info("optimize completed")
-        except Exception as e:
-            logger.exception("optimize failed: %s", e)
+            _write_lock_info(fd, acquired_at)
+        except OSError:
+            pass
+        stop = threading.Event()
+        threading.Thread(target=_lock_heartbeat, args=(fd, acquired_at, stop), daemon=True).start()
+        _lock["fd"] = fd
+        _lock["stop"] = stop
+        return True
 
-def acquire_lock():
+def _acquire_lockfile():
     try:
-        fd = os.open(LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        with os.fdopen(fd, "w") as f:
-            f.write(str(os.getpid()))
-        return True
+        return os.open(LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
     except FileExistsError:
+        holder = read_lock_info()
+        beat = holder.get("heartbeat") or 0
+        if time.time() - beat < LOCK_STALE_SECONDS:
+            return None
+        logger.warning("removing stale maintenance lock held by pid=%s", holder.get("pid"))
+        try:
+            os.unlink(LOCK_PATH)
+            return os.open(LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
+        except OSError:
+            return None
+
+def release_lock():
+    with _lock_guard:
+        fd = _lock["fd"]
+        if fd is None:
+            return
+        _lock["stop"].set()
+        _lock["fd"] = None
+        _lock["stop"] = None
+        try:
+            os.ftruncate(fd, 0)
+        except OSError:
+            pass
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            except OSError:
+                pass
         try:
-            age = time.time() - os.path.getmtime(LOCK_PATH)
-        except FileNotFoundError:
-            return acquire_lock()
-        if age >= LOCK_STALE_SECONDS:
+            os.close(fd)
+        except OSError:
+            pass
+        if fcntl is None:
             try:
                 os.unlink(LOCK_PATH)
-                return acquire_lock()
-            except:
-                return False
-        return False
-    except:
-        return False
+            except OSError:
+                pass
 
-def release_lock():
+def read_lock_info():
     try:
-        if os.path.exists(LOCK_PATH):
-            os.unlink(LOCK_PATH)
-    except:
-        pass
+        with open(LOCK_PATH, "r", encoding="utf-8") as f:
+            return json.loads(f.read() or "{}")
+    except Exception:
+        return {}
 
-def _already_ran_this_hour():
-    st = load_state()
-    hour_key = datetime.now().strftime("%Y-%m-%d %H")
-    return st.get("last_maintenance_hour") == hour_key, hour_key, st
-
-def hourly_maintenance():
-    ran, hour_key, st = _already_ran_this_hour()
-    if ran:
-        logger.info("maintenance skipped, already ran this hour (%s)", hour_key)
-        return
-    logger.info("Starting scheduled database maintenance...")
-    t0 = time.perf_counter()
-    ensure_dirs()
-    init_db()
-    b = backup_db()
-    if b:
-        logger.info("database backup created at %s", b)
-    normalize_secrets()
-    name_issues = check_names()
-    orphan_issues = check_orphans()
-    fk_issues = pragma_checks()
-    optimize_if_needed()
-    st["last_maintenance_hour"] = hour_key
-    save_state(st)
-    dt = round((time.perf_counter() - t0) * 1000)
-    if any([name_issues, orphan_issues, fk_issues]):
-        logger.warning("maintenance finished with issues names=%d orphans=%d fk=%d duration_ms=%d", name_issues, orphan_issues, fk_issues, dt)
+def lock_holder():
+    """Return the current holder's info (pid, host, acquired_at, heartbeat)
+    or None when nobody holds the maintenance lock."""
+    if fcntl is None:
+        info = read_lock_info()
+        if not info or time.time() - (info.get("heartbeat") or 0) >= LOCK_STALE_SECONDS:
+            return None
+        return info
+    if _lock["fd"] is not None:
+        return read_lock_info()
+    try:
+        fd = os.open(LOCK_PATH, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except OSError:
+        return read_lock_info() or {"pid": None}
     else:
-        logger.info("maintenance finished ok duration_ms=%d", dt)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return None
+    finally:
+        os.close(fd)
@@ -1,12 +1,18 @@
 import os
 import sys
+import json
 import sqlite3
 import shutil
 from datetime import datetime
+import time
+from functools import wraps
 import pyotp
 from binascii import Error as BinasciiError
+from database import acquire_lock, release_lock, lock_holder, restore_backup
+from logger import set_json_logs
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SETTINGS_PATH = os.path.join(BASE_DIR, "settings.json")
 INSTANCE_PATH = os.path.join(BASE_DIR, "instance", "otp.db")
 BACKUP_PATH = os.path.join(BASE_DIR, "backup", f"otp_{datetime.now().strftime('%Y-%m-%d')}.db")
 
@@ -20,6 +26,18 @@ def yellow(s): return _c(s, "33")
 def gray(s):   return _c(s, "90")
 
 
+def _json_logs_enabled():
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            return bool((json.load(f) or {}).get("json_logs"))
+    except (OSError, ValueError):
+        return False
+
+# what is logged here (restores, lock waits) has to reach app.jsonl too,
+# or the Logs page doesn't show it when the server reads that file
+set_json_logs(_json_logs_enabled())
+
+
 def get_connection():
     print(dim(f"  Connecting to {INSTANCE_PATH}"))
     if not os.path.exists(INSTANCE_PATH):
@@ -27,6 +45,25 @@ def get_connection():
     return sqlite3.connect(INSTANCE_PATH)
 
 
+def _with_maintenance_lock(fn):
+    """Hold the server's maintenance lock while fn runs, so a CLI repair or
+    restore never overlaps a scheduled VACUUM or backup."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not acquire_lock():
+            holder = lock_holder() or {}
+            beat = holder.get("heartbeat")
+            age = f", heartbeat {int(time.time() - beat)}s ago" if beat else ""
+            print(f"\n  {yellow('!')} Database maintenance is running (pid {holder.get('pid', '?')}{age}).")
+            print(f"  {dim('Try again once it has finished.')}\n")
+            return None
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            release_lock()
+    return wrapper
+
+
 def _table_exists(cur, name):
     cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
     return cur.fetchone() is not None
@@ -170,6 +207,7 @@ def check_integrity():
     print(f"\n  {bold('Done.')}\n")
 
 
+@_with_maintenance_lock
 def repair_database():
     print(bold("\n  Repair Database\n"))
     conn = get_connection()
@@ -206,6 +244,7 @@ def repair_database():
     print(f"\n  {bold('Done.')}\n")
 
 
+@_with_maintenance_lock
 def upgrade_database():
     print(bold("\n  Upgrade Database Schema\n"))
     conn = get_connection()
@@ -529,6 +568,7 @@ def database_stats():
     print(f"\n  {bold('Done.')}\n")
 
 
+@_with_maintenance_lock
 def vacuum_database():
     print(bold("\n  Vacuum Database\n"))
     conn = get_connection()
@@ -564,6 +604,7 @@ def vacuum_database():
     print(f"\n  {bold('Done.')}\n")
 
 
+@_with_maintenance_lock
 def reset_sessions():
     print(bold("\n  Reset All Sessions\n"))
     conn = get_connection()
@@ -719,48 +760,26 @@ def get_backup_entries():
     return entries
 
 
+@_with_maintenance_lock
 def restore_backup_file(path):
     print(bold("\n  Restore Backup\n"))
 
     if not os.path.exists(path):
         raise FileNotFoundError(f"Backup file not found: {path}")
+    if not os.path.exists(INSTANCE_PATH):
+        raise FileNotFoundError(f"Database not found at {INSTANCE_PATH}")
 
     def fmt(b):
         return f"{b / 1024:.1f} KB" if b < 1024 * 1024 else f"{b / (1024 * 1024):.2f} MB"
 
-    # Auto-save a security backup of the current DB before overwriting
-    if os.path.exists(INSTANCE_PATH):
-        backup_dir = os.path.join(BASE_DIR, "backup")
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
-        safety_ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        safety_path = os.path.join(backup_dir, f"otp_security-backup_{safety_ts}.db")
-        print(dim("  Saving security backup of current database..."))
-        src_conn = sqlite3.connect(INSTANCE_PATH)
-        saf_conn = sqlite3.connect(safety_path)
-        try:
-            src_conn.backup(saf_conn)
-        finally:
-            saf_conn.close()
-            src_conn.close()
-        print(f"  {green('✓')} Security backup: {gray(os.path.basename(safety_path))}  {dim(fmt(os.path.getsize(safety_path)))}")
-
-    print(dim(f"  Restoring {os.path.basename(path)} → otp.db..."))
-    bak_conn = sqlite3.connect(path)
-    dst_conn = sqlite3.connect(INSTANCE_PATH)
-    try:
-        bak_conn.backup(dst_conn)
-    finally:
-        dst_conn.close()
-        bak_conn.close()
-
-    # Remove stale WAL/SHM files so SQLite doesn't replay the old session
-    for ext in ("-wal", "-shm"):
-        stale = INSTANCE_PATH + ext
-        if os.path.exists(stale):
-            os.remove(stale)
-            print(f"  {dim(f'Removed stale {os.path.basename(stale)}')}")
+    # Copies into the live database through the backup API, so a running
+    # server keeps serving and no stale WAL frames are left behind.
+    print(dim(f"  Restoring {os.path.basename(path)} → otp.db (live)..."))
+    result = restore_backup(path)
+    if result["safety_backup"]:
+        safety = result["safety_backup"]
+        print(f"  {green('✓')} Security backup: {gray(os.path.basename(safety))}  {dim(fmt(os.path.getsize(safety)))}")
 
     size = os.path.getsize(INSTANCE_PATH)
-    print(f"  {green('✓')} Database restored  {dim(fmt(size))}")
+    print(f"  {green('✓')} Database restored  {dim(fmt(size))}  {gray(str(result['duration_ms']) + ' ms')}")
     print(f"\n  {bold('Done.')}\n")
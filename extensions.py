@@ -1,4 +0,0 @@
-# extensions.py
-from flask_bcrypt import Bcrypt
-
-bcrypt = Bcrypt()
\ No newline at end of file
@@ -0,0 +1,186 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt as _bcrypt
+from logger import logger
+
+# ---- password hashing pool -------------------------------------------------
+# bcrypt is meant to be slow. Run inline, a burst of logins puts one hash per
+# request thread on the CPU at once and code polling stalls behind them.
+# Hashes go to a small process pool instead (fewer workers than cores, so
+# there is always CPU left for everything else), and once MAX_PENDING hashes
+# are queued new ones are refused with HashingBusy rather than piling up.
+# Workers are forked, and other threads are always running by then: the log
+# QueueListener (started when logger is imported), the prefork channel
+# threads in a prefork worker, and in the maintenance worker, where
+# hash_many creates the pool lazily, the lock heartbeat and log forwarding.
+# A lock one of them held at fork time stays held in the child, but the
+# children only ever run _hash_job/_check_job: bcrypt and a timer, no
+# logging and no maintenance lock, so they never wait on one.
+POOL_SIZE = max(1, (os.cpu_count() or 2) // 2)
+MAX_PENDING = POOL_SIZE * 8
+DEFAULT_ROUNDS = 12
+LATENCY_SAMPLES = 500
+
+_pool_lock = threading.Lock()
+_pool = {"executor": None}
+_stats_lock = threading.Lock()
+_stats = {
+    "pending": 0,
+    "completed": 0,
+    "rejected": 0,
+    "errors": 0,
+    "wait_ms": deque(maxlen=LATENCY_SAMPLES),
+    "hash_ms": deque(maxlen=LATENCY_SAMPLES),
+}
+_settings = {"rounds": DEFAULT_ROUNDS}
+
+class HashingBusy(Exception):
+    """Raised when MAX_PENDING hashes are already queued."""
+
+def _hash_job(password, rounds):
+    t0 = time.perf_counter()
+    hashed = _bcrypt.hashpw(password, _bcrypt.gensalt(rounds=rounds))
+    return hashed, (time.perf_counter() - t0) * 1000
+
+def _check_job(pw_hash, password):
+    t0 = time.perf_counter()
+    ok = _bcrypt.checkpw(password, pw_hash)
+    return ok, (time.perf_counter() - t0) * 1000
+
+def rounds_from_settings(data):
+    """bcrypt_rounds from a settings.json dict, clamped to what bcrypt accepts."""
+    try:
+        return max(4, min(31, int((data or {}).get("bcrypt_rounds") or DEFAULT_ROUNDS)))
+    except (TypeError, ValueError):
+        return DEFAULT_ROUNDS
+
+def set_rounds(rounds):
+    _settings["rounds"] = int(rounds)
+
+def get_rounds():
+    return _settings["rounds"]
+
+def hash_rounds(pw_hash):
+    """Cost factor of a $2a$/$2b$/$2y$ hash, None if it isn't one."""
+    parts = str(pw_hash or "").split("$")
+    if len(parts) < 4 or parts[1] not in ("2a", "2b", "2y"):
+        return None
+    try:
+        return int(parts[2])
+    except ValueError:
+        return None
+
+def needs_rehash(pw_hash):
+    """True for a bcrypt hash made with a cost other than the configured one."""
+    rounds = hash_rounds(pw_hash)
+    return rounds is not None and rounds != _settings["rounds"]
+
+def _executor():
+    with _pool_lock:
+        if _pool["executor"] is None:
+            ctx = multiprocessing.get_context("fork") if hasattr(os, "fork") else None
+            _pool["executor"] = ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=ctx)
+        return _pool["executor"]
+
+def set_pool_size(size):
+    """Before start(): prefork workers (prefork.py) split the pool between
+    them rather than each taking half the cores."""
+    global POOL_SIZE, MAX_PENDING
+    POOL_SIZE = max(1, int(size))
+    MAX_PENDING = POOL_SIZE * 8
+
+def start():
+    """Create the pool and fork every worker up front."""
+    pool = _executor()
+    for f in [pool.submit(os.getpid) for _ in range(POOL_SIZE)]:
+        f.result()
+    logger.info("password hashing pool started workers=%d max_pending=%d", POOL_SIZE, MAX_PENDING)
+
+def stop():
+    """Let the pool processes go (a prefork worker about to exit)."""
+    with _pool_lock:
+        executor = _pool["executor"]
+        _pool["executor"] = None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _run(fn, *args):
+    with _stats_lock:
+        if _stats["pending"] >= MAX_PENDING:
+            _stats["rejected"] += 1
+            raise HashingBusy(f"{MAX_PENDING} password hashes already queued")
+        _stats["pending"] += 1
+    t0 = time.perf_counter()
+    try:
+        try:
+            result, hash_ms = _executor().submit(fn, *args).result()
+        except BrokenProcessPool:
+            logger.critical("password hashing pool broke, recreating it")
+            with _pool_lock:
+                _pool["executor"] = None
+            result, hash_ms = _executor().submit(fn, *args).result()
+    except Exception:
+        with _stats_lock:
+            _stats["errors"] += 1
+        raise
+    finally:
+        with _stats_lock:
+            _stats["pending"] -= 1
+    total_ms = (time.perf_counter() - t0) * 1000
+    with _stats_lock:
+        _stats["completed"] += 1
+        _stats["hash_ms"].append(hash_ms)
+        _stats["wait_ms"].append(max(0.0, total_ms - hash_ms))
+    return result
+
+def _bytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+def generate_password_hash(password, rounds=None):
+    """bcrypt hash of password as str. Raises HashingBusy when saturated."""
+    if not password:
+        raise ValueError("Password must be non-empty.")
+    return _run(_hash_job, _bytes(password), rounds or _settings["rounds"]).decode("utf-8")
+
+def hash_many(passwords, rounds=None):
+    """Hash a batch spread across the whole pool, for bulk jobs rather than
+    requests: it skips the MAX_PENDING gate and the latency samples."""
+    rounds = rounds or _settings["rounds"]
+    items = [_bytes(p) for p in passwords]
+    results = _executor().map(_hash_job, items, [rounds] * len(items))
+    return [hashed.decode("utf-8") for hashed, _ in results]
+
+def check_password_hash(pw_hash, password):
+    """Same contract as Flask-Bcrypt's check_password_hash."""
+    return _run(_check_job, _bytes(pw_hash), _bytes(password))
+
+def _pct(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 1)
+
+def stats():
+    with _stats_lock:
+        hash_ms = list(_stats["hash_ms"])
+        wait_ms = list(_stats["wait_ms"])
+        return {
+            "workers": POOL_SIZE,
+            "rounds": _settings["rounds"],
+            "pending": _stats["pending"],
+            "max_pending": MAX_PENDING,
+            "completed": _stats["completed"],
+            "rejected": _stats["rejected"],
+            "errors": _stats["errors"],
+            "hash_ms_p50": _pct(hash_ms, 0.5),
+            "hash_ms_p95": _pct(hash_ms, 0.95),
+            "hash_ms_max": round(max(hash_ms), 1) if hash_ms else None,
+            "wait_ms_p50": _pct(wait_ms, 0.5),
+            "wait_ms_p95": _pct(wait_ms, 0.95),
+        }
@@ -1,9 +1,54 @@
+import atexit
+import gzip
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import shutil
+import threading
+import time
 from datetime import datetime, timedelta
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 BASE_LOG_DIR = "logs"
 
+# ---- logging pipeline -------------------------------------------------------
+# Callers only put records on a bounded queue (_QueueHandler). One listener
+# thread formats them and writes logs/<day>/app.log; it also notices the
+# day change, reopens the file and runs retention cleanup, so no request
+# thread ever does file I/O for logging. When the queue is full, DEBUG/INFO
+# records are dropped straight away and WARNING and up wait briefly first;
+# drops are counted and reported in the log once there is room again.
+QUEUE_MAX = 10000
+BLOCK_SECONDS = 0.5
+
+# Past days are gzipped in place by the log_cleanup job (app.log ->
+# app.log.gz, app.jsonl -> app.jsonl.gz; the .idx stays as it is, its offsets
+# are into the uncompressed stream) and logstore.py reads them by streaming
+# decompression. Retention is by age and optionally by total size of the
+# logs folder, oldest days going first; settings.json "log_retention_days"
+# and "log_retention_mb" (0 = no size cap).
+RETENTION_DAYS = 7
+RETENTION_MB = 0
+ARCHIVE_GRACE_SECONDS = 600
+ARCHIVED_FILES = ("app.log", "app.jsonl")
+
+# Optionally (settings.json "json_logs") the same records also go to
+# logs/<day>/app.jsonl, one JSON object per line, with a sidecar
+# app.jsonl.idx: one line per JSON_BLOCK_BYTES block of the .jsonl giving its
+# byte range, first/last time and per-level/per-module counts. Readers
+# (logstore.py) skip whole blocks that can't match a level/module/time filter
+# and only ever hold one block in memory.
+JSON_BLOCK_BYTES = 256 * 1024
+
+_stats_lock = threading.Lock()
+_stats = {"dropped": 0, "dropped_reported": 0, "written": 0, "max_depth": 0}
+
 def _date_str():
     return datetime.now().strftime("%Y-%m-%d")
 
@@ -13,55 +58,446 @@ def _day_dir(day):
 def _log_path(day):
     return os.path.join(_day_dir(day), "app.log")
 
+def json_log_path(day):
+    return os.path.join(_day_dir(day), "app.jsonl")
+
+def json_index_path(day):
+    return json_log_path(day) + ".idx"
+
+def read_json_block(path, start, end):
+    """Parsed records in bytes [start, end) of a .jsonl file. A trailing
+    line without its newline yet (still being written) is left out."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(max(0, end - start))
+    records = []
+    for line in data.split(b"\n")[:-1]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+def block_summary(records, start, end):
+    levels, modules = {}, {}
+    for r in records:
+        levels[r.get("level")] = levels.get(r.get("level"), 0) + 1
+        modules[r.get("module")] = modules.get(r.get("module"), 0) + 1
+    return {
+        "start": start,
+        "end": end,
+        "t0": records[0].get("time") if records else None,
+        "t1": records[-1].get("time") if records else None,
+        "levels": levels,
+        "modules": modules,
+    }
+
+def _record_doc(record):
+    """A record as the dict stored in app.jsonl. Only valid after the text
+    handler ran, which fills in record.message and record.exc_text."""
+    doc = {
+        "ts": round(record.created, 3),
+        "time": time.strftime("%H:%M:%S", time.localtime(record.created)),
+        "level": record.levelname,
+        "module": record.module,
+        "msg": record.message if hasattr(record, "message") else record.getMessage(),
+    }
+    if record.exc_text:
+        doc["exc"] = record.exc_text
+    return doc
+
 def _ensure_dir(p):
     os.makedirs(p, exist_ok=True)
 
-def _cleanup(max_days=7):
+_retention = {"days": RETENTION_DAYS, "mb": RETENTION_MB}
+
+def retention_from_settings(data):
+    """(days, megabytes) from a settings.json dict."""
+    data = data or {}
+    try:
+        days = max(1, int(data.get("log_retention_days") or RETENTION_DAYS))
+    except (TypeError, ValueError):
+        days = RETENTION_DAYS
+    try:
+        mb = max(0, int(data.get("log_retention_mb") or RETENTION_MB))
+    except (TypeError, ValueError):
+        mb = RETENTION_MB
+    return days, mb
+
+def set_retention(days, mb):
+    _retention["days"] = days
+    _retention["mb"] = mb
+
+def _day_dirs():
     if not os.path.isdir(BASE_LOG_DIR):
-        return
-    now = datetime.now()
+        return []
+    days = []
     for name in os.listdir(BASE_LOG_DIR):
         p = os.path.join(BASE_LOG_DIR, name)
         if not os.path.isdir(p):
             continue
         try:
-            d = datetime.strptime(name, "%Y-%m-%d")
+            datetime.strptime(name, "%Y-%m-%d")
         except ValueError:
             continue
-        if now - d > timedelta(days=max_days):
-            import shutil
+        days.append(name)
+    return sorted(days)
+
+def _dir_size(p):
+    total = 0
+    for root, _, files in os.walk(p):
+        for name in files:
             try:
-                shutil.rmtree(p)
-            except:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
                 pass
+    return total
 
-class _DailyRotateFilter(logging.Filter):
-    def filter(self, record):
-        day = _date_str()
-        if getattr(logger, "_current_day", None) != day:
-            _switch_handler(day)
-            _cleanup()
-        return True
-
-def _switch_handler(day):
-    _ensure_dir(_day_dir(day))
-    fh = logging.FileHandler(_log_path(day), encoding="utf-8")
-    fh.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] [%(module)s]: %(message)s", datefmt="%H:%M:%S"))
-    for h in list(logger.handlers):
+def _cleanup(max_days=None, max_mb=None):
+    """Remove day folders older than max_days, then the oldest past days
+    until the logs folder fits in max_mb. Returns how many were removed."""
+    max_days = _retention["days"] if max_days is None else max_days
+    max_mb = _retention["mb"] if max_mb is None else max_mb
+    now = datetime.now()
+    today = _date_str()
+    removed = 0
+    kept = []
+    for name in _day_dirs():
+        p = os.path.join(BASE_LOG_DIR, name)
+        if now - datetime.strptime(name, "%Y-%m-%d") > timedelta(days=max_days):
+            shutil.rmtree(p, ignore_errors=True)
+            removed += 1
+        else:
+            kept.append(name)
+    if max_mb:
+        sizes = [(name, _dir_size(os.path.join(BASE_LOG_DIR, name))) for name in kept]
+        total = sum(size for _, size in sizes)
+        for name, size in sizes:
+            if total <= max_mb * 1024 * 1024 or name >= today:
+                break
+            shutil.rmtree(os.path.join(BASE_LOG_DIR, name), ignore_errors=True)
+            total -= size
+            removed += 1
+    return removed
+
+def archive_old_days(grace=ARCHIVE_GRACE_SECONDS):
+    """gzip app.log/app.jsonl of every day before today that nothing has
+    written to for `grace` seconds. Returns the number of files compressed."""
+    today = _date_str()
+    done = 0
+    for name in _day_dirs():
+        if name >= today:
+            continue
+        for fname in ARCHIVED_FILES:
+            src = os.path.join(BASE_LOG_DIR, name, fname)
+            try:
+                if time.time() - os.path.getmtime(src) < grace:
+                    continue
+            except OSError:
+                continue
+            dst = src + ".gz"
+            tmp = dst + ".tmp"
+            with open(src, "rb") as fi, gzip.open(tmp, "wb", compresslevel=6) as fo:
+                shutil.copyfileobj(fi, fo, 1024 * 1024)
+            if os.path.exists(dst):
+                # written to again after it was archived; a second gzip
+                # member reads back as one stream
+                with open(tmp, "rb") as fi, open(dst, "ab") as fo:
+                    shutil.copyfileobj(fi, fo, 1024 * 1024)
+                os.remove(tmp)
+            else:
+                os.replace(tmp, dst)
+            os.remove(src)
+            done += 1
+    return done
+
+class _DailyFileHandler(logging.Handler):
+    """Writes to logs/<day>/app.log. Only ever called from the listener
+    thread, so rollover and cleanup happen there."""
+
+    def __init__(self):
+        super().__init__()
+        self.stream = None
+        self.day = None
+        self.rollover_at = 0.0
+
+    def _open(self, day):
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except OSError:
+                pass
+        _ensure_dir(_day_dir(day))
+        self.stream = open(_log_path(day), "a", encoding="utf-8")
+        self.day = day
+        midnight = datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)
+        self.rollover_at = midnight.timestamp()
+
+    def emit(self, record):
         try:
-            h.flush()
-            h.close()
-        except:
+            if record.created >= self.rollover_at or self.stream is None:
+                first = self.stream is None
+                self._open(datetime.fromtimestamp(record.created).strftime("%Y-%m-%d"))
+                if not first:
+                    _cleanup()
+            self.stream.write(self.format(record) + "\n")
+            with _stats_lock:
+                _stats["written"] += 1
+                dropped = _stats["dropped"] - _stats["dropped_reported"]
+                _stats["dropped_reported"] = _stats["dropped"]
+            if dropped:
+                self.stream.write(f"{time.strftime('%H:%M:%S')} [WARNING] [logger]: log queue full, dropped {dropped} record(s)\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except OSError:
+                pass
+            self.stream = None
+        super().close()
+
+class _JsonFileHandler(logging.Handler):
+    """Writes logs/<day>/app.jsonl and its block index when enabled. Runs
+    after _DailyFileHandler on the listener thread, so record.message and
+    record.exc_text are already filled in. The server isn't the only
+    writer (edit-database.py writes from start.py's process), so appends
+    and index lines are made under an flock on the .jsonl, and each block
+    is summarised from what the file holds rather than from this process's
+    own records."""
+
+    def __init__(self):
+        super().__init__()
+        self.enabled = False
+        self.stream = None
+        self.day = None
+        self.rollover_at = 0.0
+        self.indexed = 0
+
+    def _read_indexed(self):
+        indexed = 0
+        try:
+            with open(json_index_path(self.day), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        indexed = max(indexed, json.loads(line)["end"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
             pass
-        logger.removeHandler(h)
-    logger.addHandler(fh)
-    logger._current_day = day
+        return indexed
+
+    def _flock(self, held):
+        if fcntl is not None:
+            fcntl.flock(self.stream.fileno(), fcntl.LOCK_EX if held else fcntl.LOCK_UN)
+
+    def _close_block(self, pos, min_bytes=1):
+        """Index [indexed, pos) once it is at least min_bytes; called with
+        the flock held. Another writer may have indexed part of it already."""
+        self.indexed = max(self.indexed, self._read_indexed())
+        if pos - self.indexed < min_bytes:
+            return
+        path = json_log_path(self.day)
+        b = block_summary(read_json_block(path, self.indexed, pos), self.indexed, pos)
+        with open(json_index_path(self.day), "a", encoding="utf-8") as f:
+            f.write(json.dumps(b, separators=(",", ":")) + "\n")
+        self.indexed = pos
+
+    def _open(self, day):
+        self._close_stream()
+        _ensure_dir(_day_dir(day))
+        self.stream = open(json_log_path(day), "ab")
+        self.day = day
+        self.rollover_at = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).timestamp()
+        # anything after the index (a crash before the block was closed)
+        # goes into the next block
+        self.indexed = self._read_indexed()
+
+    def _close_stream(self):
+        if self.stream is None:
+            return
+        try:
+            self._flock(True)
+            try:
+                self._close_block(os.fstat(self.stream.fileno()).st_size)
+            finally:
+                self._flock(False)
+            self.stream.close()
+        except OSError:
+            pass
+        self.stream = None
+
+    def emit(self, record):
+        if not self.enabled:
+            return
+        try:
+            if record.created >= self.rollover_at or self.stream is None:
+                self._open(datetime.fromtimestamp(record.created).strftime("%Y-%m-%d"))
+            doc = _record_doc(record)
+            line = (json.dumps(doc, ensure_ascii=False) + "\n").encode("utf-8")
+            self._flock(True)
+            try:
+                self.stream.write(line)
+                self.stream.flush()
+                pos = os.fstat(self.stream.fileno()).st_size
+                if pos - self.indexed >= JSON_BLOCK_BYTES:
+                    self._close_block(pos, JSON_BLOCK_BYTES)
+            finally:
+                self._flock(False)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self._close_stream()
+        super().close()
+
+class _TapHandler(logging.Handler):
+    """Hands each written record (as a _record_doc dict plus its "day") to
+    the callbacks registered with add_tap, e.g. the live log stream. Runs
+    last on the listener thread; callbacks must not block or log."""
+
+    def __init__(self):
+        super().__init__()
+        self.taps = []
+
+    def emit(self, record):
+        if not self.taps:
+            return
+        doc = _record_doc(record)
+        doc["day"] = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d")
+        self.deliver(doc)
+
+    def deliver(self, doc):
+        for tap in list(self.taps):
+            try:
+                tap(doc)
+            except Exception:
+                pass
+
+class _ForwardHandler(logging.Handler):
+    """In a prefork worker: hands each record, formatted, as a _record_doc
+    dict to a callback that sends it to the master (see forward_to)."""
+
+    def __init__(self, send):
+        super().__init__()
+        self.send = send
+
+    def emit(self, record):
+        try:
+            self.format(record)
+            self.send(_record_doc(record))
+        except Exception:
+            self.handleError(record)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # formatting (and the lazy name lookups in the args) is left to the
+        # listener thread; the stdlib version would do it here
+        return record
+
+    def enqueue(self, record):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=BLOCK_SECONDS)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with _stats_lock:
+                _stats["dropped"] += 1
+            return
+        depth = self.queue.qsize()
+        with _stats_lock:
+            if depth > _stats["max_depth"]:
+                _stats["max_depth"] = depth
+
+_queue = queue.Queue(maxsize=QUEUE_MAX)
+_queue_handler = _QueueHandler(_queue)
+_file_handler = _DailyFileHandler()
+_file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] [%(module)s]: %(message)s", datefmt="%H:%M:%S"))
+_json_handler = _JsonFileHandler()
+_tap_handler = _TapHandler()
+_listener = logging.handlers.QueueListener(_queue, _file_handler, _json_handler, _tap_handler)
+
+def set_json_logs(enabled):
+    """Turn the app.jsonl output on or off (settings.json "json_logs")."""
+    _json_handler.enabled = bool(enabled)
+
+def add_tap(callback):
+    """Call callback(doc) for every record once it has been written."""
+    _tap_handler.taps.append(callback)
+
+# Under prefork (prefork.py) only the master writes the files. A worker
+# calls forward_to() right after the fork: it gets a fresh queue, lock and
+# listener thread (the parent's thread doesn't exist in the child and its
+# locks may have been held mid-fork), and the listener sends each record to
+# the master, which ingest()s it into its own queue as if logged there. The
+# master's taps see every worker's records; it broadcasts them and each
+# worker hands them to its own taps with deliver_tap().
+def forward_to(send):
+    global _queue, _stats_lock, _listener
+    _stats_lock = threading.Lock()
+    _stats.update(dropped=0, dropped_reported=0, written=0, max_depth=0)
+    _queue = queue.Queue(maxsize=QUEUE_MAX)
+    _queue_handler.queue = _queue
+    _listener = logging.handlers.QueueListener(_queue, _ForwardHandler(send))
+    _listener.start()
+
+def stop_forwarding():
+    """Send what is still queued (a worker about to exit)."""
+    try:
+        _listener.stop()
+    except Exception:
+        pass
+
+def ingest(doc):
+    """Master side of forward_to: queue a record a worker sent."""
+    levelno = logging.getLevelName(doc.get("level"))
+    if not isinstance(levelno, int):
+        levelno = logging.INFO
+    record = logging.makeLogRecord({
+        "name": logger.name,
+        "msg": doc.get("msg", ""),
+        "levelname": logging.getLevelName(levelno),
+        "levelno": levelno,
+        "module": doc.get("module", ""),
+        "created": doc.get("ts") or time.time(),
+        "exc_text": doc.get("exc"),
+    })
+    _queue_handler.enqueue(record)
+
+def deliver_tap(doc):
+    _tap_handler.deliver(doc)
+
+def stats():
+    with _stats_lock:
+        return {
+            "queue_depth": _queue.qsize(),
+            "queue_max": QUEUE_MAX,
+            "max_depth": _stats["max_depth"],
+            "written": _stats["written"],
+            "dropped": _stats["dropped"],
+            "current_file": _log_path(_file_handler.day) if _file_handler.day else None,
+            "json_logs": _json_handler.enabled,
+        }
+
+def _stop():
+    # drain what's queued before the interpreter goes away
+    try:
+        _listener.stop()
+    except Exception:
+        pass
+    _file_handler.close()
+    _json_handler.close()
 
 logger = logging.getLogger("OTPLogger")
 logger.setLevel(logging.DEBUG)
 
 if not getattr(logger, "_initialized", False):
     _ensure_dir(BASE_LOG_DIR)
-    _switch_handler(_date_str())
-    logger.addFilter(_DailyRotateFilter())
-    logger._initialized = True
\ No newline at end of file
+    logger.addHandler(_queue_handler)
+    _listener.start()
+    atexit.register(_stop)
+    logger._initialized = True
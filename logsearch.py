@@ -0,0 +1,351 @@
+import gzip
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from logger import BASE_LOG_DIR
+from logstore import LEVEL_ALIASES, LINE_RE, day_file, list_days, parse_lines, valid_day
+
+# ---- cross-day log search --------------------------------------------------
+# Searches every retained day (plain or gzipped, text or JSON-lines) for
+# /api/logs/search. Each day is streamed forwards one record at a time, so
+# memory is one page of results whatever the range. Records are addressed by
+# (day, ordinal), the record's position in that day's file, which stays put
+# while the day is appended to or compressed; the opaque cursor is
+# "<day>:<ordinal>".
+#
+# Optionally (settings.json "log_search_index") the log_cleanup job writes
+# logs/<day>/search.idx.json for past days: the day cut into chunks of
+# CHUNK_RECORDS records with each chunk's byte range, record count,
+# levels, modules and time span, plus every word of three or more
+# characters mapped to the chunks it occurs in. A search then skips chunks
+# that can't match its level, module, time or text filter without reading
+# them, and a day with no candidate chunk isn't opened at all.
+PAGE_DEFAULT = 200
+PAGE_MAX = 1000
+SCAN_BUDGET = 2_000_000
+CHUNK_RECORDS = 1000
+INDEX_NAME = "search.idx.json"
+MIN_TOKEN = 3
+TOKEN_RE = re.compile(r"\w+")
+BOUND_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})(?:[T ](\d{2}:\d{2})(:\d{2})?)?$")
+CACHED_INDEXES = 8
+MEMO_TOKENS = 64
+
+_index_lock = threading.Lock()
+_index_cache = OrderedDict()
+
+class SearchError(ValueError):
+    """A search parameter that can't be used (bad regex, bad bound, bad cursor)."""
+
+def _bound(value, upper):
+    """'YYYY-MM-DD[THH:MM[:SS]]' -> 'YYYY-MM-DD HH:MM:SS', or None."""
+    if not value:
+        return None
+    m = BOUND_RE.match(value.strip())
+    if not m:
+        raise SearchError(f"bad time bound {value!r}")
+    day, hm, sec = m.groups()
+    if hm is None:
+        return day + (" 23:59:59" if upper else " 00:00:00")
+    return f"{day} {hm}{sec or (':59' if upper else ':00')}"
+
+def make_query(levels=(), modules=(), time_from=None, time_to=None, text=None, regex=False):
+    text = (text or "").strip()
+    pattern = None
+    if text and regex:
+        try:
+            pattern = re.compile(text, re.IGNORECASE)
+        except re.error as e:
+            raise SearchError(f"bad regex: {e}")
+    return {
+        "levels": {LEVEL_ALIASES.get(v.upper(), v.upper()) for v in levels if v} or None,
+        "modules": {m for m in modules if m} or None,
+        "from": _bound(time_from, False),
+        "to": _bound(time_to, True),
+        "text": text.lower() if text and not regex else None,
+        "regex": pattern,
+        "tokens": [t for t in TOKEN_RE.findall(text.lower()) if len(t) >= MIN_TOKEN] if text and not regex else [],
+    }
+
+def _haystack(r):
+    return " ".join((r.get("time") or "", r.get("level") or "", r.get("module") or "", r.get("msg") or "", r.get("exc") or ""))
+
+def _matches(day, r, q):
+    if q["levels"] and r.get("level") not in q["levels"]:
+        return False
+    if q["modules"] and r.get("module") not in q["modules"]:
+        return False
+    stamp = f"{day} {r.get('time') or '00:00:00'}"
+    if q["from"] and stamp < q["from"]:
+        return False
+    if q["to"] and stamp > q["to"]:
+        return False
+    if q["text"] and q["text"] not in _haystack(r).lower():
+        return False
+    if q["regex"] and not q["regex"].search(_haystack(r)):
+        return False
+    return True
+
+# ---- reading a day ---------------------------------------------------------
+
+def _records(f, is_json, start=0, end=None):
+    """(offset, record) from an open binary file, from byte `start` (a record
+    boundary) until `end`; offsets are into the uncompressed stream."""
+    f.seek(start)
+    pos = start
+    if is_json:
+        for line in f:
+            if end is not None and pos >= end:
+                return
+            offset, pos = pos, pos + len(line)
+            try:
+                yield offset, json.loads(line)
+            except ValueError:
+                continue
+        return
+    # text: a record is a header line plus any traceback lines under it
+    pending, pending_at = [], pos
+    for line in f:
+        if end is not None and pos >= end:
+            break
+        offset, pos = pos, pos + len(line)
+        text = line.decode("utf-8", errors="replace")
+        if pending and LINE_RE.match(text):
+            for r in parse_lines(pending):
+                yield pending_at, r
+            pending = []
+        if not pending:
+            pending_at = offset
+        pending.append(text)
+    for r in parse_lines(pending):
+        yield pending_at, r
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+def _source_stem(path):
+    name = os.path.basename(path)
+    return name[:-3] if name.endswith(".gz") else name
+
+# ---- token index -----------------------------------------------------------
+
+def index_path(day):
+    return os.path.join(BASE_LOG_DIR, day, INDEX_NAME)
+
+def build_index(day):
+    """Write search.idx.json for a day. Returns the number of chunks."""
+    path = day_file(day)
+    if path is None:
+        return 0
+    chunks, vocab = [], {}
+    chunk = None
+    with _open(path) as f:
+        for offset, r in _records(f, _source_stem(path) == "app.jsonl"):
+            if chunk is None or chunk["records"] >= CHUNK_RECORDS:
+                if chunk is not None:
+                    chunk["end"] = offset
+                    chunks.append(chunk)
+                chunk = {"start": offset, "end": None, "records": 0, "t0": r.get("time"), "t1": None,
+                         "levels": set(), "modules": set()}
+            n = len(chunks)
+            chunk["records"] += 1
+            chunk["t1"] = r.get("time") or chunk["t1"]
+            chunk["t0"] = chunk["t0"] or r.get("time")
+            chunk["levels"].add(r.get("level"))
+            chunk["modules"].add(r.get("module"))
+            for tok in set(TOKEN_RE.findall(_haystack(r).lower())):
+                if len(tok) >= MIN_TOKEN:
+                    ids = vocab.setdefault(tok, [])
+                    if not ids or ids[-1] != n:
+                        ids.append(n)
+        if chunk is not None:
+            chunk["end"] = f.tell()
+            chunks.append(chunk)
+    for c in chunks:
+        c["levels"] = sorted(lv for lv in c["levels"] if lv)
+        c["modules"] = sorted(m for m in c["modules"] if m)
+    doc = {
+        "source": _source_stem(path),
+        "size": None if path.endswith(".gz") else os.path.getsize(path),
+        "chunk_records": CHUNK_RECORDS,
+        "chunks": chunks,
+        "tokens": vocab,
+    }
+    tmp = index_path(day) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(doc, f, separators=(",", ":"))
+    os.replace(tmp, index_path(day))
+    return len(chunks)
+
+def _load_index(day, path):
+    """The day's index if it still describes `path`, else None."""
+    ipath = index_path(day)
+    try:
+        mtime = os.path.getmtime(ipath)
+    except OSError:
+        return None
+    with _index_lock:
+        cached = _index_cache.get(ipath)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(ipath, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with _index_lock:
+            _index_cache[ipath] = (mtime, doc)
+            _index_cache.move_to_end(ipath)
+            while len(_index_cache) > CACHED_INDEXES:
+                _index_cache.popitem(last=False)
+    else:
+        doc = cached[1]
+    # the decompressed stream is the same bytes, so an index built before
+    # the day was gzipped still holds; a plain file must not have grown
+    if doc.get("source") != _source_stem(path):
+        return None
+    if not path.endswith(".gz") and doc.get("size") != os.path.getsize(path):
+        return None
+    return doc
+
+def index_missing(day):
+    path = day_file(day)
+    return path is not None and _load_index(day, path) is None
+
+def _candidate_chunks(doc, q):
+    if not q["tokens"]:
+        return None
+    vocab = doc["tokens"]
+    memo = doc.setdefault("_memo", OrderedDict())
+    result = None
+    for qt in q["tokens"]:
+        # substring semantics: any word containing the query word counts
+        with _index_lock:
+            hits = memo.get(qt)
+        if hits is None:
+            hits = set()
+            for tok, ids in vocab.items():
+                if qt in tok:
+                    hits.update(ids)
+            with _index_lock:
+                memo[qt] = hits
+                while len(memo) > MEMO_TOKENS:
+                    memo.popitem(last=False)
+        result = hits if result is None else result & hits
+        if not result:
+            return set()
+    return result
+
+def _chunk_may_match(day, c, q):
+    if q["levels"] and not q["levels"] & set(c["levels"]):
+        return False
+    if q["modules"] and not q["modules"] & set(c["modules"]):
+        return False
+    if q["from"] and c["t1"] and f"{day} {c['t1']}" < q["from"]:
+        return False
+    if q["to"] and c["t0"] and f"{day} {c['t0']}" > q["to"]:
+        return False
+    return True
+
+def _day_stream(day, q, stats):
+    """(ordinal, record) for every record of the day that may match, in file
+    order; records in chunks the index rules out are skipped but counted."""
+    path = day_file(day)
+    if path is None:
+        return
+    is_json = _source_stem(path) == "app.jsonl"
+    doc = _load_index(day, path)
+    with _open(path) as f:
+        if doc is None:
+            for ordinal, (_, r) in enumerate(_records(f, is_json)):
+                stats["scanned"] += 1
+                yield ordinal, r
+            return
+        stats["indexed_days"] += 1
+        candidates = _candidate_chunks(doc, q)
+        ordinal = 0
+        chunks = doc["chunks"]
+        for i, c in enumerate(chunks):
+            if (candidates is not None and i not in candidates) or not _chunk_may_match(day, c, q):
+                ordinal += c["records"]
+                continue
+            n = 0
+            for _, r in _records(f, is_json, c["start"], c["end"]):
+                stats["scanned"] += 1
+                yield ordinal + n, r
+                n += 1
+            ordinal += c["records"]
+        # anything written after the index was built
+        if chunks:
+            for _, r in _records(f, is_json, chunks[-1]["end"]):
+                stats["scanned"] += 1
+                yield ordinal, r
+                ordinal += 1
+
+# ---- search ----------------------------------------------------------------
+
+def _parse_cursor(cursor):
+    if not cursor:
+        return None, None
+    day, _, ordinal = cursor.partition(":")
+    if not valid_day(day) or not ordinal.isdigit():
+        raise SearchError("bad cursor")
+    return day, int(ordinal)
+
+def search(q, limit=PAGE_DEFAULT, cursor=None, newest_first=True):
+    """One page of matches across all retained days. Returns the results
+    (each with its "day"), the cursor for the next page (None at the end)
+    and how much was read."""
+    limit = max(1, min(PAGE_MAX, int(limit or PAGE_DEFAULT)))
+    cur_day, cur_ordinal = _parse_cursor(cursor)
+    days = sorted(list_days(), reverse=newest_first)
+    lo = q["from"][:10] if q["from"] else None
+    hi = q["to"][:10] if q["to"] else None
+    days = [d for d in days if (lo is None or d >= lo) and (hi is None or d <= hi)]
+    if cur_day is not None:
+        days = [d for d in days if (d <= cur_day if newest_first else d >= cur_day)]
+
+    stats = {"scanned": 0, "indexed_days": 0, "days": 0}
+    results, next_cursor = [], None
+    for day in days:
+        need = limit - len(results)
+        resume = cur_ordinal if day == cur_day else None
+        stats["days"] += 1
+        if newest_first:
+            # the last `need` matches before the resume point, newest first
+            found = deque(maxlen=need)
+            for ordinal, r in _day_stream(day, q, stats):
+                if resume is not None and ordinal >= resume:
+                    break
+                if _matches(day, r, q):
+                    found.append((ordinal, r))
+            page = list(reversed(found))
+        else:
+            page = []
+            for ordinal, r in _day_stream(day, q, stats):
+                if resume is not None and ordinal < resume:
+                    continue
+                if _matches(day, r, q):
+                    page.append((ordinal, r))
+                    if len(page) >= need:
+                        break
+        results.extend(dict(r, day=day) for _, r in page)
+        if len(results) >= limit:
+            last = page[-1][0]
+            next_cursor = f"{day}:{last if newest_first else last + 1}"
+            break
+        if stats["scanned"] >= SCAN_BUDGET:
+            # stop here and let the caller continue from the next day
+            i = days.index(day)
+            if i + 1 < len(days):
+                nxt = days[i + 1]
+                next_cursor = f"{nxt}:{10 ** 12 if newest_first else 0}"
+            break
+    return {
+        "results": results,
+        "next_cursor": next_cursor,
+        "days_searched": stats["days"],
+        "indexed_days": stats["indexed_days"],
+        "records_scanned": stats["scanned"],
+    }
@@ -0,0 +1,378 @@
+import gzip
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from logger import BASE_LOG_DIR, json_log_path, json_index_path, read_json_block, block_summary
+
+# ---- reading the logs ------------------------------------------------------
+# Filtered reads of one day's log for /api/logs. With the JSON-lines output
+# (settings.json "json_logs") blocks of app.jsonl are skipped using the
+# app.jsonl.idx sidecar written by logger.py and read newest first until
+# enough matches are found; otherwise app.log is read backwards from its end
+# and parsed into the same record shape. Either way only one block (or the
+# last `limit` matches) is held in memory. Every result carries the byte
+# offset it read up to; passing that back as `since` returns only what was
+# appended after it, which is what the live view polls with. Past days
+# gzipped by the log_cleanup job are streamed through gzip forwards, still
+# skipping blocks the index rules out, keeping the last `limit` matches.
+DAY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+TIME_RE = re.compile(r"^\d{2}:\d{2}(:\d{2})?$")
+LINE_RE = re.compile(r"^(\d{2}:\d{2}:\d{2}) \[(\w+)\] \[([^\]]*)\]: ?(.*)$")
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+TAIL_CHUNK = 64 * 1024
+SUMMARY_CHUNK = 1024 * 1024
+MAX_SINCE_BYTES = 8 * 1024 * 1024
+CACHED_DAYS = 4
+LEVEL_ALIASES = {"WARN": "WARNING", "FATAL": "CRITICAL"}
+
+LOG_FILES = ("app.jsonl", "app.jsonl.gz", "app.log", "app.log.gz")
+
+def valid_day(day):
+    return bool(day) and bool(DAY_RE.match(day))
+
+def day_file(day):
+    """The file a day is read from, by preference, or None."""
+    for name in LOG_FILES:
+        path = os.path.join(BASE_LOG_DIR, day, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def list_days():
+    """Days that have a log, plain or compressed, newest first."""
+    try:
+        names = os.listdir(BASE_LOG_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((n for n in names if valid_day(n) and day_file(n)), reverse=True)
+
+def _levels(values):
+    return {LEVEL_ALIASES.get(v.upper(), v.upper()) for v in values if v} or None
+
+def make_filter(levels=(), modules=(), time_from=None, time_to=None, text=None):
+    """Normalised filter dict; time_from/time_to are HH:MM[:SS] within the day."""
+    since = time_from if time_from and TIME_RE.match(time_from) else None
+    until = time_to if time_to and TIME_RE.match(time_to) else None
+    return {
+        "levels": _levels(levels),
+        "modules": {m for m in modules if m} or None,
+        "since": since + ":00" if since and len(since) == 5 else since,
+        "until": until + ":59" if until and len(until) == 5 else until,
+        "text": (text or "").strip().lower() or None,
+    }
+
+def matches(r, flt):
+    if flt["levels"] and r.get("level") not in flt["levels"]:
+        return False
+    if flt["modules"] and r.get("module") not in flt["modules"]:
+        return False
+    t = r.get("time") or ""
+    if flt["since"] and t < flt["since"]:
+        return False
+    if flt["until"] and t > flt["until"]:
+        return False
+    if flt["text"]:
+        hay = " ".join((t, r.get("level") or "", r.get("module") or "", r.get("msg") or "", r.get("exc") or ""))
+        if flt["text"] not in hay.lower():
+            return False
+    return True
+
+def _block_may_match(b, flt):
+    if flt["levels"] and not flt["levels"] & set(b["levels"]):
+        return False
+    if flt["modules"] and not flt["modules"] & set(b["modules"]):
+        return False
+    if b["t0"] is None:
+        return False
+    if flt["since"] and b["t1"] < flt["since"]:
+        return False
+    if flt["until"] and b["t0"] > flt["until"]:
+        return False
+    return True
+
+# Per-process caches so a poll costs what was appended since the last one,
+# not the size of the day: the parsed .idx of a .jsonl, and whole-day
+# level/module counts of an app.log. Keyed by path, a few days at most.
+_cache_lock = threading.Lock()
+_index_cache = OrderedDict()
+_text_cache = OrderedDict()
+
+def _remember(table, path, entry):
+    with _cache_lock:
+        table[path] = entry
+        table.move_to_end(path)
+        while len(table) > CACHED_DAYS:
+            table.popitem(last=False)
+
+def _complete_end(path, size):
+    """Offset just past the last newline at or before size."""
+    with open(path, "rb") as f:
+        pos = size
+        while pos > 0:
+            take = min(TAIL_CHUNK, pos)
+            f.seek(pos - take)
+            nl = f.read(take).rfind(b"\n")
+            if nl >= 0:
+                return pos - take + nl + 1
+            pos -= take
+    return 0
+
+def _read_lines(path, start, end):
+    """Lines in [start, end) of a file read forwards, decoded."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(max(0, end - start))
+    return data.decode("utf-8", errors="replace").splitlines()
+
+def _read_index(day):
+    path = json_index_path(day)
+    with _cache_lock:
+        entry = _index_cache.get(path) or {"pos": 0, "blocks": []}
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return []
+    if size < entry["pos"]:
+        entry = {"pos": 0, "blocks": []}
+    if size > entry["pos"]:
+        end = _complete_end(path, size)
+        blocks = list(entry["blocks"])
+        for line in _read_lines(path, entry["pos"], end):
+            try:
+                blocks.append(json.loads(line))
+            except ValueError:
+                continue
+        entry = {"pos": end, "blocks": blocks}
+        _remember(_index_cache, path, entry)
+    return entry["blocks"]
+
+def _since_ok(since, end):
+    return since is not None and 0 <= since <= end and end - since <= MAX_SINCE_BYTES
+
+def _query_json(day, flt, limit, since):
+    path = json_log_path(day)
+    end = _complete_end(path, os.path.getsize(path))
+    blocks = [b for b in _read_index(day) if b.get("end", 0) <= end]
+    indexed = max([b["end"] for b in blocks] or [0])
+    # whatever the writer hasn't indexed yet is read as one extra block
+    tail = read_json_block(path, indexed, end) if end > indexed else []
+    blocks.append(block_summary(tail, indexed, end))
+
+    levels, modules = {}, set()
+    for b in blocks:
+        for lv, n in b["levels"].items():
+            levels[lv] = levels.get(lv, 0) + n
+        modules.update(b["modules"])
+    result = {
+        "format": "json",
+        "levels": levels,
+        "modules": sorted(m for m in modules if m),
+        "offset": end,
+        "since": None,
+        "truncated": False,
+    }
+
+    if _since_ok(since, end):
+        records = tail if since == indexed else read_json_block(path, since, end)
+        hits = [r for r in records if matches(r, flt)]
+        result.update(records=hits[-limit:], since=since, truncated=len(hits) > limit)
+        return result
+
+    found, scanned, truncated = deque(), 0, False
+    for b in reversed(blocks):
+        if len(found) >= limit:
+            truncated = truncated or _block_may_match(b, flt)
+            if truncated:
+                break
+            continue
+        if not _block_may_match(b, flt):
+            continue
+        scanned += 1
+        records = tail if b["start"] == indexed else read_json_block(path, b["start"], b["end"])
+        hits = [r for r in records if matches(r, flt)]
+        if len(found) + len(hits) > limit:
+            hits = hits[len(hits) - (limit - len(found)):]
+            truncated = True
+        found.extendleft(reversed(hits))
+    result.update(records=list(found), blocks=len(blocks), blocks_scanned=scanned, truncated=truncated)
+    return result
+
+def parse_lines(lines):
+    """app.log lines -> records; traceback lines join the record above."""
+    current = None
+    for line in lines:
+        line = line.rstrip("\n")
+        m = LINE_RE.match(line)
+        if m:
+            if current is not None:
+                yield current
+            current = {"time": m.group(1), "level": m.group(2), "module": m.group(3), "msg": m.group(4)}
+        elif current is not None:
+            current["exc"] = (current["exc"] + "\n" + line) if "exc" in current else line
+        elif line.strip():
+            current = {"time": "", "level": "INFO", "module": "app", "msg": line.strip()}
+    if current is not None:
+        yield current
+
+def _reverse_lines(path, end):
+    """Lines of [0, end) newest first, read backwards TAIL_CHUNK at a time."""
+    with open(path, "rb") as f:
+        pos, rest = end, b""
+        while pos > 0:
+            take = min(TAIL_CHUNK, pos)
+            pos -= take
+            f.seek(pos)
+            lines = (f.read(take) + rest).split(b"\n")
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode("utf-8", errors="replace")
+        yield rest.decode("utf-8", errors="replace")
+
+def _reverse_records(path, end):
+    """parse_lines() backwards: records of app.log newest first."""
+    pending = []
+    for line in _reverse_lines(path, end):
+        m = LINE_RE.match(line)
+        if m:
+            r = {"time": m.group(1), "level": m.group(2), "module": m.group(3), "msg": m.group(4)}
+            if pending:
+                r["exc"] = "\n".join(reversed(pending))
+                pending = []
+            yield r
+        elif line or pending:
+            pending.append(line)
+
+def _text_summary(path, end):
+    with _cache_lock:
+        entry = _text_cache.get(path) or {"pos": 0, "levels": {}, "modules": set()}
+    if end < entry["pos"]:
+        entry = {"pos": 0, "levels": {}, "modules": set()}
+    if end > entry["pos"]:
+        levels, modules = dict(entry["levels"]), set(entry["modules"])
+        pos = entry["pos"]
+        while pos < end:
+            stop = min(end, pos + SUMMARY_CHUNK)
+            stop = _complete_end(path, stop) if stop < end else end
+            if stop <= pos:
+                stop = end
+            for line in _read_lines(path, pos, stop):
+                m = LINE_RE.match(line)
+                if m:
+                    levels[m.group(2)] = levels.get(m.group(2), 0) + 1
+                    modules.add(m.group(3))
+            pos = stop
+        entry = {"pos": end, "levels": levels, "modules": modules}
+        _remember(_text_cache, path, entry)
+    return entry
+
+def _query_text(day, flt, limit, since):
+    path = os.path.join(BASE_LOG_DIR, day, "app.log")
+    end = _complete_end(path, os.path.getsize(path))
+    summary = _text_summary(path, end)
+    result = {
+        "format": "text",
+        "levels": dict(summary["levels"]),
+        "modules": sorted(m for m in summary["modules"] if m),
+        "offset": end,
+        "since": None,
+        "truncated": False,
+    }
+    if _since_ok(since, end):
+        hits = [r for r in parse_lines(_read_lines(path, since, end)) if matches(r, flt)]
+        result.update(records=hits[-limit:], since=since, truncated=len(hits) > limit)
+        return result
+
+    found, truncated = [], False
+    for r in _reverse_records(path, end):
+        if not matches(r, flt):
+            continue
+        if len(found) >= limit:
+            truncated = True
+            break
+        found.append(r)
+    found.reverse()
+    result.update(records=found, truncated=truncated)
+    return result
+
+def _parse_json_lines(lines):
+    for line in lines:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+def _query_archived(day, path, flt, limit, since):
+    # an archived day no longer changes, so its compressed size is the cursor
+    size = os.path.getsize(path)
+    is_json = path.endswith(".jsonl.gz")
+    result = {
+        "format": "json" if is_json else "text",
+        "archived": True,
+        "offset": size,
+        "since": None,
+        "truncated": False,
+    }
+    with _cache_lock:
+        summary = _text_cache.get(path)
+    if since == size and summary is not None and summary["pos"] == size:
+        result.update(records=[], since=since, levels=dict(summary["levels"]),
+                      modules=sorted(m for m in summary["modules"] if m))
+        return result
+
+    levels, modules, matched = {}, set(), 0
+    found = deque(maxlen=limit)
+
+    def _take(records, count):
+        nonlocal matched
+        for r in records:
+            if count:
+                levels[r.get("level")] = levels.get(r.get("level"), 0) + 1
+                modules.add(r.get("module"))
+            if matches(r, flt):
+                matched += 1
+                found.append(r)
+
+    if is_json:
+        blocks = _read_index(day)
+        indexed = max([b.get("end", 0) for b in blocks] or [0])
+        for b in blocks:
+            for lv, n in b["levels"].items():
+                levels[lv] = levels.get(lv, 0) + n
+            modules.update(b["modules"])
+        with gzip.open(path, "rb") as f:
+            for b in blocks:
+                if not _block_may_match(b, flt):
+                    continue
+                f.seek(b["start"])
+                _take(_parse_json_lines(f.read(b["end"] - b["start"]).split(b"\n")), False)
+            # anything past the index (or all of it, without one)
+            f.seek(indexed)
+            _take(_parse_json_lines(f), True)
+    else:
+        with gzip.open(path, "rt", encoding="utf-8", errors="replace") as f:
+            _take(parse_lines(f), True)
+
+    _remember(_text_cache, path, {"pos": size, "levels": levels, "modules": modules})
+    result.update(records=list(found), levels=levels, modules=sorted(m for m in modules if m),
+                  truncated=matched > limit)
+    return result
+
+def query(day, flt, limit=DEFAULT_LIMIT, since=None):
+    """The newest `limit` records of the day matching flt, oldest first, plus
+    per-level counts and the module list for the whole day and the byte
+    offset read up to. Given that offset back as `since`, only records
+    appended after it are returned (result["since"] is then set; it is None
+    when the cursor was stale and a fresh tail was read instead). Raises
+    FileNotFoundError when the day has no log."""
+    path = day_file(day) if valid_day(day) else None
+    if path is None:
+        raise FileNotFoundError(day)
+    limit = max(1, min(MAX_LIMIT, int(limit or DEFAULT_LIMIT)))
+    if path.endswith(".gz"):
+        return _query_archived(day, path, flt, limit, since)
+    if path.endswith(".jsonl"):
+        return _query_json(day, flt, limit, since)
+    return _query_text(day, flt, limit, since)
@@ -0,0 +1,303 @@
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+# ---- request metrics -------------------------------------------------------
+# Per-endpoint request counts, status classes and latency histograms, kept
+# in memory by the before/after request hooks in app.py. Each endpoint gets
+# one flat list of ints the first time it is seen:
+#   [count, sum_us, max_us, 1xx, 2xx, 3xx, 4xx, 5xx, bucket0 .. bucketN]
+# and a request only bumps slots in it (bisect over the fixed bucket bounds;
+# nothing is appended or resized), so recording costs a lock and a handful
+# of adds.
+# Percentiles are estimated from the buckets by linear interpolation, which
+# is as precise as the bucket layout: fine steps below 100 ms, where most
+# requests land, coarser above.
+BUCKETS_MS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 250, 500, 1000, 2500, 5000, 10000)
+_COUNT, _SUM, _MAX, _STATUS = 0, 1, 2, 3
+_BUCKET = _STATUS + 5
+_BUCKETS_US = tuple(b * 1000 for b in BUCKETS_MS)
+_SLOTS = _BUCKET + len(BUCKETS_MS) + 1
+
+_lock = threading.Lock()
+# the Server page's table, which its Reset clears, and the same counts kept
+# for Prometheus, which must never go down
+_endpoints = {}
+_totals = {}
+_timings = {}
+_counters = {}
+_started = {"at": time.time()}
+_query_hook = {"fn": None}
+_PROCESS_START = time.time()
+
+def record(endpoint, status, elapsed):
+    """Count one request; elapsed in seconds (perf_counter difference)."""
+    us = int(elapsed * 1_000_000)
+    cls = status // 100
+    bucket = _BUCKET + bisect_left(_BUCKETS_US, us)
+    with _lock:
+        for table in (_endpoints, _totals):
+            row = table.get(endpoint)
+            if row is None:
+                row = table[endpoint] = [0] * _SLOTS
+            row[_COUNT] += 1
+            row[_SUM] += us
+            if us > row[_MAX]:
+                row[_MAX] = us
+            if 1 <= cls <= 5:
+                row[_STATUS + cls - 1] += 1
+            row[bucket] += 1
+
+def observe(name, elapsed, label=None):
+    """Add one duration (seconds) to a plain histogram, e.g. SQLite timings;
+    same bucket layout as requests, minus the status slots."""
+    us = int(elapsed * 1_000_000)
+    key = (name, label)
+    with _lock:
+        row = _timings.get(key)
+        if row is None:
+            row = _timings[key] = [0] * _SLOTS
+        row[_COUNT] += 1
+        row[_SUM] += us
+        if us > row[_MAX]:
+            row[_MAX] = us
+        row[_BUCKET + bisect_left(_BUCKETS_US, us)] += 1
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+# ---- SQLite timings ---------------------------------------------------------
+# connect() is sqlite3.connect with a Connection subclass whose cursors time
+# every execute; the open itself goes to sqlite_connect and each statement
+# to sqlite_query labelled by its verb. Rows fetched after execute aren't
+# included (for a SELECT, execute already steps to the first row).
+# set_query_hook() lets sqlprofile see each statement's text as well.
+
+def set_query_hook(fn):
+    """fn(sql, elapsed) after every timed statement; None to detach."""
+    _query_hook["fn"] = fn
+
+def _timed(sql, t0):
+    dt = time.perf_counter() - t0
+    observe("sqlite_query", dt, _verb(sql))
+    hook = _query_hook["fn"]
+    if hook is not None:
+        hook(sql, dt)
+
+def _verb(sql):
+    head = sql.lstrip()[:8].split(None, 1)
+    return head[0].lower() if head else "other"
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _timed(sql, t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _timed(sql, t0)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def connect(path, **kwargs):
+    t0 = time.perf_counter()
+    db = sqlite3.connect(path, factory=TimedConnection, **kwargs)
+    observe("sqlite_connect", time.perf_counter() - t0)
+    return db
+
+def _percentile(buckets, count, p):
+    if not count:
+        return None
+    rank = p * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        if n and seen + n >= rank:
+            lo = BUCKETS_MS[i - 1] if i > 0 else 0
+            hi = BUCKETS_MS[i] if i < len(BUCKETS_MS) else BUCKETS_MS[-1] * 2
+            return round(lo + (hi - lo) * (rank - seen) / n, 1)
+        seen += n
+    return float(BUCKETS_MS[-1])
+
+def _summary(name, row):
+    count = row[_COUNT]
+    buckets = row[_BUCKET:]
+    max_ms = round(row[_MAX] / 1000, 1)
+
+    def pct(p):
+        v = _percentile(buckets, count, p)
+        return None if v is None else min(v, max_ms)
+
+    return {
+        "endpoint": name,
+        "count": count,
+        "status": {f"{i + 1}xx": row[_STATUS + i] for i in range(5) if row[_STATUS + i]},
+        "errors": row[_STATUS + 4],
+        "mean_ms": round(row[_SUM] / count / 1000, 1) if count else None,
+        "max_ms": max_ms,
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+    }
+
+def snapshot():
+    """Raw rows, copied under the lock: {endpoint: [slots...]}."""
+    with _lock:
+        return {name: list(row) for name, row in _endpoints.items()}
+
+def _add(into, row):
+    for i in range(_SLOTS):
+        into[i] = max(into[i], row[i]) if i == _MAX else into[i] + row[i]
+
+def stats(peers=()):
+    """The request table; `peers` are snapshot()s of other prefork workers
+    to add in."""
+    rows = snapshot()
+    for peer in peers:
+        for name, row in peer.items():
+            _add(rows.setdefault(name, [0] * _SLOTS), row)
+    total = [0] * _SLOTS
+    for row in rows.values():
+        _add(total, row)
+    endpoints = sorted((_summary(name, row) for name, row in rows.items()), key=lambda e: -e["count"])
+    return {
+        "since": _started["at"],
+        "buckets_ms": list(BUCKETS_MS),
+        "total": _summary("*", total),
+        "endpoints": endpoints,
+    }
+
+def reset():
+    """Clear the request table (the Server page's Reset); the counters
+    /metrics reports are kept apart in _totals and left alone."""
+    with _lock:
+        _endpoints.clear()
+        _started["at"] = time.time()
+
+# ---- Prometheus text format ------------------------------------------------
+
+def _esc(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(**labels):
+    parts = [f'{k}="{_esc(v)}"' for k, v in labels.items() if v is not None]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+_LE = [f"{b / 1000:g}" for b in BUCKETS_MS] + ["+Inf"]
+
+def _histogram(samples, row, **labels):
+    cumulative = 0
+    for i, le in enumerate(_LE):
+        cumulative += row[_BUCKET + i]
+        samples.append(["_bucket", dict(labels, le=le), cumulative])
+    samples.append(["_sum", labels, round(row[_SUM] / 1_000_000, 6)])
+    samples.append(["_count", labels, row[_COUNT]])
+
+def _process():
+    """RSS bytes, OS threads and open fds, from /proc where there is one."""
+    rss = threads = fds = None
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+        fds = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        try:
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except (ImportError, OSError):
+            pass
+    if threads is None:
+        threads = threading.active_count()
+    return rss, threads, fds
+
+def families(extra=()):
+    """This process's metrics as [name, type, help, samples] lists, each
+    sample [suffix, labels, value]. JSON-safe, so prefork workers can pass
+    them around (see render_prometheus). `extra` is (name, type, help,
+    [(labels dict, value), ...]) tuples for values owned by other modules
+    (caches, jobs, websockets)."""
+    with _lock:
+        endpoints = {k: list(v) for k, v in _totals.items()}
+        timings = {k: list(v) for k, v in _timings.items()}
+        counters = dict(_counters)
+    out = []
+
+    def family(name, kind, help_text):
+        samples = []
+        out.append([name, kind, help_text, samples])
+        return samples
+
+    samples = family("otp_http_requests_total", "counter", "HTTP requests by endpoint and status class.")
+    for name, row in sorted(endpoints.items()):
+        for i in range(5):
+            if row[_STATUS + i]:
+                samples.append(["", {"endpoint": name, "code": f"{i + 1}xx"}, row[_STATUS + i]])
+    samples = family("otp_http_request_duration_seconds", "histogram", "HTTP request latency by endpoint.")
+    for name, row in sorted(endpoints.items()):
+        _histogram(samples, row, endpoint=name)
+
+    samples = family("otp_sqlite_connect_seconds", "histogram", "Time to open a SQLite connection.")
+    if ("sqlite_connect", None) in timings:
+        _histogram(samples, timings[("sqlite_connect", None)])
+    samples = family("otp_sqlite_query_seconds", "histogram", "SQLite statement execution time by verb.")
+    for (name, verb), row in sorted(timings.items(), key=lambda kv: (kv[0][0], kv[0][1] or "")):
+        if name == "sqlite_query":
+            _histogram(samples, row, verb=verb)
+
+    family("otp_totp_codes_total", "counter", "TOTP codes computed.").append(["", {}, counters.get("totp", 0)])
+
+    for name, kind, help_text, values in extra:
+        samples = family(name, kind, help_text)
+        for labels, value in values:
+            if value is not None:
+                samples.append(["", labels, value])
+
+    rss, threads, fds = _process()
+    samples = family("otp_process_resident_memory_bytes", "gauge", "Resident set size.")
+    if rss is not None:
+        samples.append(["", {}, rss])
+    family("otp_process_threads", "gauge", "OS threads of this process.").append(["", {}, threads])
+    samples = family("otp_process_open_fds", "gauge", "Open file descriptors.")
+    if fds is not None:
+        samples.append(["", {}, fds])
+    family("otp_process_start_time_seconds", "gauge", "Start time of this process.").append(["", {}, round(_PROCESS_START, 3)])
+    return out
+
+def render_prometheus(extra=(), worker=None, peers=None):
+    """Metrics in the Prometheus text exposition format: this process's,
+    plus under prefork the other processes' families from `peers`
+    ({worker: families}), every series then labelled with its worker."""
+    merged = {}
+    for who, fams in [(worker, families(extra))] + sorted((peers or {}).items()):
+        for name, kind, help_text, samples in fams:
+            if name not in merged:
+                merged[name] = (kind, help_text, [])
+            for suffix, labels, value in samples:
+                merged[name][2].append((suffix, labels if who is None else dict(worker=who, **labels), value))
+    out = []
+    for name, (kind, help_text, samples) in merged.items():
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            out.append(f"{name}{suffix}{_labels(**labels)} {value}")
+    return "\n".join(out) + "\n"
@@ -0,0 +1,425 @@
+import gc
+import itertools
+import json
+import os
+import queue
+import select
+import signal
+import socket
+import struct
+import threading
+import time
+
+import logger as logmod
+from logger import logger
+import wsgiserver
+
+# ---- pre-fork workers ------------------------------------------------------
+# settings.json "workers": N > 0 (production server mode, Unix only) serves
+# from N processes forked from one master once app.py is imported and warmed
+# up. The master binds the listening socket and every worker accepts on it
+# with its own wsgiserver pool, so requests aren't limited to one GIL.
+# Right before each fork gc.freeze() moves everything loaded so far into
+# the permanent generation: the collector no longer walks (and writes to)
+# those objects, so their pages stay shared copy-on-write between workers.
+# What must exist once stays in the master, which serves no requests: the
+# log files (workers forward records, see logger.forward_to), the
+# maintenance scheduler and the remote console pty. Master and each worker
+# talk over a socketpair carrying length-prefixed JSON {"t": kind, "p":
+# payload}; handlers registered with on() run on the channel's reader
+# thread. ask() is a worker's request that the master's handler answers
+# through reply(), matched up by an "a" id. A worker that dies is replaced; SIGTERM/SIGINT to the master
+# stops them all.
+# Workers aren't forked by the master itself: once its threads run (the
+# scheduler, the console reader, the channels' readers and writers) any
+# lock one of them holds at that moment, in metrics, cache, the rate
+# limiter or anywhere else, would stay held in the new worker for good.
+# Right after warmup the master forks a zygote that starts no threads, and
+# every worker, the first ones and the replacements, is forked from that.
+# The master hands the zygote one end of each worker's socketpair over a
+# datagram socketpair (SCM_RIGHTS); the zygote answers with the worker's
+# pid and later its exit status, since only it can wait for the worker.
+DEFAULT_WORKERS = 0
+MAX_WORKERS = 64
+SEND_QUEUE = 2000
+SEND_WAIT = 5.0
+MAX_MESSAGE = 16 * 1024 * 1024
+RESPAWN_DELAY = 1.0
+STOP_TIMEOUT = 10.0
+ASK_TIMEOUT = 2.0
+
+_HEADER = struct.Struct("!I")
+
+_state = {"role": None, "channel": None, "workers": {}, "stopping": False, "server": None, "zygote": None, "pending": {}, "slot": None}
+_handlers = {"master": {}, "worker": {}}
+_asks = {}
+_ask_ids = itertools.count(1)
+
+def supported():
+    return hasattr(os, "fork")
+
+def workers_from_settings(data):
+    """workers from a settings.json dict, clamped; 0 = single process."""
+    try:
+        return max(0, min(MAX_WORKERS, int((data or {}).get("workers") or DEFAULT_WORKERS)))
+    except (TypeError, ValueError):
+        return DEFAULT_WORKERS
+
+def is_master():
+    return _state["role"] == "master"
+
+def is_worker():
+    return _state["role"] == "worker"
+
+def worker_slot():
+    """This worker's number, 0 to workers - 1; a replacement keeps it."""
+    return _state["slot"]
+
+def on(kind, fn, role="worker"):
+    """Call fn(payload, reply) for each `kind` message arriving in `role`:
+    "worker" for what the master broadcasts, "master" for what workers
+    send. reply(kind, payload) answers the sender; for an ask() the
+    payload is the answer."""
+    _handlers[role][kind] = fn
+
+def send(kind, payload, wait=False):
+    """Worker -> master. False if not a worker or the message was dropped."""
+    channel = _state["channel"]
+    return channel.send(kind, payload, wait) if channel is not None and is_worker() else False
+
+def ask(kind, payload=None, timeout=ASK_TIMEOUT):
+    """Worker -> master request; returns what the master's handler for
+    `kind` passed to reply(), or None if not a worker or no answer came."""
+    channel = _state["channel"]
+    if channel is None or not is_worker():
+        return None
+    ask_id = next(_ask_ids)
+    waiter = _asks[ask_id] = {"done": threading.Event(), "answer": None}
+    try:
+        if channel.send(kind, payload, wait=True, ask=ask_id):
+            waiter["done"].wait(timeout)
+        return waiter["answer"]
+    finally:
+        _asks.pop(ask_id, None)
+
+def _answered(ask_id, answer):
+    waiter = _asks.get(ask_id)
+    if waiter is not None:
+        waiter["answer"] = answer
+        waiter["done"].set()
+
+def broadcast(kind, payload):
+    """Master -> every worker; never blocks, drops for a worker that is
+    that far behind. No-op outside the master."""
+    if not is_master():
+        return
+    for info in list(_state["workers"].values()):
+        info["channel"].send(kind, payload)
+
+class _Channel:
+    """One end of a master/worker socketpair. send() queues; a writer
+    thread does the socket I/O, so a slow peer never stalls the caller."""
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        self.out = queue.Queue(maxsize=SEND_QUEUE)
+        self.dropped = 0
+        self.writer = None
+
+    def start(self, on_close):
+        self.writer = threading.Thread(target=self._write_loop, daemon=True, name=f"prefork-send-{self.name}")
+        self.writer.start()
+        threading.Thread(target=self._read_loop, args=(on_close,), daemon=True, name=f"prefork-recv-{self.name}").start()
+
+    def send(self, kind, payload, wait=False, ask=None):
+        msg = {"t": kind, "p": payload}
+        if ask is not None:
+            msg["a"] = ask
+        data = json.dumps(msg, separators=(",", ":")).encode("utf-8")
+        try:
+            if wait:
+                self.out.put(data, timeout=SEND_WAIT)
+            else:
+                self.out.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def reply(self, kind, payload):
+        self.send(kind, payload)
+
+    def _write_loop(self):
+        while True:
+            data = self.out.get()
+            if data is None:
+                break
+            try:
+                self.sock.sendall(_HEADER.pack(len(data)) + data)
+            except OSError:
+                break
+
+    def _read_loop(self, on_close):
+        role = _state["role"]
+        f = self.sock.makefile("rb")
+        try:
+            while True:
+                head = f.read(_HEADER.size)
+                if len(head) < _HEADER.size:
+                    break
+                (size,) = _HEADER.unpack(head)
+                if size > MAX_MESSAGE:
+                    break
+                body = f.read(size)
+                if len(body) < size:
+                    break
+                try:
+                    msg = json.loads(body)
+                except ValueError:
+                    continue
+                ask_id = msg.get("a")
+                if msg.get("t") == "_answer":
+                    _answered(ask_id, msg.get("p"))
+                    continue
+                fn = _handlers[role].get(msg.get("t"))
+                if fn is None:
+                    continue
+                reply = self.reply if ask_id is None else (lambda _kind, payload, a=ask_id: self.send("_answer", payload, ask=a))
+                try:
+                    fn(msg.get("p"), reply)
+                except Exception as e:
+                    logger.exception("prefork %s handler failed: %s", msg.get("t"), e)
+        except OSError:
+            pass
+        finally:
+            on_close(self)
+
+    def close(self, flush=False):
+        """Stop the writer (after what is queued if flush) and the socket."""
+        try:
+            self.out.put(None, timeout=SEND_WAIT if flush else 0)
+        except queue.Full:
+            pass
+        if flush and self.writer is not None:
+            self.writer.join(SEND_WAIT)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+def _listen(host, port):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=1024)
+    # every worker polls the same socket; the ones that lose the race for
+    # a connection get EAGAIN instead of blocking in accept()
+    sock.setblocking(False)
+    return sock
+
+# ---- worker ----------------------------------------------------------------
+
+def _worker_main(sock, slot, listener, app, threads, hooks):
+    channel = _Channel(sock, "master")
+    _state.update(role="worker", channel=channel, stopping=False, slot=slot)
+    logmod.forward_to(lambda doc: send("log", doc, wait=True))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: _worker_stop())
+    channel.start(lambda _ch: _worker_stop())
+    code = 0
+    try:
+        host, port = listener.getsockname()[:2]
+        server = wsgiserver.make_server(host, port, app, threads=threads, fd=listener.fileno())
+        _state["server"] = server
+        listener.close()
+        # what this worker forks (the hashing pool) must not keep the port
+        # bound or the channel open after a SIGKILL leaves it orphaned
+        os.register_at_fork(after_in_child=lambda: (server.socket.close(), channel.sock.close()))
+        if hooks["worker_start"] is not None:
+            hooks["worker_start"]()
+        send("hello", {"pid": os.getpid()})
+        if not _state["stopping"]:
+            server.serve_forever()
+        server.server_close()
+    except Exception as e:
+        logger.exception("prefork worker pid=%d failed: %s", os.getpid(), e)
+        code = 1
+    if hooks["worker_stop"] is not None:
+        try:
+            hooks["worker_stop"]()
+        except Exception as e:
+            logger.error("prefork worker stop hook failed: %s", e)
+    logmod.stop_forwarding()
+    channel.close(flush=True)
+    os._exit(code)
+
+def _worker_stop():
+    if _state["stopping"]:
+        return
+    _state["stopping"] = True
+    server = _state["server"]
+    if server is not None:
+        # shutdown() waits for serve_forever to notice, so not from its thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+# ---- zygote ----------------------------------------------------------------
+
+def _zygote_main(ctl, master_pid, listener, app, threads, hooks):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _state["role"] = "zygote"
+    # no logging here: the master's log queue is copied mid-use and nothing
+    # in this process drains it
+    try:
+        while os.getppid() == master_pid:
+            if select.select([ctl], [], [], 0.2)[0]:
+                data, fds, _flags, _addr = socket.recv_fds(ctl, 4096, 1)
+                if not fds:
+                    # the master is done
+                    break
+                sock = socket.socket(fileno=fds[0])
+                slot = json.loads(data)["slot"]
+                gc.collect()
+                gc.freeze()
+                pid = os.fork()
+                if pid == 0:
+                    ctl.close()
+                    _worker_main(sock, slot, listener, app, threads, hooks)
+                sock.close()
+                ctl.send(json.dumps({"spawned": pid, "slot": slot}).encode("utf-8"))
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if not pid:
+                    break
+                ctl.send(json.dumps({"exited": pid, "status": status}).encode("utf-8"))
+    except OSError:
+        pass
+    os._exit(0)
+
+# ---- master ----------------------------------------------------------------
+
+def _start_zygote(listener, app, threads, hooks):
+    ctl, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    master_pid = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        ctl.close()
+        _zygote_main(child, master_pid, listener, app, threads, hooks)
+    child.close()
+    _state["zygote"] = {"pid": pid, "ctl": ctl}
+
+def _spawn(slot):
+    """Ask the zygote for a worker; it is added once the zygote answers."""
+    parent, child = socket.socketpair()
+    socket.send_fds(_state["zygote"]["ctl"], [json.dumps({"slot": slot}).encode("utf-8")], [child.fileno()])
+    child.close()
+    _state["pending"][slot] = parent
+
+def _zygote_events(timeout):
+    """Handle what the zygote sent within `timeout`: spawned workers get
+    their channel, exited ones are replaced unless stopping."""
+    ctl = _state["zygote"]["ctl"]
+    deadline = time.time() + timeout
+    while True:
+        wait = deadline - time.time()
+        if wait <= 0 or not select.select([ctl], [], [], wait)[0]:
+            return
+        try:
+            msg = json.loads(ctl.recv(4096))
+        except (OSError, ValueError):
+            return
+        if "spawned" in msg:
+            pid, slot = msg["spawned"], msg["slot"]
+            channel = _Channel(_state["pending"].pop(slot), f"w{slot}")
+            _state["workers"][pid] = {"slot": slot, "channel": channel, "started": time.time()}
+            channel.start(lambda _ch: None)
+            if _state["stopping"]:
+                os.kill(pid, signal.SIGTERM)
+        elif msg.get("exited") in _state["workers"]:
+            pid = msg["exited"]
+            info = _state["workers"].pop(pid)
+            info["channel"].close()
+            if _state["stopping"]:
+                continue
+            logger.error("prefork worker %d pid=%d exited with code %s, restarting", info["slot"], pid, os.waitstatus_to_exitcode(msg["status"]))
+            if time.time() - info["started"] < RESPAWN_DELAY * 5:
+                time.sleep(RESPAWN_DELAY)
+            _spawn(info["slot"])
+
+def _zygote_alive():
+    try:
+        return os.waitpid(_state["zygote"]["pid"], os.WNOHANG)[0] == 0
+    except ChildProcessError:
+        return False
+
+def _stop_workers(*_):
+    _state["stopping"] = True
+    for pid in list(_state["workers"]):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+def serve(host, port, app, workers, threads, warmup=None, master_start=None, worker_start=None, worker_stop=None):
+    """Be the prefork master until SIGTERM/SIGINT. warmup() runs once before
+    the zygote is forked, master_start() in the master once the first
+    workers are up, worker_start() in each worker before it serves and
+    worker_stop() when it is done (workers leave with os._exit, so nothing
+    registered with atexit runs there)."""
+    hooks = {"worker_start": worker_start, "worker_stop": worker_stop}
+    listener = _listen(host, port)
+    _state["role"] = "master"
+    on("log", lambda doc, _reply: logmod.ingest(doc), role="master")
+    if warmup is not None:
+        warmup()
+    _start_zygote(listener, app, threads, hooks)
+    for slot in range(workers):
+        _spawn(slot)
+    deadline = time.time() + STOP_TIMEOUT
+    while _state["pending"] and time.time() < deadline:
+        _zygote_events(0.2)
+    logmod.add_tap(lambda doc: broadcast("log", doc))
+    signal.signal(signal.SIGTERM, _stop_workers)
+    signal.signal(signal.SIGINT, _stop_workers)
+    logger.info("Serving on %s:%s (production, %d workers x %d threads, master pid=%d)", host, port, workers, threads, os.getpid())
+    if master_start is not None:
+        master_start()
+
+    deadline = None
+    while _state["workers"] or (_state["pending"] and not _state["stopping"]):
+        _zygote_events(0.2)
+        if not _zygote_alive():
+            # nothing left to replace workers or to wait for them, so
+            # stop and go by whether the pids still exist
+            if not _state["stopping"]:
+                logger.critical("prefork zygote exited, stopping the workers")
+                _stop_workers()
+            for pid in list(_state["workers"]):
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    _state["workers"].pop(pid)["channel"].close()
+        if _state["stopping"]:
+            deadline = deadline or time.time() + STOP_TIMEOUT
+            if time.time() > deadline:
+                for pid in list(_state["workers"]):
+                    logger.warning("prefork worker pid=%d did not stop in %ds, killing it", pid, STOP_TIMEOUT)
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                deadline = time.time() + STOP_TIMEOUT
+    try:
+        _state["zygote"]["ctl"].send(b"{}")
+    except OSError:
+        pass
+    _state["zygote"]["ctl"].close()
+    try:
+        os.waitpid(_state["zygote"]["pid"], 0)
+    except ChildProcessError:
+        pass
+    listener.close()
+    logger.info("prefork master stopped")
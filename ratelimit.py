@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from logger import logger
+
+# ---- login rate limiter ----------------------------------------------------
+# Failed logins per key (the client IP): MAX_ATTEMPTS failures inside a
+# WINDOW_SECONDS window lock the key for WINDOW_SECONDS. Two stores:
+#   memory - an OrderedDict kept in last-touched order and capped at
+#            MAX_ENTRIES, so a spray from many addresses evicts the stalest
+#            keys instead of growing without bound. Everything is O(1).
+#   sqlite - a small table in its own file (not otp.db, so failed logins
+#            don't churn the main WAL) that every app process shares, so
+#            several workers enforce one limit.
+# A sweeper thread drops expired keys every SWEEP_SECONDS in either case.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "instance", "ratelimit.db")
+MAX_ATTEMPTS = 5
+WINDOW_SECONDS = 900
+MAX_ENTRIES = 10000
+SWEEP_SECONDS = 60
+
+class MemoryStore:
+    name = "memory"
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.evicted = 0
+
+    def remaining(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry["locked_until"] > now:
+                return entry["locked_until"] - now
+            if now - entry["window_start"] > WINDOW_SECONDS:
+                del self.entries[key]
+            return None
+
+    def record(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or now - entry["window_start"] > WINDOW_SECONDS:
+                entry = {"count": 0, "window_start": now, "locked_until": 0.0}
+            entry["count"] += 1
+            entry["touched"] = now
+            if entry["count"] >= MAX_ATTEMPTS:
+                entry["locked_until"] = now + WINDOW_SECONDS
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+            return entry["count"]
+
+    def clear(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def sweep(self, now):
+        # entries sit in last-touched order and nothing outlives its last
+        # touch by more than WINDOW_SECONDS, so stop at the first live one
+        removed = 0
+        with self.lock:
+            while self.entries:
+                key, entry = next(iter(self.entries.items()))
+                if entry["touched"] + WINDOW_SECONDS > now:
+                    break
+                self.entries.popitem(last=False)
+                removed += 1
+        return removed
+
+    def stats(self, now):
+        with self.lock:
+            locked = sum(1 for e in self.entries.values() if e["locked_until"] > now)
+            return {"store": self.name, "entries": len(self.entries), "locked": locked,
+                    "max_entries": self.max_entries, "evicted": self.evicted}
+
+class SQLiteStore:
+    name = "sqlite"
+
+    def __init__(self, path=DB_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS login_attempts (
+                    key TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL,
+                    window_start REAL NOT NULL,
+                    locked_until REAL NOT NULL DEFAULT 0,
+                    expires REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_login_attempts_expires ON login_attempts(expires)")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=5)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def remaining(self, key, now):
+        with self._connect() as db:
+            row = db.execute("SELECT locked_until FROM login_attempts WHERE key = ?", (key,)).fetchone()
+        if row and row[0] > now:
+            return row[0] - now
+        return None
+
+    def record(self, key, now):
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT count, window_start FROM login_attempts WHERE key = ?", (key,)).fetchone()
+            if not row or now - row[1] > WINDOW_SECONDS:
+                count, window_start = 1, now
+            else:
+                count, window_start = row[0] + 1, row[1]
+            locked_until = now + WINDOW_SECONDS if count >= MAX_ATTEMPTS else 0.0
+            db.execute(
+                "INSERT OR REPLACE INTO login_attempts (key, count, window_start, locked_until, expires) VALUES (?, ?, ?, ?, ?)",
+                (key, count, window_start, locked_until, max(window_start, locked_until - WINDOW_SECONDS) + WINDOW_SECONDS),
+            )
+        return count
+
+    def clear(self, key):
+        with self._connect() as db:
+            db.execute("DELETE FROM login_attempts WHERE key = ?", (key,))
+
+    def sweep(self, now):
+        with self._connect() as db:
+            removed = db.execute("DELETE FROM login_attempts WHERE expires <= ?", (now,)).rowcount
+            over = db.execute("SELECT COUNT(*) FROM login_attempts").fetchone()[0] - self.max_entries
+            if over > 0:
+                db.execute("""
+                    DELETE FROM login_attempts WHERE key IN (
+                        SELECT key FROM login_attempts ORDER BY expires LIMIT ?
+                    )
+                """, (over,))
+                removed += over
+        return removed
+
+    def stats(self, now):
+        with self._connect() as db:
+            entries, locked = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(locked_until > ?), 0) FROM login_attempts", (now,)
+            ).fetchone()
+        return {"store": self.name, "entries": entries, "locked": locked, "max_entries": self.max_entries}
+
+_store = {"impl": MemoryStore(), "sweeper": None}
+
+def configure(kind="memory"):
+    """Pick the store; "sqlite" shares the limit between app processes."""
+    if kind == "sqlite":
+        try:
+            _store["impl"] = SQLiteStore()
+        except sqlite3.Error as e:
+            logger.critical("could not open rate limit store %s, using memory: %s", DB_PATH, e)
+            _store["impl"] = MemoryStore()
+    else:
+        _store["impl"] = MemoryStore()
+    return _store["impl"].name
+
+def remaining(key):
+    """Seconds left on the key's lockout, or None if it may try again."""
+    try:
+        return _store["impl"].remaining(key, time.time())
+    except sqlite3.Error as e:
+        logger.error("rate limit lookup failed: %s", e)
+        return None
+
+def record_failure(key):
+    try:
+        return _store["impl"].record(key, time.time())
+    except sqlite3.Error as e:
+        logger.error("rate limit update failed: %s", e)
+        return 0
+
+def clear(key):
+    try:
+        _store["impl"].clear(key)
+    except sqlite3.Error as e:
+        logger.error("rate limit clear failed: %s", e)
+
+def _sweep_loop():
+    while True:
+        time.sleep(SWEEP_SECONDS)
+        try:
+            removed = _store["impl"].sweep(time.time())
+            if removed:
+                logger.debug("rate limiter swept %d expired keys", removed)
+        except Exception as e:
+            logger.error("rate limiter sweep failed: %s", e)
+
+def start_sweeper():
+    if _store["sweeper"] is not None and _store["sweeper"].is_alive():
+        return
+    t = threading.Thread(target=_sweep_loop, daemon=True, name="ratelimit-sweeper")
+    _store["sweeper"] = t
+    t.start()
+
+def stats():
+    return _store["impl"].stats(time.time())
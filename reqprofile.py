@@ -0,0 +1,115 @@
+import cProfile
+import json
+import os
+import pstats
+import re
+import secrets
+import threading
+import time
+from datetime import datetime
+
+# ---- per-request cProfile --------------------------------------------------
+# An admin adds "X-Profile: 1" (or ?_profile=1) to a request; the hooks in
+# app.py run that one request under cProfile and save the stats here as
+# <id>.pstats (loadable with pstats / snakeviz) plus <id>.json with what
+# the request was. The response carries X-Profile-Id and a Link header to
+# /profiles/<id>, which shows the top functions.
+# Only one request is profiled at a time (cProfile hooks are process-wide
+# on newer Pythons); a flagged request arriving meanwhile runs unprofiled
+# and says so in X-Profile.
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "profiles")
+KEEP = 20
+TOP = 40
+SORTS = ("cumulative", "tottime", "ncalls")
+
+_ID_RE = re.compile(r"^\d{8}-\d{6}-[0-9a-f]{6}$")
+
+_active = threading.Lock()
+
+def requested(req):
+    flag = req.headers.get("X-Profile") or req.args.get("_profile")
+    return str(flag or "").lower() in ("1", "true", "yes")
+
+def start():
+    """A running cProfile.Profile, or None if another request holds it."""
+    if not _active.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # some other profiler (sys.setprofile / sys.monitoring) is active
+        _active.release()
+        return None
+    return profile
+
+def stop(profile):
+    profile.disable()
+    _active.release()
+
+def save(profile, meta):
+    """Write the stats and meta for a stopped profile; returns its id."""
+    profile_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile.dump_stats(os.path.join(PROFILE_DIR, profile_id + ".pstats"))
+    with open(os.path.join(PROFILE_DIR, profile_id + ".json"), "w", encoding="utf-8") as f:
+        json.dump(dict(meta, id=profile_id, at=time.time()), f)
+    _prune()
+    return profile_id
+
+def _prune():
+    ids = sorted(n[:-7] for n in os.listdir(PROFILE_DIR) if n.endswith(".pstats"))
+    for old in ids[:-KEEP]:
+        for ext in (".pstats", ".json"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old + ext))
+            except OSError:
+                pass
+
+def stats_path(profile_id):
+    if not _ID_RE.match(profile_id or ""):
+        return None
+    path = os.path.join(PROFILE_DIR, profile_id + ".pstats")
+    return path if os.path.isfile(path) else None
+
+def _meta(profile_id):
+    try:
+        with open(os.path.join(PROFILE_DIR, profile_id + ".json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"id": profile_id}
+
+def list_profiles():
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    ids = sorted((n[:-7] for n in names if n.endswith(".pstats")), reverse=True)
+    return [_meta(i) for i in ids]
+
+def top(profile_id, sort="cumulative", limit=TOP):
+    """(meta, rows) for one saved profile, rows sorted by `sort`; None if
+    there is no such profile."""
+    path = stats_path(profile_id)
+    if path is None:
+        return None
+    if sort not in SORTS:
+        sort = SORTS[0]
+    st = pstats.Stats(path)
+    rows = []
+    for (filename, line, func), (primitive, ncalls, tottime, cumtime, _callers) in st.stats.items():
+        rows.append({
+            "function": func,
+            "file": os.path.basename(filename) if filename != "~" else "",
+            "line": line,
+            "ncalls": ncalls,
+            "primitive": primitive,
+            "tottime_ms": round(tottime * 1000, 2),
+            "cumtime_ms": round(cumtime * 1000, 2),
+        })
+    key = {"cumulative": "cumtime_ms", "tottime": "tottime_ms", "ncalls": "ncalls"}[sort]
+    rows.sort(key=lambda r: -r[key])
+    meta = _meta(profile_id)
+    meta["total_ms"] = round(st.total_tt * 1000, 1)
+    meta["functions"] = len(rows)
+    return meta, rows[:limit]
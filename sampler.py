@@ -0,0 +1,106 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# ---- sampling profiler -----------------------------------------------------
+# Admin-triggered from the Server page: for N seconds, every interval, walk
+# the stack of every other thread via sys._current_frames() and count each
+# distinct (thread, stack). Other threads keep running; the only cost to
+# them is the GIL hold while one snapshot is walked. Stacks are keyed by
+# code objects while sampling and only turned into text at the end.
+# Output is the collapsed-stack format flamegraph.pl / speedscope read:
+#   thread;outer (file.py:12);inner (file.py:40) <count>
+# Frames are labelled by the function's first line, so samples from
+# different lines of one function merge. Numbered thread names
+# ("Thread-12 (process_request_thread)", the production pool's "http_3")
+# lose the number so all request threads fold into one root.
+# Under gevent (asyncmode.py) app.py runs this on a real thread; all
+# greenlets share the main thread, whose stack is whichever one is running.
+DEFAULT_SECONDS = 10
+MAX_SECONDS = 60
+DEFAULT_INTERVAL = 0.01
+MIN_INTERVAL = 0.001
+MAX_DEPTH = 200
+
+_THREAD_NUM_RE = re.compile(r"[-_]\d+\b")
+
+_lock = threading.Lock()
+_state = {"running": False}
+
+class SamplerBusy(Exception):
+    pass
+
+def _thread_names():
+    return {t.ident: _THREAD_NUM_RE.sub("", t.name) for t in threading.enumerate()}
+
+def _label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample(seconds=DEFAULT_SECONDS, interval=DEFAULT_INTERVAL):
+    """Sample all other threads for `seconds`; returns a dict with the
+    collapsed stacks as text plus sample counts. Raises SamplerBusy if a
+    profile is already being taken."""
+    seconds = max(0.1, min(MAX_SECONDS, float(seconds)))
+    interval = max(MIN_INTERVAL, min(1.0, float(interval)))
+    with _lock:
+        if _state["running"]:
+            raise SamplerBusy("A profile is already being taken")
+        _state["running"] = True
+    try:
+        # by frame rather than threading.get_ident(), which gevent patches
+        me = sys._getframe()
+        names = _thread_names()
+        counts = Counter()
+        samples = 0
+        walk_s = 0.0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if frame is me:
+                    continue
+                if ident not in names:
+                    names = _thread_names()
+                    names.setdefault(ident, f"thread {ident}")
+                codes = []
+                while frame is not None and len(codes) < MAX_DEPTH:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                counts[(names.get(ident, f"thread {ident}"),) + tuple(codes)] += 1
+            del frames
+            samples += 1
+            walk_s += time.perf_counter() - t0
+            time.sleep(interval)
+        elapsed = time.perf_counter() - started
+    finally:
+        with _lock:
+            _state["running"] = False
+
+    labels = {}
+    lines = []
+    for key, n in counts.items():
+        parts = [key[0]]
+        for code in key[1:]:
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = _label(code)
+            parts.append(label)
+        lines.append(f"{';'.join(parts)} {n}")
+    lines.sort()
+    return {
+        "collapsed": "\n".join(lines) + ("\n" if lines else ""),
+        "samples": samples,
+        "stacks": len(counts),
+        "threads": len({key[0] for key in counts}),
+        "seconds": round(elapsed, 2),
+        "overhead_ms": round(walk_s * 1000, 1),
+    }
+
+def running():
+    return _state["running"]
@@ -0,0 +1,562 @@
+import json
+import os
+import queue
+import random
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+import hashing
+import logsearch
+from logger import logger, _cleanup as cleanup_logs, archive_old_days, retention_from_settings, forward_to, ingest
+from database import (
+    acquire_lock, release_lock, load_state, save_state, ensure_dirs, init_db, connect,
+    backup_db, restore_backup, quick_check, pragma_checks, optimize, vacuum, checkpoint_if_needed,
+    normalize_secrets, check_names, check_orphans,
+)
+
+# ---- maintenance scheduler -----------------------------------------------
+# Every maintenance step is a named job with its own cadence instead of one
+# hourly batch. A single runner thread in the server picks the next due job
+# and hands it to a long-lived child process (`scheduler.py --worker`) over
+# a JSON-lines pipe, so backups, integrity checks and VACUUM never hold the
+# GIL of the process that serves requests. A job that overruns its timeout
+# gets the worker killed and restarted. Run history is persisted in
+# maintenance_state.json so start.py (a separate process) can show it and
+# so restarts don't re-run everything at once.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SETTINGS_PATH = os.path.join(BASE_DIR, "settings.json")
+WORKER_CMD = [sys.executable or "python3", os.path.join(BASE_DIR, "scheduler.py"), "--worker"]
+JOB_HISTORY = 20
+TICK_SECONDS = 30
+STARTUP_DELAY = 15
+LOCK_RETRY_SECONDS = 60
+PASSWORD_BATCH = 50
+TASK_WAIT_SECONDS = 5
+
+_jobs_lock = threading.Lock()
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+_runner = {"thread": None}
+_worker = {"proc": None, "results": None}
+_activity = {"last": None, "shared": None}
+JOBS = {}
+TASKS = {}
+
+# Under prefork (prefork.py) only the master runs the scheduler. It calls
+# share_activity() before forking so the workers' touch() lands in shared
+# memory, and on_change() to broadcast list_jobs() when a job starts or
+# ends. Workers call set_remote(): trigger() is then sent to the master and
+# list_jobs() answers from the last snapshot it broadcast, and run_task()
+# asks the master to run the task and waits for its answer.
+_remote = {"send": None, "ask": None, "jobs": None}
+_hooks = {"on_change": None}
+
+def _orphan_scan():
+    normalize_secrets()
+    return check_names() + check_orphans()
+
+def _backup():
+    dest = backup_db()
+    if dest:
+        logger.info("database backup created at %s", dest)
+    return 0
+
+def _log_cleanup():
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            settings = json.load(f) or {}
+    except (OSError, ValueError):
+        settings = {}
+    days, mb = retention_from_settings(settings)
+    archived = archive_old_days()
+    removed = cleanup_logs(days, mb)
+    indexed = 0
+    if settings.get("log_search_index"):
+        today = time.strftime("%Y-%m-%d")
+        for day in logsearch.list_days():
+            if day < today and logsearch.index_missing(day):
+                logsearch.build_index(day)
+                indexed += 1
+    if archived or removed or indexed:
+        logger.info("log cleanup compressed=%d removed=%d indexed=%d retention_days=%d retention_mb=%d",
+                    archived, removed, indexed, days, mb)
+    return 0
+
+def touch():
+    """Mark the server as busy; jobs registered with idle_aware get the
+    seconds since the last call so they can wait for a quiet moment."""
+    now = time.time()
+    _activity["last"] = now
+    shared = _activity["shared"]
+    if shared is not None:
+        shared.value = now
+
+def _idle_for():
+    last = _activity["last"]
+    shared = _activity["shared"]
+    if shared is not None and shared.value:
+        last = max(last or 0.0, shared.value)
+    return None if last is None else round(time.time() - last, 1)
+
+def share_activity():
+    import multiprocessing
+    _activity["shared"] = multiprocessing.RawValue("d", 0.0)
+
+def on_change(fn):
+    _hooks["on_change"] = fn
+
+def _changed():
+    fn = _hooks["on_change"]
+    if fn is not None:
+        try:
+            fn()
+        except Exception as e:
+            logger.error("maintenance job change hook failed: %s", e)
+
+def set_remote(send, ask=None):
+    _remote["send"] = send
+    _remote["ask"] = ask
+
+def set_snapshot(jobs):
+    _remote["jobs"] = jobs
+
+def _password_migration():
+    """Hash every users.password that isn't bcrypt yet, PASSWORD_BATCH rows
+    per transaction, with the hashing spread over the process pool. An
+    empty password used to let the first login set any password; those
+    accounts get a random hash instead and need an admin password reset."""
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            hashing.set_rounds(hashing.rounds_from_settings(json.load(f)))
+    except (OSError, ValueError):
+        pass
+    with connect() as db:
+        rows = [
+            (uid, username, pw) for uid, username, pw in
+            db.execute("SELECT id, username, password FROM users").fetchall()
+            if hashing.hash_rounds(pw) is None
+        ]
+    if not rows:
+        return 0
+    migrated = locked = 0
+    for i in range(0, len(rows), PASSWORD_BATCH):
+        batch = rows[i:i + PASSWORD_BATCH]
+        plain = [pw if (pw or "").strip() else secrets.token_urlsafe(32) for _, _, pw in batch]
+        hashed = hashing.hash_many(plain)
+        with connect() as db:
+            for (uid, username, old), new in zip(batch, hashed):
+                # only if nobody changed it while we were hashing
+                cur = db.execute("UPDATE users SET password = ? WHERE id = ? AND password IS ?", (new, uid, old))
+                if not cur.rowcount:
+                    continue
+                if (old or "").strip():
+                    migrated += 1
+                else:
+                    locked += 1
+                    logger.warning("user %s with id %s had an empty password, locked until an admin resets it", username, uid)
+    logger.info("password migration hashed=%d locked_empty=%d", migrated, locked)
+    return 0
+
+def register(name, func, interval, jitter=0, timeout=300, label=None, description="", idle_aware=False):
+    with _jobs_lock:
+        JOBS[name] = {
+            "name": name,
+            "label": label or name.replace("_", " ").capitalize(),
+            "description": description,
+            "func": func,
+            "interval": interval,
+            "jitter": jitter,
+            "timeout": timeout,
+            "idle_aware": idle_aware,
+            "manual": False,
+            "running": False,
+            "next_run": None,
+            "last_run": None,
+            "last_status": None,
+            "last_error": None,
+            "issues": 0,
+            "durations": deque(maxlen=JOB_HISTORY),
+        }
+
+register("backup", _backup, 3600, jitter=120, timeout=300, label="Backup",
+         description="Copies the database into the backup folder and prunes old copies.")
+register("quick_check", quick_check, 900, jitter=60, timeout=120, label="Quick check",
+         description="PRAGMA quick_check on the live database.")
+register("full_check", pragma_checks, 6 * 3600, jitter=600, timeout=900, label="Full check",
+         description="PRAGMA integrity_check and foreign_key_check.")
+register("optimize", optimize, 3600, jitter=120, timeout=120, label="Optimize",
+         description="PRAGMA optimize to refresh query planner statistics.")
+register("vacuum", vacuum, 86400, jitter=1800, timeout=1800, label="Vacuum",
+         description="Rebuilds the database file to reclaim free pages.")
+register("orphan_scan", _orphan_scan, 3600, jitter=120, timeout=300, label="Orphan scan",
+         description="Normalizes secrets and reports empty names and orphaned secrets.")
+register("wal_checkpoint", checkpoint_if_needed, 120, jitter=10, timeout=120, label="WAL checkpoint",
+         description="PASSIVE checkpoint when idle, TRUNCATE once the WAL grows past the threshold.",
+         idle_aware=True)
+register("password_migration", _password_migration, 3600, jitter=120, timeout=600, label="Password migration",
+         description="Hashes legacy plaintext passwords; empty ones are locked until reset.")
+register("log_cleanup", _log_cleanup, 3600, jitter=300, timeout=1800, label="Log cleanup",
+         description="Compresses past log days, removes the oldest past the age or size limit and builds search indexes.")
+
+# ---- on-demand tasks ------------------------------------------------------
+# What the Database page's buttons run: same worker process and maintenance
+# lock as the jobs, but started by an admin who waits for the result.
+# A task tied to a job counts as a run of that job, so it shows up in
+# list_jobs() and pushes the job's next run back.
+def _integrity():
+    with connect() as db:
+        result = db.execute("PRAGMA integrity_check").fetchone()
+        fk_issues = len(db.execute("PRAGMA foreign_key_check").fetchall())
+    ok = bool(result) and result[0].lower() == "ok"
+    orphans = check_orphans()
+    return {"ok": ok, "fk_issues": fk_issues, "orphans": orphans, "issues": (not ok) + fk_issues + orphans}
+
+def _repair():
+    normalize_secrets()
+    with connect() as db:
+        db.execute("REINDEX")
+
+def _backup_now():
+    dest = backup_db()
+    return {"backup": os.path.basename(dest) if dest else None}
+
+def register_task(name, func, timeout=300, job=None):
+    TASKS[name] = {"name": name, "func": func, "timeout": timeout, "job": job}
+
+register_task("vacuum", vacuum, timeout=1800, job="vacuum")
+register_task("integrity", _integrity, timeout=900, job="full_check")
+register_task("repair", _repair, timeout=300)
+register_task("backup", _backup_now, timeout=300, job="backup")
+register_task("restore", restore_backup, timeout=600)
+
+def _persist(job):
+    st = load_state()
+    jobs = st.setdefault("jobs", {})
+    jobs[job["name"]] = {
+        "label": job["label"],
+        "interval": job["interval"],
+        "last_run": job["last_run"],
+        "next_run": job["next_run"],
+        "status": job["last_status"],
+        "error": job["last_error"],
+        "issues": job["issues"],
+        "durations": list(job["durations"]),
+    }
+    save_state(st)
+
+def _schedule_next(job, now, delay=None):
+    if delay is None:
+        delay = job["interval"] + random.uniform(0, job["jitter"])
+    job["next_run"] = now + delay
+
+def load_history():
+    jobs = load_state().get("jobs") or {}
+    now = time.time()
+    with _jobs_lock:
+        for name, job in JOBS.items():
+            saved = jobs.get(name) or {}
+            job["last_run"] = saved.get("last_run")
+            job["last_status"] = saved.get("status")
+            job["last_error"] = saved.get("error")
+            job["issues"] = saved.get("issues") or 0
+            # replace, not append: start.py reloads before every manual run
+            job["durations"].clear()
+            job["durations"].extend(saved.get("durations") or [])
+            if job["last_run"]:
+                due = job["last_run"] + job["interval"]
+                job["next_run"] = max(due, now + STARTUP_DELAY)
+            else:
+                _schedule_next(job, now, STARTUP_DELAY + random.uniform(0, job["jitter"]))
+
+def _run_local(name, idle_for=None):
+    """Worker side: run one job under the maintenance lock and time it."""
+    job = JOBS.get(name)
+    if job is None:
+        return {"status": "error", "error": f"unknown job {name}", "issues": 0, "duration_ms": 0}
+    if not acquire_lock():
+        return {"status": "skipped", "error": None, "issues": 0, "duration_ms": 0}
+    t0 = time.perf_counter()
+    status, error, issues = "ok", None, 0
+    try:
+        issues = (job["func"](idle_for) if job["idle_aware"] else job["func"]()) or 0
+        if issues:
+            status = "issues"
+    except Exception as e:
+        status, error = "error", str(e)
+        logger.exception("maintenance job %s failed: %s", name, e)
+    finally:
+        release_lock()
+    dt = round((time.perf_counter() - t0) * 1000)
+    logger.info("maintenance job %s finished status=%s duration_ms=%d", name, status, dt)
+    return {"status": status, "error": error, "issues": issues, "duration_ms": dt}
+
+def _run_task_local(name, args):
+    """Worker side: the same for a task, which also returns what its
+    function did (a JSON-safe dict or None)."""
+    task = TASKS.get(name)
+    if task is None:
+        return {"status": "error", "error": f"unknown task {name}", "issues": 0, "duration_ms": 0, "result": None}
+    if not acquire_lock():
+        return {"status": "skipped", "error": None, "issues": 0, "duration_ms": 0, "result": None}
+    t0 = time.perf_counter()
+    status, error, result = "ok", None, None
+    try:
+        result = task["func"](*args)
+    except Exception as e:
+        status, error = "error", str(e)
+        logger.exception("maintenance task %s failed: %s", name, e)
+    finally:
+        release_lock()
+    issues = (result or {}).get("issues") or 0
+    if issues:
+        status = "issues"
+    dt = round((time.perf_counter() - t0) * 1000)
+    logger.info("maintenance task %s finished status=%s duration_ms=%d", name, status, dt)
+    return {"status": status, "error": error, "issues": issues, "duration_ms": dt, "result": result}
+
+def _worker_reader(proc, out):
+    for line in proc.stdout:
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            continue
+        if "log" in msg:
+            ingest(msg["log"])
+        else:
+            out.put(msg)
+    out.put(None)
+
+def _worker_start():
+    proc = _worker["proc"]
+    if proc is not None and proc.poll() is None:
+        return proc
+    proc = subprocess.Popen(
+        WORKER_CMD,
+        cwd=BASE_DIR,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+    )
+    _worker["proc"] = proc
+    _worker["results"] = queue.Queue()
+    threading.Thread(target=_worker_reader, args=(proc, _worker["results"]), daemon=True).start()
+    logger.info("maintenance worker started pid=%d", proc.pid)
+    return proc
+
+def _worker_kill():
+    proc = _worker["proc"]
+    _worker["proc"] = None
+    if proc is None:
+        return
+    try:
+        proc.kill()
+        proc.wait(5)
+    except Exception:
+        pass
+
+def _request(msg, what, timeout):
+    """Supervisor side, caller holds _worker_lock: hand one request to the
+    worker process and wait for its result. A request that overruns its
+    timeout gets the worker killed, which is the only way to really stop a
+    stuck VACUUM or integrity check. The kernel drops the dead worker's
+    flock, so the next job isn't blocked by it."""
+    try:
+        proc = _worker_start()
+        proc.stdin.write(json.dumps(msg) + "\n")
+        proc.stdin.flush()
+    except Exception as e:
+        _worker_kill()
+        return {"status": "error", "error": f"could not reach maintenance worker: {e}", "issues": 0, "duration_ms": 0}
+    try:
+        result = _worker["results"].get(timeout=timeout)
+    except queue.Empty:
+        logger.critical("maintenance %s exceeded its %ds timeout, killing worker pid=%d", what, timeout, proc.pid)
+        _worker_kill()
+        return {"status": "timeout", "error": f"exceeded {timeout}s", "issues": 0, "duration_ms": timeout * 1000}
+    if result is None:
+        _worker_kill()
+        return {"status": "error", "error": "maintenance worker exited", "issues": 0, "duration_ms": 0}
+    return result
+
+def _dispatch(job, idle_for=None):
+    with _worker_lock:
+        return _request({"job": job["name"], "idle_for": idle_for}, f"job {job['name']}", job["timeout"])
+
+def _record(job, result, now):
+    # caller holds _jobs_lock
+    job["last_run"] = now
+    job["last_error"] = result.get("error")
+    job["issues"] = result.get("issues") or 0
+    job["durations"].append(result.get("duration_ms") or 0)
+    _schedule_next(job, now)
+    _persist(job)
+
+def _execute(job):
+    name = job["name"]
+    with _jobs_lock:
+        # a manual run shouldn't wait for the server to go quiet
+        idle_for = None if job["manual"] else _idle_for()
+        job["manual"] = False
+    result = _dispatch(job, idle_for)
+    now = time.time()
+    with _jobs_lock:
+        job["running"] = False
+        job["last_status"] = result["status"]
+        if result["status"] == "skipped":
+            logger.warning("skip maintenance job %s, lock present", name)
+            _schedule_next(job, now, LOCK_RETRY_SECONDS)
+        else:
+            _record(job, result, now)
+    _changed()
+
+def run_job(name, wait=True):
+    """Start a job now. Returns False if it is unknown or already running."""
+    with _jobs_lock:
+        job = JOBS.get(name)
+        if job is None or job["running"]:
+            return False
+        job["running"] = True
+        job["last_status"] = "running"
+    _changed()
+    worker = threading.Thread(target=_execute, args=(job,), daemon=True, name=f"job-{name}")
+    worker.start()
+    if wait:
+        worker.join()
+    return True
+
+def run_task(name, *args):
+    """Run an on-demand task in the maintenance worker and wait for it.
+    Returns the worker's result: status ok, issues, error, timeout, or
+    skipped when the maintenance lock or the worker stayed busy."""
+    task = TASKS.get(name)
+    if task is None:
+        return {"status": "error", "error": f"unknown task {name}", "issues": 0, "duration_ms": 0, "result": None}
+    if _remote["ask"] is not None:
+        answer = _remote["ask"]("task", {"name": name, "args": list(args)}, task["timeout"] + TASK_WAIT_SECONDS + 5)
+        return answer or {"status": "error", "error": "no answer from the server master", "issues": 0, "duration_ms": 0, "result": None}
+    if not _worker_lock.acquire(timeout=TASK_WAIT_SECONDS):
+        return {"status": "skipped", "error": None, "issues": 0, "duration_ms": 0, "result": None}
+    try:
+        result = _request({"task": name, "args": list(args)}, f"task {name}", task["timeout"])
+    finally:
+        _worker_lock.release()
+    job = JOBS.get(task["job"])
+    if job is not None and result["status"] in ("ok", "issues"):
+        with _jobs_lock:
+            if not job["running"]:
+                job["last_status"] = result["status"]
+            _record(job, result, time.time())
+        _changed()
+    return result
+
+def trigger(name):
+    """Queue a job to run on the scheduler thread as soon as possible."""
+    if _remote["send"] is not None:
+        if name not in JOBS:
+            return False
+        _remote["send"]("job", {"name": name})
+        return True
+    with _jobs_lock:
+        job = JOBS.get(name)
+        if job is None:
+            return False
+        job["next_run"] = 0
+        job["manual"] = True
+    _wake.set()
+    return True
+
+def _loop():
+    while True:
+        now = time.time()
+        with _jobs_lock:
+            due = sorted(
+                (j for j in JOBS.values() if not j["running"] and j["next_run"] is not None and j["next_run"] <= now),
+                key=lambda j: j["next_run"],
+            )
+        for job in due:
+            try:
+                run_job(job["name"])
+            except Exception as e:
+                logger.critical("maintenance scheduler error in %s: %s", job["name"], e)
+        with _jobs_lock:
+            pending = [j["next_run"] for j in JOBS.values() if j["next_run"] is not None and not j["running"]]
+        wait = min([TICK_SECONDS] + [max(0.0, t - time.time()) for t in pending])
+        _wake.wait(wait)
+        _wake.clear()
+
+def start():
+    if _runner["thread"] is not None and _runner["thread"].is_alive():
+        return
+    ensure_dirs()
+    init_db()
+    load_history()
+    t = threading.Thread(target=_loop, daemon=True, name="maintenance-scheduler")
+    _runner["thread"] = t
+    t.start()
+    logger.info("maintenance scheduler started with %d jobs", len(JOBS))
+
+def _avg(values):
+    return round(sum(values) / len(values)) if values else None
+
+def list_jobs():
+    if _remote["jobs"] is not None:
+        return _remote["jobs"]
+    with _jobs_lock:
+        out = []
+        for job in JOBS.values():
+            durations = list(job["durations"])
+            out.append({
+                "name": job["name"],
+                "label": job["label"],
+                "description": job["description"],
+                "interval": job["interval"],
+                "jitter": job["jitter"],
+                "timeout": job["timeout"],
+                "running": job["running"],
+                "status": job["last_status"],
+                "error": job["last_error"],
+                "issues": job["issues"],
+                "last_run": job["last_run"],
+                "next_run": job["next_run"],
+                "last_ms": durations[-1] if durations else None,
+                "avg_ms": _avg(durations),
+                "max_ms": max(durations) if durations else None,
+                "durations": durations,
+            })
+        return out
+
+def worker_main():
+    """Entry point of the maintenance child process: one JSON job request per
+    stdin line, one JSON result per stdout line. Exits when the parent closes
+    the pipe (or dies). Log records go up the same pipe as {"log": doc}
+    lines, so the server writes them (app.jsonl included) and its live
+    log stream sees them."""
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    out_lock = threading.Lock()
+
+    def send(msg):
+        with out_lock:
+            out.write(json.dumps(msg) + "\n")
+            out.flush()
+
+    forward_to(lambda doc: send({"log": doc}))
+    ensure_dirs()
+    init_db()
+    for line in sys.stdin:
+        try:
+            req = json.loads(line)
+        except ValueError:
+            continue
+        if "task" in req:
+            send(_run_task_local(req.get("task"), req.get("args") or []))
+        else:
+            send(_run_local(req.get("job"), req.get("idle_for")))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        worker_main()
@@ -2,10 +2,11 @@
 """
 Dev CLI for testing the OTP manager at scale.
 
-Seeds/clears fake OTP secrets (and companies/pins), and measures the
+Seeds/clears fake OTP secrets (and companies/pins), measures the
 server-side cost of building the /api/secrets response at the current
-vault size. Fake data is always name-tagged with a prefix so `clear`
-can never touch real secrets.
+vault size, and calibrates the bcrypt cost factor for this machine.
+Fake data is always name-tagged with a prefix so `clear` can never
+touch real secrets.
 
 Usage:
     python3 scripts/devtool.py seed 700
@@ -13,14 +14,26 @@ Usage:
     python3 scripts/devtool.py stats
     python3 scripts/devtool.py bench
     python3 scripts/devtool.py clear
+    python3 scripts/devtool.py calibrate --target-ms 250
+    python3 scripts/devtool.py serve-bench --clients 16 --seconds 10
+    python3 scripts/devtool.py serve-bench --modes production,prefork --workers 4
+    python3 scripts/devtool.py ws-bench --clients 300
 """
 import argparse
+import base64
+import http.client
 import json
 import os
 import random
 import re
+import selectors
+import signal
+import socket
 import sqlite3
+import struct
+import subprocess
 import sys
+import threading
 import time
 
 import pyotp
@@ -28,6 +41,7 @@ import pyotp
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 BASE_DIR = os.path.dirname(SCRIPT_DIR)
 DB_PATH = os.path.join(BASE_DIR, "instance", "otp.db")
+SETTINGS_PATH = os.path.join(BASE_DIR, "settings.json")
 
 # tracks which company_ids this tool created, since fake companies get
 # realistic-looking names (no "[TEST]" tag) and so can't be found by name
@@ -417,6 +431,365 @@ def cmd_bench(args):
     print(dim("  polled roughly every 30s per open tab/sidebar"))
 
 
+def cmd_calibrate(args):
+    header(f"Calibrating bcrypt cost (target {args.target_ms:.0f}ms per hash)")
+    try:
+        import bcrypt
+    except ImportError:
+        err("bcrypt is not installed (pip install bcrypt)")
+        return
+
+    # each extra round doubles the cost, so stop once we're clearly past the target
+    results = []
+    for rounds in range(args.min_rounds, args.max_rounds + 1):
+        times = []
+        for _ in range(args.samples):
+            t0 = time.perf_counter()
+            bcrypt.hashpw(b"calibration-password", bcrypt.gensalt(rounds=rounds))
+            times.append((time.perf_counter() - t0) * 1000)
+        times.sort()
+        results.append((rounds, times[len(times) // 2]))
+        if times[len(times) // 2] > args.target_ms * 2:
+            break
+
+    fitting = [r for r, ms in results if ms <= args.target_ms]
+    chosen = max(fitting) if fitting else args.min_rounds
+    slowest = max(ms for _, ms in results)
+
+    def bar_line(rounds, ms):
+        width = 24
+        filled = int(width * min(1.0, ms / slowest)) if slowest else 0
+        bar = (green if ms <= args.target_ms else yellow)("█" * filled) + gray("░" * (width - filled))
+        mark = f"  {lavender('◂ chosen')}" if rounds == chosen else ""
+        return f"{pad(f'cost {rounds}', 9)} {bar} {bold(f'{ms:.1f}ms')}{mark}"
+
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            settings = json.load(f) or {}
+    except (OSError, ValueError):
+        settings = {}
+    current = settings.get("bcrypt_rounds")
+
+    box("bcrypt cost", [bar_line(r, ms) for r, ms in results] + [
+        "",
+        f"Current         {bold(str(current) if current else '12 (default)')}",
+        f"Chosen          {bold(green(str(chosen)))}",
+    ])
+    if not fitting:
+        warn(f"Even cost {args.min_rounds} is slower than {args.target_ms:.0f}ms; using the floor.")
+
+    if args.dry_run:
+        info("Dry run, settings.json not changed.")
+        return
+    settings["bcrypt_rounds"] = chosen
+    with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False, indent=2)
+    ok(f"Saved bcrypt_rounds={chosen} to settings.json")
+    print(dim("  restart the server to apply; existing hashes are upgraded on next login"))
+
+
+# ---------------------------------------------------------------------------
+# HTTP throughput: development (socketio.run + debugger/reloader) vs
+# production (wsgiserver pool). Each mode gets its own app.py process on a
+# spare loopback port, run against the real database and stopped after.
+# ---------------------------------------------------------------------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_http(port, path, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", path)
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.25)
+    return False
+
+
+def _start_app(mode, port, threads, workers=0, async_mode="threading"):
+    # "prefork" is production mode with worker processes (see prefork.py)
+    env = os.environ.copy()
+    env.pop("WERKZEUG_RUN_MAIN", None)
+    env.pop("WERKZEUG_SERVER_FD", None)
+    env["OTP_HOST"] = "127.0.0.1"
+    env["OTP_PORT"] = str(port)
+    env["OTP_SERVER_MODE"] = "production" if mode == "prefork" else mode
+    env["OTP_WORKERS"] = str(workers if mode == "prefork" else 0)
+    env["OTP_SOCKETIO_ASYNC"] = async_mode
+    if threads:
+        env["OTP_SERVER_THREADS"] = str(threads)
+    return subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, "app.py")],
+        cwd=BASE_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def _stop_app(proc):
+    # the dev reloader forks a child that serves, so signal the whole group
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGTERM)
+        else:
+            proc.terminate()
+        proc.wait(timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        if hasattr(os, "killpg"):
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        else:
+            proc.kill()
+
+
+def _load(port, path, clients, seconds):
+    """`clients` keep-alive connections issuing GETs back to back."""
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+    deadline = time.perf_counter() + seconds
+
+    def worker(i):
+        conn = None
+        while time.perf_counter() < deadline:
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+                t0 = time.perf_counter()
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+                latencies[i].append(time.perf_counter() - t0)
+                if resp.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                errors[i] += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    flat = sorted(ms * 1000 for per in latencies for ms in per)
+
+    def pct(p):
+        return flat[min(len(flat) - 1, int(len(flat) * p))] if flat else 0.0
+
+    return {
+        "requests": len(flat),
+        "errors": sum(errors),
+        "rps": len(flat) / elapsed if elapsed else 0.0,
+        "p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99),
+    }
+
+
+def cmd_serve_bench(args):
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    header(f"HTTP throughput: GET {args.path}, {args.clients} clients, {args.seconds:.0f}s per mode")
+    results = {}
+    for mode in modes:
+        port = _free_port()
+        proc = _start_app(mode, port, args.threads, args.workers)
+        try:
+            if not _wait_http(port, args.path):
+                err(f"{mode}: app.py did not answer on port {port}")
+                continue
+            _load(port, args.path, args.clients, min(2.0, args.seconds))  # warm-up
+            results[mode] = _load(port, args.path, args.clients, args.seconds)
+            ok(f"{mode}: {results[mode]['rps']:.0f} req/s")
+        finally:
+            _stop_app(proc)
+
+    if not results:
+        return
+    best = max(r["rps"] for r in results.values())
+    lines = []
+    for mode, r in results.items():
+        width = 24
+        filled = int(width * (r["rps"] / best)) if best else 0
+        bar = cyan("█" * filled) + gray("░" * (width - filled))
+        rps = f"{r['rps']:.0f} req/s"
+        lines.append(f"{pad(mode, 12)} {bar} {bold(rps)}")
+        lines.append(gray(f"{'':12} p50 {r['p50']:.1f}ms · p95 {r['p95']:.1f}ms · p99 {r['p99']:.1f}ms · "
+                          f"{r['requests']} ok · {r['errors']} errors"))
+    if "development" in results and "production" in results and results["development"]["rps"]:
+        ratio = results["production"]["rps"] / results["development"]["rps"]
+        lines += ["", f"production / development  {bold(green(f'{ratio:.2f}x'))}"]
+    if "production" in results and "prefork" in results and results["production"]["rps"]:
+        ratio = results["prefork"]["rps"] / results["production"]["rps"]
+        lines += [f"prefork / production      {bold(green(f'{ratio:.2f}x'))}"]
+    box("serve-bench", lines)
+
+
+# ---------------------------------------------------------------------------
+# Memory per websocket client: threading (a wsgiserver thread per socket)
+# vs gevent (a greenlet per socket, see asyncmode.py), both in production
+# mode. Opens N Socket.IO websockets on the default namespace, answers the
+# server's pings while holding them, and reads the app process's RSS and
+# thread count from /proc before and after. Linux only.
+# ---------------------------------------------------------------------------
+class _WsClient:
+    """Just enough Socket.IO over a raw websocket to stay connected:
+    the upgrade, engine.io open, namespace connect and pongs."""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((
+            "GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+        self.buf = b""
+        while b"\r\n\r\n" not in self.buf:
+            self._fill()
+        head, self.buf = self.buf.split(b"\r\n\r\n", 1)
+        if b" 101 " not in head.split(b"\r\n", 1)[0] + b" ":
+            self.sock.close()
+            raise OSError(head.split(b"\r\n", 1)[0].decode(errors="replace"))
+        self.recv()          # engine.io open: 0{"sid":...}
+        self.send("40")      # socket.io connect to "/"
+        self.recv()          # 40{"sid":...}
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise OSError("connection closed")
+        self.buf += chunk
+
+    def _take(self, n):
+        while len(self.buf) < n:
+            self._fill()
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def recv(self):
+        b0, b1 = self._take(2)
+        size = b1 & 0x7F
+        if size == 126:
+            size = struct.unpack("!H", self._take(2))[0]
+        elif size == 127:
+            size = struct.unpack("!Q", self._take(8))[0]
+        return self._take(size)
+
+    def send(self, text):
+        # client frames are masked; everything sent here is < 126 bytes
+        payload = text.encode()
+        mask = os.urandom(4)
+        self.sock.sendall(bytes([0x81, 0x80 | len(payload)]) + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def _ws_pong_loop(clients, stop):
+    sel = selectors.DefaultSelector()
+    for c in clients:
+        sel.register(c.sock, selectors.EVENT_READ, c)
+    while not stop.is_set():
+        for key, _ in sel.select(timeout=0.5):
+            c = key.data
+            try:
+                if c.recv() == b"2":
+                    c.send("3")
+            except OSError:
+                sel.unregister(c.sock)
+    sel.close()
+
+
+def _proc_status(pid):
+    out = {}
+    with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "Threads"):
+                out[key] = int(value.split()[0])
+    return out
+
+
+def cmd_ws_bench(args):
+    if not os.path.isdir("/proc/self"):
+        err("ws-bench reads /proc, so it only runs on Linux")
+        return
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    header(f"Memory per websocket client: {args.clients} clients held {args.seconds:.0f}s per mode")
+    results = {}
+    for mode in modes:
+        port = _free_port()
+        # threading mode keeps a pool thread per open websocket
+        count = min(args.clients, 480) if mode == "threading" else args.clients
+        if count < args.clients:
+            warn(f"{mode}: capped at {count} clients (wsgiserver.MAX_THREADS)")
+        proc = _start_app("production", port, count + 32, async_mode=mode)
+        clients = []
+        try:
+            if not _wait_http(port, "/login"):
+                err(f"{mode}: app.py did not answer on port {port}")
+                continue
+            _load(port, "/login", 4, 1.0)  # warm-up
+            time.sleep(1.0)
+            before = _proc_status(proc.pid)
+            failed = 0
+            for _ in range(count):
+                try:
+                    clients.append(_WsClient(port))
+                except OSError:
+                    failed += 1
+            stop = threading.Event()
+            pong = threading.Thread(target=_ws_pong_loop, args=(clients, stop), daemon=True)
+            pong.start()
+            time.sleep(args.seconds)
+            held = _proc_status(proc.pid)
+            stop.set()
+            pong.join()
+            per_kb = (held["VmRSS"] - before["VmRSS"]) / len(clients) if clients else 0.0
+            results[mode] = {
+                "clients": len(clients), "failed": failed, "per_kb": per_kb,
+                "rss_before": before["VmRSS"], "rss_held": held["VmRSS"], "threads": held["Threads"],
+            }
+            ok(f"{mode}: {len(clients)} clients, {per_kb:.0f} KB per client")
+        finally:
+            for c in clients:
+                c.close()
+            _stop_app(proc)
+
+    if not results:
+        return
+    worst = max(r["per_kb"] for r in results.values()) or 1.0
+    lines = []
+    for mode, r in results.items():
+        width = 24
+        filled = max(0, int(width * r["per_kb"] / worst))
+        bar = cyan("█" * filled) + gray("░" * (width - filled))
+        per = f"{r['per_kb']:.0f} KB/client"
+        lines.append(f"{pad(mode, 10)} {bar} {bold(per)}")
+        lines.append(gray(f"{'':10} RSS {r['rss_before'] / 1024:.1f} → {r['rss_held'] / 1024:.1f} MB · "
+                          f"{r['threads']} threads · {r['clients']} open · {r['failed']} failed"))
+    if "threading" in results and "gevent" in results and results["gevent"]["per_kb"] > 0:
+        ratio = results["threading"]["per_kb"] / results["gevent"]["per_kb"]
+        lines += ["", f"threading / gevent  {bold(green(f'{ratio:.1f}x'))} memory per client"]
+    box("ws-bench", lines)
+
+
 def ask(msg, default=None, cast=str):
     label = msg + (f" [{default}]" if default is not None else "")
     raw = input(f"  {cyan('?')} {label}: ").strip()
@@ -443,6 +816,7 @@ def interactive_menu():
         ("2", "Show vault stats", cmd_stats),
         ("3", "Benchmark /api/secrets", cmd_bench),
         ("4", "Clear fake data", cmd_clear),
+        ("5", "Calibrate bcrypt cost", cmd_calibrate),
     ]
     ran_command = False
     while True:
@@ -474,6 +848,10 @@ def interactive_menu():
         elif choice == "4":
             cmd_clear(argparse.Namespace(prefix=DEFAULT_PREFIX, yes=False))
             ran_command = True
+        elif choice == "5":
+            target = ask("Target milliseconds per hash?", 250.0, float)
+            cmd_calibrate(argparse.Namespace(target_ms=target, min_rounds=10, max_rounds=16, samples=3, dry_run=False))
+            ran_command = True
         else:
             warn("Unknown option.")
             ran_command = True
@@ -503,6 +881,29 @@ def main():
     p_bench = sub.add_parser("bench", help="measure server-side cost of building /api/secrets at current vault size")
     p_bench.set_defaults(func=cmd_bench)
 
+    p_srv = sub.add_parser("serve-bench", help="compare HTTP throughput of the development, production and prefork server modes")
+    p_srv.add_argument("--modes", default="development,production", help="comma-separated modes to run (default: development,production)")
+    p_srv.add_argument("--clients", type=int, default=16, help="concurrent keep-alive clients (default: 16)")
+    p_srv.add_argument("--seconds", type=float, default=10.0, help="measurement time per mode (default: 10)")
+    p_srv.add_argument("--path", default="/login", help="path to GET (default: /login)")
+    p_srv.add_argument("--threads", type=int, default=0, help="production pool size (default: settings.json)")
+    p_srv.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="worker processes for the prefork mode (default: CPU count)")
+    p_srv.set_defaults(func=cmd_serve_bench)
+
+    p_ws = sub.add_parser("ws-bench", help="compare server memory per open websocket in the threading and gevent Socket.IO modes")
+    p_ws.add_argument("--modes", default="threading,gevent", help="comma-separated Socket.IO async modes (default: threading,gevent)")
+    p_ws.add_argument("--clients", type=int, default=200, help="websockets to hold open; threading mode caps at 480 (default: 200)")
+    p_ws.add_argument("--seconds", type=float, default=5.0, help="how long to hold them before measuring (default: 5)")
+    p_ws.set_defaults(func=cmd_ws_bench)
+
+    p_cal = sub.add_parser("calibrate", help="benchmark bcrypt cost factors and save the best fit to settings.json")
+    p_cal.add_argument("--target-ms", type=float, default=250.0, help="target latency per hash (default: 250)")
+    p_cal.add_argument("--min-rounds", type=int, default=10, help="lowest cost to consider (default: 10)")
+    p_cal.add_argument("--max-rounds", type=int, default=16, help="highest cost to consider (default: 16)")
+    p_cal.add_argument("--samples", type=int, default=3, help="hashes timed per cost (default: 3)")
+    p_cal.add_argument("--dry-run", action="store_true", help="print the result without saving it")
+    p_cal.set_defaults(func=cmd_calibrate)
+
     parser.add_argument("--no-color", action="store_true", help="disable colored output")
 
     args = parser.parse_args()
@@ -0,0 +1,113 @@
+import re
+import threading
+import time
+from collections import deque
+
+import metrics
+from logger import logger
+
+# ---- slow-query profiler ---------------------------------------------------
+# Opt-in (settings.json "sql_profile", or the toggle on the Database page).
+# When on, metrics.TimedCursor hands every statement and its duration to
+# record(), which folds it into a row per normalized statement (literals
+# replaced by ?, IN lists collapsed, whitespace squeezed) and logs any run
+# over the slow threshold. Only the normalized text is kept or logged, so
+# bound values and inline literals never reach the page or the log file.
+# When off, the hook is unset and the only cost left is one dict lookup per
+# statement in TimedCursor.
+SLOW_MS = 100
+MAX_STATEMENTS = 500
+SAMPLES = 256
+NORMALIZED_MAX = 2048
+OTHER = "(other statements)"
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+_lock = threading.Lock()
+_settings = {"enabled": False, "slow_ms": SLOW_MS}
+_statements = {}
+_normalized = {}
+_started = {"at": time.time()}
+
+def settings_from(data):
+    """(enabled, slow_ms) from a settings.json dict."""
+    data = data or {}
+    try:
+        slow_ms = max(1, int(data.get("sql_slow_ms") or SLOW_MS))
+    except (TypeError, ValueError):
+        slow_ms = SLOW_MS
+    return bool(data.get("sql_profile")), slow_ms
+
+def configure(enabled, slow_ms=None):
+    _settings["enabled"] = bool(enabled)
+    if slow_ms is not None:
+        _settings["slow_ms"] = slow_ms
+    metrics.set_query_hook(record if enabled else None)
+
+def normalize(sql):
+    norm = _normalized.get(sql)
+    if norm is None:
+        norm = _STRING_RE.sub("?", sql)
+        norm = _NUMBER_RE.sub("?", norm)
+        norm = _IN_LIST_RE.sub("(?, ...)", norm)
+        norm = _SPACE_RE.sub(" ", norm).strip()
+        if len(_normalized) >= NORMALIZED_MAX:
+            _normalized.clear()
+        _normalized[sql] = norm
+    return norm
+
+def record(sql, elapsed):
+    ms = elapsed * 1000
+    norm = normalize(sql)
+    with _lock:
+        row = _statements.get(norm)
+        if row is None:
+            if len(_statements) >= MAX_STATEMENTS:
+                norm = OTHER
+                row = _statements.get(OTHER)
+            if row is None:
+                row = _statements[norm] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0, "samples": deque(maxlen=SAMPLES)}
+        row["count"] += 1
+        row["total_ms"] += ms
+        if ms > row["max_ms"]:
+            row["max_ms"] = ms
+        row["samples"].append(ms)
+        slow = ms >= _settings["slow_ms"]
+        if slow:
+            row["slow"] += 1
+    if slow:
+        logger.warning("Slow query (%.1f ms): %s", ms, norm)
+
+def _pct(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2)
+
+def stats():
+    with _lock:
+        rows = [(sql, dict(row, samples=list(row["samples"]))) for sql, row in _statements.items()]
+    statements = [{
+        "sql": sql,
+        "count": row["count"],
+        "slow": row["slow"],
+        "total_ms": round(row["total_ms"], 1),
+        "mean_ms": round(row["total_ms"] / row["count"], 2),
+        "max_ms": round(row["max_ms"], 2),
+        "p95_ms": _pct(row["samples"], 0.95),
+    } for sql, row in rows]
+    statements.sort(key=lambda s: -s["total_ms"])
+    return {
+        "enabled": _settings["enabled"],
+        "slow_ms": _settings["slow_ms"],
+        "since": _started["at"],
+        "statements": statements,
+    }
+
+def reset():
+    with _lock:
+        _statements.clear()
+        _started["at"] = time.time()
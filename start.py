@@ -11,6 +11,7 @@ import threading
 from datetime import datetime
 import re
 import socket
+import struct
 import urllib.request
 import urllib.error
 import ssl
@@ -34,6 +35,7 @@ APP_PY_PATH = os.path.join(BASE_DIR, "app.py")
 VERSION_PATH = os.path.join(BASE_DIR, "VERSION")
 SETTINGS_PATH = os.path.join(BASE_DIR, "settings.json")
 UPDATE_STATUS_PATH = os.path.join(BASE_DIR, "otp-server.update-status.json")
+MAINTENANCE_STATE_PATH = os.path.join(BASE_DIR, "instance", "maintenance_state.json")
 
 PYTHON = sys.executable or "python3"
 APP_CMD = [PYTHON, os.path.join(BASE_DIR, "app.py")]
@@ -80,6 +82,7 @@ DB_STATUS_CACHE = {
     "schema_msg": "—",
     "int_ok": None,
     "int_msg": "—",
+    "wal": None,
     "last_check_ts": 0.0,
 }
 DB_STATUS_INTERVAL = 10  # re-check every 10 seconds
@@ -170,6 +173,14 @@ def clear():
         return
     os.system("cls" if os.name == "nt" else "clear")
 
+# "production" serves without the Werkzeug debugger/reloader on a fixed
+# thread pool (see wsgiserver.py); "development" is the old socketio.run
+SERVER_MODES = ("development", "production")
+# production only: N > 0 forks N worker processes (see prefork.py)
+MAX_WORKERS = 64
+# app.py's asyncmode.ASYNC_MODES
+SOCKETIO_ASYNC_MODES = ("threading", "gevent")
+
 def get_default_settings():
     return {
         "host": "0.0.0.0",
@@ -192,21 +203,44 @@ def read_settings():
     if not valid_port(port):
         port = defaults["port"]
     secret_key = str(data.get("secret_key") or defaults["secret_key"]).strip() or defaults["secret_key"]
+    server_mode = data.get("server_mode") if data.get("server_mode") in SERVER_MODES else "development"
+    try:
+        workers = max(0, min(MAX_WORKERS, int(data.get("workers") or 0)))
+    except (TypeError, ValueError):
+        workers = 0
+    socketio_async = data.get("socketio_async") if data.get("socketio_async") in SOCKETIO_ASYNC_MODES else "threading"
     return {
         "host": host,
         "port": port,
-        "secret_key": secret_key
+        "secret_key": secret_key,
+        "server_mode": server_mode,
+        "workers": workers,
+        "socketio_async": socketio_async
     }
 
-def write_settings(data):
+def mode_label(cfg):
+    if cfg["socketio_async"] == "gevent":
+        return f"{cfg['server_mode']}, gevent"
+    if cfg["server_mode"] == "production" and cfg["workers"]:
+        return f"production, {cfg['workers']} workers"
+    return cfg["server_mode"]
+
+def write_settings(data, keep_existing=True):
+    # keep keys this screen doesn't manage (company_name, bcrypt_rounds, ...)
     current = get_default_settings()
+    if keep_existing:
+        try:
+            with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+                current.update(json.load(f) or {})
+        except:
+            pass
     current.update(data or {})
     with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
         json.dump(current, f, ensure_ascii=False, indent=2)
 
 def ensure_settings_file():
     if not os.path.exists(SETTINGS_PATH):
-        write_settings(get_default_settings())
+        write_settings(get_default_settings(), keep_existing=False)
 
 def mask_secret(secret):
     secret = str(secret or "")
@@ -450,6 +484,8 @@ def start_server():
     host = cfg["host"]
     port = cfg["port"]
     secret_key = cfg["secret_key"]
+    server_mode = cfg["server_mode"]
+    workers = cfg["workers"]
 
     if not valid_port(port):
         return False, f"Invalid port: {port}"
@@ -481,6 +517,9 @@ def start_server():
     env["OTP_HOST"] = str(host)
     env["OTP_PORT"] = str(port)
     env["OTP_SECRET_KEY"] = str(secret_key)
+    env["OTP_SERVER_MODE"] = server_mode
+    env["OTP_WORKERS"] = str(workers)
+    env["OTP_SOCKETIO_ASYNC"] = cfg["socketio_async"]
 
     try:
         p = subprocess.Popen(
@@ -525,9 +564,11 @@ def start_server():
         "cmd": APP_CMD,
         "log": LOG_PATH,
         "host": host,
-        "port": port
+        "port": port,
+        "mode": server_mode,
+        "workers": workers
     })
-    return True, f"Started (PID {p.pid}) on port {port}.{schema_note}"
+    return True, f"Started (PID {p.pid}) on port {port} ({mode_label(cfg)}).{schema_note}"
 
 def stop_server(grace_seconds=6):
     pid = read_pid()
@@ -847,11 +888,13 @@ def maybe_refresh_db_status():
     def worker():
         s_ok, s_msg = get_db_status()
         i_ok, i_msg = get_db_integrity()
+        wal = get_db_wal()
         with DB_STATUS_LOCK:
             DB_STATUS_CACHE["schema_ok"]  = s_ok
             DB_STATUS_CACHE["schema_msg"] = s_msg
             DB_STATUS_CACHE["int_ok"]     = i_ok
             DB_STATUS_CACHE["int_msg"]    = i_msg
+            DB_STATUS_CACHE["wal"]        = wal
             DB_STATUS_CACHE["state"]      = "done"
             DB_STATUS_CACHE["last_check_ts"] = time.time()
 
@@ -1226,6 +1269,87 @@ def get_db_integrity():
     except Exception as e:
         return None, f"Check failed: {shorten_middle(str(e), 40)}"
 
+# database.WAL_TRUNCATE_BYTES
+WAL_TRUNCATE_BYTES = 16 * 1024 * 1024
+
+def get_db_wal():
+    """What database.wal_status() reports, read directly: the -wal size and
+    the wal-index header in -shm (mxFrame at 16, nBackfill at 96)."""
+    db_path = os.path.join(BASE_DIR, "instance", "otp.db")
+    try:
+        size = os.path.getsize(db_path + "-wal")
+    except OSError:
+        size = 0
+    try:
+        with open(MAINTENANCE_STATE_PATH, "r", encoding="utf-8") as f:
+            last_checkpoint = (json.load(f) or {}).get("last_checkpoint")
+    except:
+        last_checkpoint = None
+    out = {"size": size, "lag": None, "threshold": WAL_TRUNCATE_BYTES, "last_checkpoint": last_checkpoint}
+    try:
+        with open(db_path + "-shm", "rb") as f:
+            hdr = f.read(100)
+        if len(hdr) >= 100 and hdr[12]:
+            frames = struct.unpack_from("=I", hdr, 16)[0]
+            backfilled = struct.unpack_from("=I", hdr, 96)[0]
+            out["lag"] = frames - min(backfilled, frames)
+    except OSError:
+        pass
+    return out
+
+def wal_summary(wal):
+    if not wal:
+        return gray("—")
+    size = wal.get("size") or 0
+    txt = f"{size / 1024:.1f} KB" if size < 1024 * 1024 else f"{size / (1024 * 1024):.1f} MB"
+    mark = red("●") if size >= (wal.get("threshold") or 0) else green("✓")
+    extra = []
+    if wal.get("lag") is not None:
+        extra.append(f"lag {wal['lag']} frames")
+    cp = wal.get("last_checkpoint") or {}
+    if cp.get("at"):
+        extra.append(f"{cp.get('mode', '?')} {fmt_relative(cp['at'])}")
+    return f"{mark}  {txt}" + (gray("  " + " · ".join(extra)) if extra else "")
+
+def read_maintenance_jobs():
+    """Job history the server's maintenance scheduler persists after each run."""
+    try:
+        with open(MAINTENANCE_STATE_PATH, "r", encoding="utf-8") as f:
+            return (json.load(f) or {}).get("jobs") or {}
+    except:
+        return {}
+
+def fmt_relative(ts):
+    if not ts:
+        return "never"
+    delta = int(float(ts) - time.time())
+    n = abs(delta)
+    if n < 60:
+        txt = f"{n}s"
+    elif n < 3600:
+        txt = f"{n // 60}m"
+    elif n < 86400:
+        txt = f"{n // 3600}h"
+    else:
+        txt = f"{n // 86400}d"
+    return f"in {txt}" if delta >= 0 else f"{txt} ago"
+
+def jobs_summary():
+    jobs = read_maintenance_jobs()
+    if not jobs:
+        return gray("— no runs recorded")
+    failing = [j.get("label") or n for n, j in jobs.items() if j.get("status") in ("error", "timeout", "issues")]
+    upcoming = sorted(
+        (j for j in jobs.values() if j.get("next_run")),
+        key=lambda j: j["next_run"],
+    )
+    nxt = ""
+    if upcoming:
+        nxt = gray(f"  next {upcoming[0].get('label', '?')} {fmt_relative(upcoming[0]['next_run'])}")
+    if failing:
+        return red("✗") + f"  {len(failing)} failing ({shorten_middle(', '.join(failing), 30)}){nxt}"
+    return green("✓") + f"  {len(jobs)} ok{nxt}"
+
 HEALTH_STATUS_LOCK = threading.Lock()
 HEALTH_STATUS_CACHE = {
     "state": "idle",       # idle | checking | done
@@ -1336,6 +1460,7 @@ def draw_header():
         db_msg   = DB_STATUS_CACHE.get("schema_msg", "—")
         int_ok   = DB_STATUS_CACHE.get("int_ok")
         int_msg  = DB_STATUS_CACHE.get("int_msg", "—")
+        db_wal   = DB_STATUS_CACHE.get("wal")
 
     if db_state == "checking" and db_ok is None:
         spin   = spinner_frame()
@@ -1418,6 +1543,7 @@ def draw_header():
         sep,
         section_label("SERVER"),
         kv("Port", gray(str(cfg['port']))),
+        kv("Mode", gray(mode_label(cfg))),
     ]
 
     if not is_very_narrow:
@@ -1452,6 +1578,9 @@ def draw_header():
             kv("Schema", db_val),
             kv("Integrity", int_val),
         ]
+        if not is_short:
+            info_lines.append(kv("WAL", wal_summary(db_wal)))
+            info_lines.append(kv("Jobs", jobs_summary()))
 
     hints = f"{cyan('↵')} Open menu   {gray('X')} Exit"
     render_screen(None, info_lines, breadcrumb="Dashboard", hints=hints, big_title=True)
@@ -1862,7 +1991,6 @@ def _db_select_backup(db):
             selected = (selected + 1) % len(entries)
         elif key == "enter":
             _, name, size, path = entries[selected]
-            server_running = status()["running"]
             conf_lines = [
                 f"  {yellow('!')} This will overwrite the current live database.",
                 "",
@@ -1870,9 +1998,6 @@ def _db_select_backup(db):
                 f"  Size : {gray(fmt_size(size))}",
                 "",
             ]
-            if server_running:
-                conf_lines.append(f"  {yellow('!')} Server is running — it will be stopped and restarted.")
-                conf_lines.append("")
             conf_lines.append(f"  {dim('A security backup of the current DB will be saved first.')}")
             conf_lines.append("")
             conf_lines.append(dim("Press Y to confirm, any other key to cancel."))
@@ -1884,6 +2009,53 @@ def _db_select_backup(db):
             return None
 
 
+def jobs_menu():
+    try:
+        import scheduler
+    except Exception as e:
+        toast(f"Could not load scheduler: {e}", False)
+        return
+
+    selected = 0
+    breadcrumb = "Dashboard ▸ Menu ▸ Database Tools ▸ Scheduled Jobs"
+    hints = f"{cyan('↑↓/jk')} Move   {cyan('↵')} Run now   {gray('Esc')} Back"
+    names = list(scheduler.JOBS)
+
+    while True:
+        saved = read_maintenance_jobs()
+        lines = []
+        for idx, name in enumerate(names):
+            job = scheduler.JOBS[name]
+            hist = saved.get(name) or {}
+            durations = hist.get("durations") or []
+            st = hist.get("status") or "—"
+            st_txt = green(st) if st == "ok" else red(st) if st in ("error", "timeout", "issues") else gray(st)
+            timing = f"avg {round(sum(durations) / len(durations))}ms" if durations else "no runs"
+            label = f"{pad_visible(job['label'], 12)} {st_txt}  {gray(fmt_relative(hist.get('last_run')))}  {dim(timing)}"
+            lines.append(menu_line(str(idx + 1), label, idx == selected, color="cyan"))
+        render_screen("Scheduled Jobs", lines, breadcrumb=breadcrumb, hints=hints)
+
+        key = read_menu_key()
+        if key == "up":
+            selected = (selected - 1) % len(names)
+        elif key == "down":
+            selected = (selected + 1) % len(names)
+        elif key in ("esc", "b", "q"):
+            return
+        elif key == "enter" or (key and key.isdigit() and 1 <= int(key) <= len(names)):
+            if key != "enter":
+                selected = int(key) - 1
+            name = names[selected]
+            scheduler.load_history()
+            run_with_spinner(f"Running {scheduler.JOBS[name]['label']}", scheduler.run_job, name)
+            job = next(j for j in scheduler.list_jobs() if j["name"] == name)
+            ok = job["status"] == "ok"
+            if job["status"] == "skipped":
+                toast(f"{job['label']}: skipped, lock held", False)
+            else:
+                toast(f"{job['label']}: {job['status']} ({job['last_ms']} ms)", ok)
+
+
 def database_menu():
     try:
         db = _load_db_module()
@@ -1901,6 +2073,7 @@ def database_menu():
         {"key": "7", "choice": "7", "label": "Create backup", "color": "green"},
         {"key": "8", "choice": "8", "label": "List backups", "color": "cyan"},
         {"key": "9", "choice": "9", "label": "Load backup", "color": "red"},
+        {"key": "S", "choice": "s", "label": "Scheduled jobs", "color": "cyan"},
         {"key": "B", "choice": "0", "label": "Back", "color": "gray"},
     ]
 
@@ -1935,17 +2108,17 @@ def database_menu():
         if choice == "0":
             return
 
-        # Option 9: interactive select → stop server → restore → restart server
+        if choice == "s":
+            jobs_menu()
+            continue
+
+        # Option 9: interactive select → hot restore into the live database
+        # (the server keeps running; see database.restore_backup)
         if choice == "9":
             restore_path = _db_select_backup(db)
             if restore_path is None:
                 continue
 
-            server_was_running = status()["running"]
-            stop_msg = None
-            if server_was_running:
-                _, stop_msg = run_with_spinner("Stopping server", stop_server)
-
             import io
             buf = io.StringIO()
             old_stdout = sys.stdout
@@ -1957,21 +2130,14 @@ def database_menu():
             finally:
                 sys.stdout = old_stdout
 
-            start_msg = None
-            if server_was_running:
-                _, start_msg = run_with_spinner("Restarting server", start_server)
-
             out_lines = buf.getvalue().splitlines()
             while out_lines and not out_lines[0].strip():
                 out_lines.pop(0)
             while out_lines and not out_lines[-1].strip():
                 out_lines.pop()
-            if server_was_running:
+            if status()["running"]:
                 out_lines.append("")
-                if stop_msg:
-                    out_lines.append(f"  {dim('Stop')}    : {gray(stop_msg)}")
-                if start_msg:
-                    out_lines.append(f"  {dim('Restart')} : {gray(start_msg)}")
+                out_lines.append(f"  {dim('The running server picked up the restored data without a restart.')}")
             render_screen(
                 "Restore Backup", out_lines,
                 breadcrumb="Dashboard ▸ Menu ▸ Database Tools ▸ Restore Backup",
@@ -2042,6 +2208,9 @@ def settings_menu():
         {"key": "2", "choice": "2", "label": "Set secret", "color": "cyan"},
         {"key": "3", "choice": "3", "label": "Reset to defaults", "color": "red"},
         {"key": "4", "choice": "4", "label": "Set version", "color": "cyan"},
+        {"key": "5", "choice": "5", "label": "Toggle server mode", "color": "cyan"},
+        {"key": "6", "choice": "6", "label": "Set worker processes", "color": "cyan"},
+        {"key": "7", "choice": "7", "label": "Toggle websocket mode", "color": "cyan"},
         {"key": "B", "choice": "0", "label": "Back", "color": "gray"},
     ]
 
@@ -2058,6 +2227,7 @@ def settings_menu():
             kv("Port", gray(str(cfg['port']))),
             kv("Secret", gray(mask_secret(cfg['secret_key']))),
             kv("Version", gray(read_local_version())),
+            kv("Mode", gray(mode_label(cfg))),
             "",
         ]
 
@@ -2119,7 +2289,7 @@ def settings_menu():
             if status()["running"]:
                 toast("Stop the server before resetting settings.", False)
                 continue
-            write_settings(get_default_settings())
+            write_settings(get_default_settings(), keep_existing=False)
             toast("Settings reset.", True)
             continue
 
@@ -2144,6 +2314,47 @@ def settings_menu():
                 toast(f"Could not write VERSION: {e}", False)
             continue
 
+        if choice == "5":
+            value = "production" if cfg["server_mode"] == "development" else "development"
+            cfg["server_mode"] = value
+            write_settings(cfg)
+            if status()["running"]:
+                toast(f"Server mode set to {value}; restart the server to apply.", True)
+            else:
+                toast(f"Server mode set to {value}.", True)
+            continue
+
+        if choice == "6":
+            tw, _ = get_terminal_size()
+            prompt = (" " * max(0, (tw - 36) // 2)) + f"Worker processes (0 = one process) [{cfg['workers']}]: "
+            value = read_line_allow_escape(prompt)
+            if value is None or value.strip() == "" or value.strip().lower() == "b":
+                toast("Worker change cancelled.", False)
+                continue
+            value = value.strip()
+            if not value.isdigit() or int(value) > MAX_WORKERS:
+                toast(f"Invalid number. Use 0 to {MAX_WORKERS}.", False)
+                continue
+            cfg["workers"] = int(value)
+            write_settings(cfg)
+            note = "" if cfg["server_mode"] == "production" or not cfg["workers"] else " Only used in production mode."
+            if status()["running"]:
+                toast(f"Workers set to {value}; restart the server to apply.{note}", True)
+            else:
+                toast(f"Workers set to {value}.{note}", True)
+            continue
+
+        if choice == "7":
+            value = "gevent" if cfg["socketio_async"] == "threading" else "threading"
+            cfg["socketio_async"] = value
+            write_settings(cfg)
+            note = " Needs gevent installed; worker processes are not used with it." if value == "gevent" else ""
+            if status()["running"]:
+                toast(f"Websocket mode set to {value}; restart the server to apply.{note}", True)
+            else:
+                toast(f"Websocket mode set to {value}.{note}", True)
+            continue
+
         if choice == "0":
             return
 
@@ -0,0 +1,88 @@
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# ---- production HTTP server ------------------------------------------------
+# What app.py serves with when settings.json has "server_mode": "production":
+# Werkzeug's request handling (so Flask-SocketIO's threading mode and its
+# websocket upgrade keep working unchanged), but with no debugger, no
+# reloader and a fixed pool of worker threads instead of a new thread per
+# connection. Connections beyond the pool wait in the executor queue rather
+# than spawning more threads.
+# A connection holds its worker from accept on, so waiting for the request
+# line is bounded by IDLE_TIMEOUT: browser preconnects and clients that
+# open a socket and go quiet give their thread back instead of pinning it
+# (Werkzeug closes the connection after each response, so there are no
+# idle keep-alive sockets beyond that). Once the request line is in, the
+# socket goes back to blocking, so bodies, long-polls and websockets
+# aren't cut off. Each open websocket (console, live logs) keeps one
+# worker for as long as it is open; size the pool above the number of
+# those expected.
+DEFAULT_THREADS = 32
+MIN_THREADS = 4
+MAX_THREADS = 512
+IDLE_TIMEOUT = 5.0
+
+def threads_from_settings(data):
+    """server_threads from a settings.json dict, clamped."""
+    try:
+        return max(MIN_THREADS, min(MAX_THREADS, int((data or {}).get("server_threads") or DEFAULT_THREADS)))
+    except (TypeError, ValueError):
+        return DEFAULT_THREADS
+
+class _Handler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_one_request(self):
+        self.connection.settimeout(IDLE_TIMEOUT)
+        self._waiting = True
+        super().handle_one_request()
+        # one request per connection, as with Werkzeug's own "Connection:
+        # close"; a websocket that bypassed it would otherwise have its
+        # leftover frames read as the next request line
+        self.close_connection = True
+
+    def parse_request(self):
+        self._waiting = False
+        self.connection.settimeout(None)
+        return super().parse_request()
+
+    def log_error(self, format, *args):
+        # a connection that never sent a request isn't an error
+        if getattr(self, "_waiting", False) and format.startswith("Request timed out"):
+            return
+        super().log_error(format, *args)
+
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, app, threads=DEFAULT_THREADS, fd=None):
+        super().__init__(host, port, app, handler=_Handler, fd=fd)
+        self.threads = threads
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        # what socketserver.ThreadingMixIn does per thread; NODELAY because
+        # Werkzeug sends headers and body as separate writes
+        try:
+            if self.address_family in (socket.AF_INET, socket.AF_INET6):
+                request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        # also called from BaseWSGIServer.__init__ when given an fd
+        pool = getattr(self, "_pool", None)
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def make_server(host, port, app, threads=DEFAULT_THREADS, fd=None):
+    return PooledWSGIServer(host, port, app, threads=threads, fd=fd)